@@ -70,6 +70,7 @@ def _handler(request, response):
     object and creates the buffer
     """
 
+    import os
     from osgeo import ogr
 
     # obtaining input with identifier 'vector' as file name
@@ -85,7 +86,7 @@ def _handler(request, response):
 
     # create output file
     driver = ogr.GetDriverByName('GML')
-    output_source = driver.CreateDataSource(layer_name,
+    output_source = driver.CreateDataSource(os.path.join(response.workdir, layer_name),
         ["XSISCHEMAURI=http://schemas.opengis.net/gml/2.1.2/feature.xsd"])
     output_layer = output_source.CreateLayer(layer_name, None, ogr.wkbUnknown)
 
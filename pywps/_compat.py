@@ -20,6 +20,9 @@ if PY2:
     from urlparse import urlparse
     from urlparse import urljoin
     from urllib2 import urlopen
+    from urllib2 import Request
+    from urllib2 import HTTPError
+    import Queue as queue
 
 else:
     LOGGER.debug('Python 3.x')
@@ -29,3 +32,23 @@ else:
     from urllib.parse import urlparse
     from urllib.parse import urljoin
     from urllib.request import urlopen
+    from urllib.request import Request
+    from urllib.error import HTTPError
+    import queue
+
+
+def reset_logging_locks():
+    """Replace the locks of the logging module in a forked child
+
+    They may be held by threads of the parent, which do not exist in the
+    child. Python 3.7 and newer replace them at fork themselves.
+    """
+
+    if sys.version_info >= (3, 7):
+        return
+    import threading
+    logging._lock = threading.RLock()
+    for ref in logging._handlerList:
+        handler = ref()
+        if handler is not None:
+            handler.createLock()
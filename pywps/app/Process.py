@@ -5,26 +5,33 @@
 ##################################################################
 
 
+import atexit
+import copy
 import logging
 import os
 import sys
+import threading
 import traceback
-import json
 import shutil
 import tempfile
 
 from pywps import WPS, OWS, E, dblog
 from pywps.app.WPSResponse import WPSResponse
 from pywps.app.WPSResponse import STATUS
-from pywps.app.WPSRequest import WPSRequest
+from pywps.app.WorkerPool import get_worker_pool
+from pywps.app.Scheduler import get_scheduler
+from pywps.app.ResultCache import get_result_cache
+from pywps.app.WorkdirManager import get_workdir_manager
 import pywps.configuration as config
-from pywps._compat import PY2
+from pywps._compat import PY2, reset_logging_locks
 from pywps.exceptions import (StorageNotSupported, OperationNotSupported,
                               ServerBusy, NoApplicableCode)
 
 
 LOGGER = logging.getLogger("PYWPS")
 
+_GRASS_LOCATIONS_LOCK = threading.Lock()
+
 
 class Process(object):
     """
@@ -43,10 +50,38 @@ class Process(object):
                    objects.
     :param metadata: List of metadata advertised by this process. They
                      should be :class:`pywps.app.Common.Metadata` objects.
+    :param priority: Queued asynchronous requests of processes with higher
+                     priority are started first, if the `queueorder`
+                     configuration value is ``priority``.
+    :param weight: Number of the `parallelprocesses` slots taken by one
+                   running request of this process, e.g. according to its
+                   memory or CPU usage.
+    :param max_parallel: Maximum number of requests of this process running
+                         at the same time, None for no own limit.
+    :param cacheable: The outputs depend only on the inputs and the version
+                      of the process, so they may be taken from the result
+                      cache (see the `resultcachepath` configuration value)
+                      instead of running the handler again.
+    :param setup: A callable without arguments preparing expensive state of
+                  the handler (e.g. loading a model). It is called once per
+                  operating system process (server process or worker) before
+                  its first request of this process, and its result is passed
+                  to the handler as third argument on every request.
+    :param teardown: A callable releasing the result of `setup`, called when
+                     the worker is recycled or the server process exits.
+    :param batch_handler: Optional vectorized handler for batch requests (see
+                          :meth:`execute_batch`). It gets the lists of all
+                          :class:`pywps.app.WPSRequest` and
+                          :class:`pywps.app.WPSResponse` objects of the batch
+                          (and the `setup` result) and sets the outputs of
+                          each response. Without it, `handler` is called for
+                          each input set.
     """
 
     def __init__(self, handler, identifier, title, abstract='', profile=[], metadata=[], inputs=[],
-                 outputs=[], version='None', store_supported=False, status_supported=False, grass_location=None):
+                 outputs=[], version='None', store_supported=False, status_supported=False, grass_location=None,
+                 priority=0, weight=1, max_parallel=None, cacheable=False,
+                 setup=None, teardown=None, batch_handler=None):
         self.identifier = identifier
         self.handler = handler
         self.title = title
@@ -62,6 +97,16 @@ class Process(object):
         self.workdir = None
         self._grass_mapset = None
         self.grass_location = grass_location
+        self.priority = priority
+        self.weight = weight
+        self.max_parallel = max_parallel
+        self.cacheable = cacheable
+        self.setup = setup
+        self.teardown = teardown
+        self.batch_handler = batch_handler
+        # setup results and locks by pid, shared with the instances
+        self._setup_states = {}
+        self._setup_locks = {}
 
         if store_supported:
             self.store_supported = 'true'
@@ -123,8 +168,27 @@ class Process(object):
 
         return doc
 
+    def new_instance(self):
+        """Return lightweight copy of this process for a single request
+
+        The process definition (inputs and outputs definitions, formats,
+        validators, metadata) is shared with this process, the copy owns only
+        the request specific state: uuid, working directory, status location
+        and inputs and outputs values.
+        """
+
+        process = copy.copy(self)
+        process.inputs = [inpt.clone() for inpt in self.inputs]
+        process.outputs = [outpt.clone() for outpt in self.outputs]
+        process.uuid = None
+        process.status_location = ''
+        process.status_url = ''
+        process.workdir = None
+        process._grass_mapset = None
+        return process
+
     def execute(self, wps_request, uuid):
-        self._set_uuid(uuid)
+        self._set_uuid(uuid, wps_request.response_format)
         self.async = False
         wps_response = WPSResponse(self, wps_request, self.uuid)
 
@@ -148,8 +212,65 @@ class Process(object):
 
         return wps_response
 
-    def _set_uuid(self, uuid):
+    def execute_batch(self, processes, wps_requests, uuid):
+        """Run the requests of a batch synchronously
+
+        The batch takes the slots of one request of this process.
+
+        :param processes: new instances of this process, one per request
+        :param wps_requests: requests with the parsed inputs of each input set
+        :param uuid: identifier of the batch request
+        :return: list of responses, failed requests have status -1
+        """
+
+        wps_responses = []
+        for (process, wps_request) in zip(processes, wps_requests):
+            process._set_uuid(uuid)
+            process.async = False
+            wps_responses.append(WPSResponse(process, wps_request, process.uuid))
+
+        if not get_scheduler().acquire(self, uuid):
+            raise ServerBusy('Maximum number of parallel running processes reached. Please try later.')
+
+        try:
+            if self.batch_handler is None:
+                for (process, wps_request, wps_response) in zip(processes, wps_requests, wps_responses):
+                    process._run_handler(wps_request, wps_response)
+            else:
+                self._run_batch_handler(wps_requests, wps_responses)
+        finally:
+            self._release(uuid)
+
+        return wps_responses
+
+    def _run_batch_handler(self, wps_requests, wps_responses):
+        """Run the vectorized handler, the batch is logged once
+        """
+
+        try:
+            if self.setup is not None:
+                self.batch_handler(wps_requests, wps_responses, self._get_setup_state())
+            else:
+                self.batch_handler(wps_requests, wps_responses)
+            (message, percentage, status) = ('PyWPS Process {} finished'.format(self.title), 100, STATUS.DONE_STATUS)
+        except Exception as e:
+            traceback.print_exc()
+            message = 'Process error: %s' % e
+            LOGGER.error(message)
+            (percentage, status) = (-1, None)
+
+        for wps_response in wps_responses:
+            wps_response.message = message
+            wps_response.status_percentage = percentage
+            if status is not None:
+                wps_response.status = status
+        dblog.update_response(wps_responses[0].uuid, wps_responses[-1])
+
+    def _set_uuid(self, uuid, response_format='xml'):
         """Set uuid and status location path and url
+
+        :param response_format: encoding of the status document, 'xml' or
+            'json'
         """
 
         self.uuid = uuid
@@ -163,8 +284,9 @@ class Process(object):
 
         file_url = config.get_config_value('server', 'outputurl')
 
-        self.status_location = os.path.join(file_path, str(self.uuid)) + '.xml'
-        self.status_url = os.path.join(file_url, str(self.uuid)) + '.xml'
+        extension = '.json' if response_format == 'json' else '.xml'
+        self.status_location = os.path.join(file_path, str(self.uuid)) + extension
+        self.status_url = os.path.join(file_url, str(self.uuid)) + extension
 
     def _execute_process(self, async, wps_request, wps_response):
         """Uses :module:`multiprocessing` module for sending process to
@@ -174,25 +296,13 @@ class Process(object):
         :return: wps_response or None
         """
 
-        maxparallel = int(config.get_config_value('server', 'parallelprocesses'))
-        running = dblog.get_running().count()
-        stored = dblog.get_stored().count()
-
         # async
         if async:
-
-            # run immedietly
-            if running < maxparallel or maxparallel == -1:
-                self._run_async(wps_request, wps_response)
-
-            # try to store for later usage
-            else:
-                wps_response = self._store_process(stored,
-                                                   wps_request, wps_response)
+            wps_response = get_scheduler().submit(self, wps_request, wps_response)
 
         # not async
         else:
-            if running < maxparallel or maxparallel == -1:
+            if get_scheduler().acquire(self):
                 wps_response = self._run_process(wps_request, wps_response)
             else:
                 raise ServerBusy('Maximum number of parallel running processes reached. Please try later.')
@@ -200,29 +310,64 @@ class Process(object):
         return wps_response
 
     def _run_async(self, wps_request, wps_response):
-        import multiprocessing
-        process = multiprocessing.Process(
-            target=self._run_process,
-            args=(wps_request, wps_response)
-        )
-        process.start()
-
-    def _store_process(self, stored, wps_request, wps_response):
-        """Try to store given requests
+        pool = get_worker_pool()
+        if pool is None or not pool.submit(self, wps_request, wps_response):
+            import multiprocessing
+            process = multiprocessing.Process(
+                target=self._run_forked,
+                args=(wps_request, wps_response)
+            )
+            process.start()
+
+        if not dblog.is_shared():
+            # the child process writes to its own copy of the database, it
+            # cannot take the slot over and release it
+            get_scheduler().release(self.uuid)
+
+    def _run_forked(self, wps_request, wps_response):
+        """Run the request in the child process forked for it
         """
+        reset_logging_locks()
+        return self._run_detached(wps_request, wps_response, teardown=True)
 
-        maxprocesses = int(config.get_config_value('server', 'maxprocesses'))
+    def _run_detached(self, wps_request, wps_response, teardown=False):
+        """Run the process in its own (child) operating system process
 
-        if stored < maxprocesses:
-            LOGGER.debug("Store process in job queue, uuid=%s", self.uuid)
-            dblog.store_process(self.uuid, wps_request)
-            wps_response.update_status('PyWPS Process stored in job queue', 0)
-        else:
-            raise ServerBusy('Maximum number of parallel running processes reached. Please try later.')
+        The working directory can be changed safely here, as it is not shared
+        with other requests.
 
-        return wps_response
+        :param teardown: release the setup state afterwards, as the child
+            process runs only this request
+        """
+        get_scheduler().hold(self)
+        if self.workdir and os.path.isdir(self.workdir):
+            os.chdir(self.workdir)
+        try:
+            return self._run_process(wps_request, wps_response)
+        finally:
+            # the child process exits without running atexit handlers
+            if teardown:
+                self._teardown_setup()
+            dblog.flush()
 
     def _run_process(self, wps_request, wps_response):
+        """Run the request in the slot taken for it and release the slot
+        """
+
+        try:
+            return self._run_handler(wps_request, wps_response)
+        finally:
+            self._release(self.uuid)
+
+    def _release(self, uuid):
+        get_scheduler().release(uuid)
+        # a slot is free now
+        try:
+            get_scheduler().dispatch()
+        except Exception as e:
+            LOGGER.error("Could not run stored process. %s", e)
+
+    def _run_handler(self, wps_request, wps_response):
         try:
             self._set_grass()
             # if required set HOME to the current working directory.
@@ -231,12 +376,19 @@ class Process(object):
                 LOGGER.info('Setting HOME to current working directory: %s', os.environ['HOME'])
             LOGGER.debug('ProcessID=%s, HOME=%s', self.uuid, os.environ.get('HOME'))
             wps_response.update_status('PyWPS Process started', 0)
-            wps_response = self.handler(wps_request, wps_response)
+            message = 'PyWPS Process {} finished'.format(self.title)
+            if self._get_cached_result(wps_request):
+                message += ' (cached result)'
+            else:
+                if self.setup is not None:
+                    wps_response = self.handler(wps_request, wps_response, self._get_setup_state())
+                else:
+                    wps_response = self.handler(wps_request, wps_response)
+                self._cache_result(wps_request)
 
             # if (not wps_response.status_percentage) or (wps_response.status_percentage != 100):
             LOGGER.debug('Updating process status to 100% if everything went correctly')
-            wps_response.update_status('PyWPS Process {} finished'.format(self.title),
-                                       100, STATUS.DONE_STATUS, clean=self.async)
+            wps_response.update_status(message, 100, STATUS.DONE_STATUS, clean=self.async)
         except Exception as e:
             traceback.print_exc()
             LOGGER.debug('Retrieving file and line number where exception occurred')
@@ -266,35 +418,79 @@ class Process(object):
             else:
                 wps_response.update_status(msg, -1)
 
-        # tr
-        stored_request = dblog.get_first_stored()
-        if stored_request:
-            try:
-                (uuid, request_json) = (stored_request.uuid, stored_request.request)
-                if not PY2:
-                    request_json = request_json.decode('utf-8')
-                new_wps_request = WPSRequest()
-                new_wps_request.json = json.loads(request_json)
-                new_wps_response = WPSResponse(self, new_wps_request, uuid)
-                new_wps_response.status = STATUS.STORE_AND_UPDATE_STATUS
-                self._set_uuid(uuid)
-                self._run_async(new_wps_request, new_wps_response)
-                dblog.remove_stored(uuid)
-            except Exception as e:
-                LOGGER.error("Could not run stored process. %s", e)
-
         return wps_response
 
+    def _get_cached_result(self, wps_request):
+        """Set outputs from the result cache
+
+        :return: True if the result was found in the cache
+        """
+
+        self._result_key = None
+        cache = get_result_cache() if self.cacheable else None
+        if cache is None:
+            return False
+        try:
+            self._result_key = cache.key(self, wps_request)
+            return cache.get(self._result_key, self)
+        except Exception as e:
+            LOGGER.error('Could not read result cache: %s', e)
+            return False
+
+    def _cache_result(self, wps_request):
+        cache = get_result_cache() if self.cacheable else None
+        if cache is None or self._result_key is None:
+            return
+        try:
+            cache.put(self._result_key, self)
+        except Exception as e:
+            LOGGER.error('Could not store result in cache: %s', e)
+
+    def _get_setup_state(self):
+        """Return result of the setup hook in this operating system process
+        """
+
+        pid = os.getpid()
+        lock = self._setup_locks.setdefault(pid, threading.Lock())
+        with lock:
+            if pid not in self._setup_states:
+                LOGGER.info('Setting up process %s in %s', self.identifier, pid)
+                self._setup_states[pid] = self.setup()
+                atexit.register(self._teardown_setup)
+            return self._setup_states[pid]
+
+    def _teardown_setup(self):
+        """Run the teardown hook, if the setup hook ran in this operating
+        system process
+        """
+
+        pid = os.getpid()
+        if pid not in self._setup_states:
+            return
+        state = self._setup_states.pop(pid)
+        self._setup_locks.pop(pid, None)
+        if self.teardown is None:
+            return
+        LOGGER.info('Tearing down process %s in %s', self.identifier, pid)
+        try:
+            self.teardown(state)
+        except Exception as e:
+            LOGGER.error('Teardown of process %s failed: %s', self.identifier, e)
+
     def clean(self):
         """Clean the process working dir and other temporary files
+
+        The directories are deleted in the background, see
+        :class:`pywps.app.WorkdirManager.WorkdirManager`.
         """
         LOGGER.info("Removing temporary working directory: %s" % self.workdir)
         try:
+            manager = get_workdir_manager()
             if os.path.isdir(self.workdir):
-                shutil.rmtree(self.workdir)
+                manager.remove(self.workdir)
             if self._grass_mapset and os.path.isdir(self._grass_mapset):
                 LOGGER.info("Removing temporary GRASS GIS mapset: %s" % self._grass_mapset)
-                shutil.rmtree(self._grass_mapset)
+                manager.remove(self._grass_mapset)
         except Exception as err:
             LOGGER.error('Unable to remove directory: %s', err)
 
@@ -319,7 +515,9 @@ class Process(object):
         in the first case, new temporary mapset within the location will be
         created
 
-        in the second case, location will be created in self.workdir
+        in the second case, location will be copied to self.workdir from a
+        template, which is created once per EPSG code in the `locations`
+        directory of the `grass` configuration section
 
         the mapset should be deleted automatically using self.clean() method
         """
@@ -331,8 +529,6 @@ class Process(object):
 
         if self.grass_location:
 
-            from grass.script import core as grass
-
             dbase = ''
             location = ''
 
@@ -340,21 +536,12 @@ class Process(object):
             # server
             os.environ['HOME'] = self.workdir
 
-            # GISRC envvariable needs to be set
-            gisrc = open(os.path.join(self.workdir, 'GISRC'), 'w')
-            gisrc.write("GISDBASE: %s\n" % self.workdir)
-            gisrc.write("GUI: txt\n")
-            gisrc.close()
-            os.environ['GISRC'] = gisrc.name
-
-            # create new location from epsg code
+            # copy location created from epsg code
             if self.grass_location.lower().startswith('epsg:'):
                 epsg = self.grass_location.lower().replace('epsg:', '')
                 dbase = self.workdir
-                os.environ['GISDBASE'] = self.workdir
                 location = 'pywps_location'
-                grass.run_command('g.gisenv', set="GISDBASE=%s" % dbase)
-                grass.run_command('g.proj', flags="t", location=location, epsg=epsg)
+                shutil.copytree(_get_grass_location(epsg), os.path.join(dbase, location))
                 LOGGER.debug('GRASS location based on EPSG code created')
 
             # create temporary mapset within existing location
@@ -362,7 +549,6 @@ class Process(object):
                 LOGGER.debug('Temporary mapset will be created')
                 dbase = os.path.dirname(self.grass_location)
                 location = os.path.basename(self.grass_location)
-                grass.run_command('g.gisenv', set="GISDBASE=%s" % dbase)
 
             else:
                 raise NoApplicableCode('Location does exists or does not seem ' +
@@ -382,12 +568,73 @@ class Process(object):
             # set _grass_mapset attribute - will be deleted once handler ends
             self._grass_mapset = mapset_name
 
-            # final initialization
+            # final initialization, the GISRC file is written directly
+            # instead of running g.gisenv for each variable
             LOGGER.debug('GRASS Mapset set to %s' % mapset_name)
-            grass.run_command('g.gisenv', set="LOCATION_NAME=%s" % location)
-            grass.run_command('g.gisenv', set="MAPSET=%s" % os.path.basename(mapset_name))
+            os.environ['GISRC'] = _write_gisrc(self.workdir, dbase, location, os.path.basename(mapset_name))
+            os.environ['GISDBASE'] = dbase
 
             LOGGER.debug('GRASS environment initialised')
             LOGGER.debug('GISRC {}, GISBASE {}, GISDBASE {}, LOCATION {}, MAPSET {}'.format(
                          os.environ.get('GISRC'), os.environ.get('GISBASE'),
                          dbase, location, os.path.basename(mapset_name)))
+
+
+def _write_gisrc(directory, dbase, location, mapset):
+    """Write GRASS GIS variables file into directory
+
+    :return: path of the file
+    """
+
+    gisrc = os.path.join(directory, 'GISRC')
+    with open(gisrc, 'w') as f:
+        f.write("GISDBASE: %s\n" % dbase)
+        f.write("LOCATION_NAME: %s\n" % location)
+        f.write("MAPSET: %s\n" % mapset)
+        f.write("GUI: txt\n")
+    return gisrc
+
+
+def _get_grass_location(epsg):
+    """Return template GRASS GIS location of the EPSG code
+
+    The location is created by g.proj at the first use and shared by all
+    requests and server processes using the same `locations` directory.
+    """
+
+    path = config.get_config_value('grass', 'locations')
+    if not path:
+        path = os.path.join(os.path.abspath(config.get_config_value('server', 'workdir')), 'pywps_grass_locations')
+    template = os.path.join(path, 'epsg_%s' % epsg)
+    if os.path.isdir(os.path.join(template, 'PERMANENT')):
+        return template
+
+    with _GRASS_LOCATIONS_LOCK:
+        if os.path.isdir(os.path.join(template, 'PERMANENT')):
+            return template
+
+        from grass.script import core as grass
+
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # created by another process meanwhile
+                pass
+
+        # create the location aside, another process may be creating it too
+        dbase = tempfile.mkdtemp(prefix='.epsg_%s_' % epsg, dir=path)
+        try:
+            env = os.environ.copy()
+            env['GISRC'] = _write_gisrc(dbase, dbase, 'location', 'PERMANENT')
+            if grass.run_command('g.proj', flags='t', location='location', epsg=epsg, env=env) != 0:
+                raise NoApplicableCode('Could not create GRASS location from EPSG code %s' % epsg)
+            try:
+                os.rename(os.path.join(dbase, 'location'), template)
+            except OSError:
+                if not os.path.isdir(os.path.join(template, 'PERMANENT')):
+                    raise
+            LOGGER.info('GRASS location template created for EPSG code %s', epsg)
+        finally:
+            shutil.rmtree(dbase, ignore_errors=True)
+    return template
@@ -0,0 +1,291 @@
+##################################################################
+# Copyright 2016 OSGeo Foundation,                               #
+# represented by PyWPS Project Steering Committee,               #
+# licensed under MIT, Please consult LICENSE.txt for details     #
+##################################################################
+
+"""
+Cache of results of deterministic processes
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from pywps import configuration as config
+from pywps._compat import PY2
+from pywps.inout.basic import SOURCE_TYPE
+
+LOGGER = logging.getLogger('PYWPS')
+
+CHUNK_SIZE = 64 * 1024
+
+_RESULT_CACHE = None
+_RESULT_CACHE_LOCK = threading.Lock()
+
+
+def get_result_cache():
+    """Return the :class:`ResultCache` of this server process
+
+    :return: the cache or None if `resultcachepath` is not configured
+    """
+
+    global _RESULT_CACHE
+
+    path = config.get_config_value('server', 'resultcachepath')
+    if not path:
+        return None
+
+    max_size = config.get_size_mb(config.get_config_value('server', 'resultcachesize')) * 1024 * 1024
+    ttl = float(config.get_config_value('server', 'resultcachettl'))
+    with _RESULT_CACHE_LOCK:
+        if (_RESULT_CACHE is None or _RESULT_CACHE.path != path or
+                _RESULT_CACHE.max_size != max_size or _RESULT_CACHE.ttl != ttl):
+            _RESULT_CACHE = ResultCache(path, max_size, ttl)
+        return _RESULT_CACHE
+
+
+class ResultCache(object):
+    """Outputs of cacheable processes by their inputs
+
+    Results are keyed by the identifier and version of the process, the
+    values of the literal and bounding box inputs, the content of the complex
+    inputs (including those passed by reference) and the requested output
+    formats. Each result is a directory in `path` with the output files and
+    a ``result.json`` file with the other output values. Results older than
+    `ttl` seconds are not used and removed, least recently used results are
+    removed as soon as the total size exceeds `max_size` bytes.
+
+    Counters of this server process are available in :attr:`stats`.
+
+    :param path: cache directory
+    :param max_size: maximum total size of the cached files in bytes
+    :param ttl: time to live of results in seconds, 0 for no limit
+    """
+
+    def __init__(self, path, max_size, ttl=0):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'stored': 0,
+            'evicted': 0
+        }
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    @property
+    def stats(self):
+        """Copy of the hit, miss and eviction counters
+        """
+
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, **counters):
+        with self._lock:
+            for (name, value) in counters.items():
+                self._stats[name] += value
+
+    @staticmethod
+    def key(process, wps_request):
+        """Return cache key of the request
+
+        :param process: :class:`pywps.app.Process.Process` instance
+        :param wps_request: parsed request with the fetched inputs
+        """
+
+        digest = hashlib.sha256()
+
+        def update(*values):
+            for value in values:
+                digest.update(u'{}\n'.format(value).encode('utf-8'))
+
+        update(process.identifier, process.version)
+        for identifier in sorted(wps_request.inputs):
+            for inpt in wps_request.inputs[identifier]:
+                update('input', identifier)
+                if hasattr(inpt, 'data_format'):
+                    update(inpt.data_format.mime_type, inpt.data_format.encoding, inpt.data_format.schema)
+                    digest.update(_content_hash(inpt).encode('utf-8'))
+                else:
+                    update(json.dumps(inpt.data, sort_keys=True, default=str), getattr(inpt, 'uom', None))
+
+        for identifier in sorted(wps_request.outputs or {}):
+            requested = wps_request.outputs[identifier]
+            update('output', identifier)
+            update(*[requested.get(name, '') for name in ('mimetype', 'encoding', 'schema', 'uom')])
+
+        return digest.hexdigest()
+
+    def get(self, key, process):
+        """Set the cached outputs of the result to the process outputs
+
+        :return: False if there is no valid result
+        """
+
+        result_dir = os.path.join(self.path, key)
+        result = self._read_result(result_dir)
+        if result is None or self._expired(result_dir):
+            self._count(misses=1)
+            return False
+
+        try:
+            for outpt in process.outputs:
+                if outpt.identifier not in result['outputs']:
+                    continue
+                value = result['outputs'][outpt.identifier]
+                if 'file' in value:
+                    target = os.path.join(process.workdir, value['file'])
+                    _link(os.path.join(result_dir, value['file']), target)
+                    outpt.file = target
+                else:
+                    outpt.data = value['data']
+        except (IOError, OSError) as e:
+            # removed meanwhile
+            LOGGER.debug('Could not use cached result %s: %s', key, e)
+            self._count(misses=1)
+            return False
+
+        self._touch(result_dir)
+        self._count(hits=1)
+        LOGGER.info('Result cache hit for process %s, uuid=%s', process.identifier, process.uuid)
+        return True
+
+    def put(self, key, process):
+        """Store the outputs of the process
+        """
+
+        tmp_dir = tempfile.mkdtemp(dir=self.path, prefix='.result_')
+        try:
+            result = {'outputs': {}, 'size': 0}
+            for outpt in process.outputs:
+                if outpt.source_type is None:
+                    continue
+                if hasattr(outpt, 'data_format'):
+                    file_name = '{}_{}'.format(len(result['outputs']), os.path.basename(outpt.file))
+                    shutil.copyfile(outpt.file, os.path.join(tmp_dir, file_name))
+                    result['size'] += os.path.getsize(os.path.join(tmp_dir, file_name))
+                    result['outputs'][outpt.identifier] = {'file': file_name}
+                else:
+                    result['outputs'][outpt.identifier] = {'data': outpt.data}
+
+            with open(os.path.join(tmp_dir, 'result.json'), 'w') as f:
+                json.dump(result, f, default=str)
+            if result['size'] > self.max_size:
+                shutil.rmtree(tmp_dir)
+                return
+
+            result_dir = os.path.join(self.path, key)
+            if os.path.isdir(result_dir):
+                # stored by another request meanwhile, or expired
+                shutil.rmtree(result_dir, ignore_errors=True)
+            os.rename(tmp_dir, result_dir)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        self._count(stored=1)
+        LOGGER.debug('Stored result of process %s in cache', process.identifier)
+        self._evict(keep=key)
+
+    def _read_result(self, result_dir):
+        try:
+            with open(os.path.join(result_dir, 'result.json')) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _expired(self, result_dir):
+        if not self.ttl:
+            return False
+        try:
+            created = os.path.getctime(os.path.join(result_dir, 'result.json'))
+        except OSError:
+            return True
+        return time.time() - created > self.ttl
+
+    def _touch(self, result_dir):
+        """Mark the result as recently used
+        """
+
+        try:
+            os.utime(result_dir, None)
+        except OSError:
+            pass
+
+    def _evict(self, keep=None):
+        """Remove expired and least recently used results until the cache
+        fits in max_size
+        """
+
+        results = []
+        total_size = 0
+        for name in os.listdir(self.path):
+            result_dir = os.path.join(self.path, name)
+            if name.startswith('.') or not os.path.isdir(result_dir):
+                continue
+            result = self._read_result(result_dir)
+            if result is None:
+                continue
+            try:
+                used = os.path.getmtime(result_dir)
+            except OSError:
+                continue
+            if name != keep and self._expired(result_dir):
+                self._remove(result_dir)
+                continue
+            results.append((used, name, result['size']))
+            total_size += result['size']
+
+        for (used, name, size) in sorted(results):
+            if total_size <= self.max_size:
+                break
+            if name == keep:
+                continue
+            self._remove(os.path.join(self.path, name))
+            total_size -= size
+
+    def _remove(self, result_dir):
+        shutil.rmtree(result_dir, ignore_errors=True)
+        self._count(evicted=1)
+        LOGGER.debug('Removed result %s from cache', os.path.basename(result_dir))
+
+
+def _content_hash(inpt):
+    """Return sha256 of the content of the complex input
+    """
+
+    digest = hashlib.sha256()
+    if inpt.source_type == SOURCE_TYPE.FILE:
+        with open(inpt.file, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+    else:
+        data = inpt.data
+        if PY2 or not isinstance(data, bytes):
+            data = u'{}'.format(data).encode('utf-8')
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def _link(source, target):
+    """Hard link cached file to target, copy it to another file system
+    """
+
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        if not os.path.exists(source):
+            raise
+        shutil.copyfile(source, target)
@@ -0,0 +1,446 @@
+##################################################################
+# Copyright 2016 OSGeo Foundation,                               #
+# represented by PyWPS Project Steering Committee,               #
+# licensed under MIT, Please consult LICENSE.txt for details     #
+##################################################################
+
+"""
+Scheduling of asynchronous requests
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+import pywps.configuration as config
+from pywps import dblog
+from pywps.app.WPSRequest import WPSRequest
+from pywps.app.WPSResponse import WPSResponse, STATUS
+from pywps.exceptions import ServerBusy, NoApplicableCode
+
+LOGGER = logging.getLogger('PYWPS')
+
+# processes of the services, by identifier
+_PROCESSES = {}
+_SCHEDULER = None
+_SCHEDULER_LOCK = threading.Lock()
+
+
+def register_process(process):
+    """Make the process available for queued requests and to workers
+    started afterwards
+    """
+
+    _PROCESSES[process.identifier] = process
+
+
+def job_description(process, wps_request, wps_response):
+    """Return description of the request, from which it can be started in
+    another process with :func:`restore_job`
+
+    :return: dict, which can be encoded as JSON
+    """
+
+    return {
+        'identifier': process.identifier,
+        'uuid': str(process.uuid),
+        'node': dblog.get_node(),
+        'workdir': process.workdir,
+        'request': wps_request.json,
+        'status': wps_response.status
+    }
+
+
+def restore_job(job, processes=None):
+    """Return process, request and response described by the job
+
+    :param job: dict returned by :func:`job_description`
+    :param processes: processes by identifier, defaults to the registered ones
+    :return: (process, wps_request, wps_response), the process is a new
+        instance of the registered one
+    """
+
+    if processes is None:
+        processes = _PROCESSES
+    if not os.path.isdir(job['workdir'] or ''):
+        raise NoApplicableCode('Working directory %s of the request is not available' % job['workdir'])
+    process = processes[job['identifier']].new_instance()
+
+    wps_request = WPSRequest()
+    wps_request.json = json.loads(job['request'])
+
+    process._set_uuid(job['uuid'], wps_request.response_format)
+    process.set_workdir(job['workdir'])
+    process.async = True
+    for outpt in process.outputs:
+        requested = wps_request.outputs.get(outpt.identifier, {})
+        outpt.as_reference = requested.get('asReference', 'false').lower() == 'true'
+
+    wps_response = WPSResponse(process, wps_request, job['uuid'])
+    wps_response.status = job['status']
+    return (process, wps_request, wps_response)
+
+
+def get_scheduler():
+    """Return the :class:`Scheduler` of this operating system process
+    """
+
+    global _SCHEDULER, _SCHEDULER_LOCK
+
+    if _SCHEDULER is not None and _SCHEDULER.pid != os.getpid():
+        # forked child, the lock may be held by a thread of the parent
+        _SCHEDULER_LOCK = threading.Lock()
+        _SCHEDULER = None
+    with _SCHEDULER_LOCK:
+        if _SCHEDULER is None or _SCHEDULER.pid != os.getpid():
+            _SCHEDULER = Scheduler()
+        return _SCHEDULER
+
+
+def get_limits(process):
+    """Return weight and maximum number of parallel requests of the process
+
+    Both can be overridden in the `[processes]` configuration section by
+    options ``<identifier>.weight`` and ``<identifier>.maxparallel``.
+
+    :return: (weight, max_parallel), max_parallel is None for no limit
+    """
+
+    weight = getattr(process, 'weight', 1)
+    max_parallel = getattr(process, 'max_parallel', None)
+    if config.CONFIG and config.CONFIG.has_section('processes'):
+        option = '%s.weight' % process.identifier
+        if config.CONFIG.has_option('processes', option):
+            weight = config.CONFIG.getfloat('processes', option)
+        option = '%s.maxparallel' % process.identifier
+        if config.CONFIG.has_option('processes', option):
+            max_parallel = config.CONFIG.getint('processes', option)
+            if max_parallel < 0:
+                max_parallel = None
+    return (weight, max_parallel)
+
+
+class Scheduler(object):
+    """Starts asynchronous requests as far as `parallelprocesses` allows
+    and queues the others
+
+    Each running request takes the weight of its process (default 1) from
+    the `parallelprocesses` slots, and a process may limit the number of its
+    own requests running at the same time (see :func:`get_limits`). A request
+    heavier than all slots is started only when nothing else runs.
+
+    Slots are rows of a small table with a lease of `leasetime` seconds.
+    The operating system process running the request renews the lease by a
+    heartbeat (see :class:`Heartbeat`) and releases the slot when the request
+    is done. Slots of crashed requests expire, their requests are logged as
+    failed when the queue is dispatched.
+
+    The queue is stored in the database, so that all server processes share
+    it, also those of other nodes using the same database. Slots are counted
+    per node, a node starts a queued request only after claiming it in the
+    database. At most `maxprocesses` requests may wait. Queued requests are started
+    in FIFO order, or by the priority of their process first if `queueorder`
+    is ``priority``. Requests of processes at their own limit are skipped,
+    but the queue stops at the first request which does not fit in the free
+    slots, so that heavy requests are not starved by light ones. The queue is
+    dispatched whenever a request finishes and every `schedulerinterval`
+    seconds by the process which accepted the requests, so that it does not
+    stall if a request dies.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._ticker = None
+        self._stopped = threading.Event()
+        self._heartbeat = None
+        self._lock_heartbeat = threading.Lock()
+
+    def submit(self, process, wps_request, wps_response):
+        """Start the request now or queue it
+
+        :raises ServerBusy: the queue is full
+        :return: wps_response
+        """
+
+        self._start_ticker()
+        with self._lock:
+            # queued requests go first
+            stored = dblog.count_stored()
+            run = not stored and self._acquire(process, process.uuid)
+        if run:
+            # the child process is forked outside of the lock, so that it
+            # does not inherit it locked
+            self._run(process, wps_request, wps_response)
+            return wps_response
+
+        with self._lock:
+            maxprocesses = int(config.get_config_value('server', 'maxprocesses'))
+            if stored >= maxprocesses:
+                raise ServerBusy('Maximum number of parallel running processes reached. Please try later.')
+
+            LOGGER.debug("Store process in job queue, uuid=%s", process.uuid)
+            job = job_description(process, wps_request, wps_response)
+            dblog.store_process(process.uuid, json.dumps(job), process.priority)
+            wps_response.update_status('PyWPS Process stored in job queue', 0)
+
+        # a slot may have been freed meanwhile
+        self.dispatch()
+        return wps_response
+
+    def acquire(self, process, uuid=None):
+        """Take a slot for a request of the process, if it may start now
+
+        :param uuid: identifier of the request, defaults to process.uuid
+        :return: False if there is no free slot
+        """
+
+        with self._lock:
+            return self._acquire(process, uuid or process.uuid)
+
+    def hold(self, process):
+        """Take over the slot of the request run by this operating system
+        process from the one, which admitted it
+        """
+
+        (weight, max_parallel) = get_limits(process)
+        dblog.hold_slot(process.uuid, process.identifier, weight, self._get_heartbeat().lease)
+        self._get_heartbeat().add(process.uuid)
+
+    def release(self, uuid):
+        """Release the slot of the finished request
+        """
+
+        self._get_heartbeat().discard(uuid)
+        dblog.release_slot(uuid)
+
+    def dispatch(self):
+        """Start queued requests while there are free slots
+
+        :return: number of started requests
+        """
+
+        with self._lock:
+            self._expire()
+            load = self._get_load()
+            priority = config.get_config_value('server', 'queueorder') == 'priority'
+            started = []
+            for stored in dblog.get_stored(priority):
+                job = _load_job(stored)
+                if not _is_accessible(job):
+                    # left to the node, which queued it
+                    continue
+                process = _PROCESSES.get(job.get('identifier') if job else None)
+                if process is not None and not self._admit(process, load):
+                    (weight, max_parallel) = get_limits(process)
+                    if max_parallel is not None and load['counts'].get(process.identifier, 0) >= max_parallel:
+                        continue
+                    break
+                if process is not None and not self._acquire(process, stored.uuid):
+                    # taken by another server process meanwhile
+                    break
+                # another process or node may have started it already, the
+                # request leaves the queue before it is started, only if the
+                # claim is still valid, so that it never runs twice
+                token = dblog.claim_stored(stored.uuid)
+                if token is None or not dblog.remove_stored(stored.uuid, token):
+                    if token is not None:
+                        LOGGER.warning('Claim of stored process %s was taken over', stored.uuid)
+                    if process is not None:
+                        self.release(stored.uuid)
+                    continue
+                started.append(stored)
+                if process is not None:
+                    self._add_load(load, process)
+        # child processes are forked outside of the lock
+        for stored in started:
+            self._start(stored)
+        return len(started)
+
+    def _acquire(self, process, uuid):
+        """Take slot and check afterwards, that it fits, so that server
+        processes admitting requests at the same time do not overcommit
+        """
+
+        (weight, max_parallel) = get_limits(process)
+        heartbeat = self._get_heartbeat()
+        dblog.hold_slot(uuid, process.identifier, weight, heartbeat.lease)
+        if self._admit(process, self._get_load(exclude=uuid)):
+            heartbeat.add(uuid)
+            return True
+        dblog.release_slot(uuid)
+        return False
+
+    def _get_load(self, exclude=None):
+        """Return total weight and number of requests running on this node
+        by process
+        """
+
+        load = {'weight': 0, 'counts': {}}
+        for slot in dblog.get_slots(dblog.get_node()):
+            if slot.uuid == str(exclude):
+                continue
+            load['weight'] += slot.weight
+            load['counts'][slot.identifier] = load['counts'].get(slot.identifier, 0) + 1
+        return load
+
+    def _expire(self):
+        """Log requests with expired slots as failed
+        """
+
+        for uuid in dblog.expire_slots():
+            LOGGER.warning('Slot of process %s expired, the process died', uuid)
+
+            class LostResponse:
+                message = 'Process died'
+                status_percentage = -1
+                status = STATUS.ERROR_STATUS
+            dblog.update_response(uuid, LostResponse, close=True)
+
+    def _get_heartbeat(self):
+        if self._heartbeat is None:
+            with self._lock_heartbeat:
+                if self._heartbeat is None:
+                    self._heartbeat = Heartbeat(float(config.get_config_value('server', 'leasetime')))
+                    self._heartbeat.start()
+        return self._heartbeat
+
+    @staticmethod
+    def _add_load(load, process):
+        load['weight'] += get_limits(process)[0]
+        load['counts'][process.identifier] = load['counts'].get(process.identifier, 0) + 1
+
+    @staticmethod
+    def _admit(process, load):
+        (weight, max_parallel) = get_limits(process)
+        if max_parallel is not None and load['counts'].get(process.identifier, 0) >= max_parallel:
+            return False
+        maxparallel = int(config.get_config_value('server', 'parallelprocesses'))
+        if maxparallel == -1:
+            return True
+        if not load['counts']:
+            return maxparallel > 0
+        return load['weight'] + weight <= maxparallel
+
+    def _run(self, process, wps_request, wps_response):
+        dblog.update_response(process.uuid, wps_response)
+        try:
+            process._run_async(wps_request, wps_response)
+        except Exception:
+            self.release(process.uuid)
+            raise
+
+    def _start(self, stored):
+        try:
+            job = json.loads(_get_request(stored))
+            (process, wps_request, wps_response) = restore_job(job)
+            LOGGER.debug('Starting queued process %s, uuid=%s', process.identifier, process.uuid)
+            self._run(process, wps_request, wps_response)
+        except Exception as e:
+            LOGGER.error('Could not run stored process %s: %s', stored.uuid, e)
+            self.release(stored.uuid)
+
+            class FailedResponse:
+                message = 'Could not run stored process: %s' % e
+                status_percentage = -1
+                status = STATUS.ERROR_STATUS
+            dblog.update_response(stored.uuid, FailedResponse, close=True)
+
+    def _start_ticker(self):
+        interval = float(config.get_config_value('server', 'schedulerinterval'))
+        if interval <= 0 or self._ticker is not None:
+            return
+        with self._lock:
+            if self._ticker is None:
+                self._ticker = threading.Thread(target=self._tick, args=(interval,), name='pywps-scheduler')
+                self._ticker.daemon = True
+                self._ticker.start()
+
+    def _tick(self, interval):
+        while not self._stopped.wait(interval):
+            try:
+                self.dispatch()
+            except Exception as e:
+                LOGGER.error('Dispatching the job queue failed: %s', e)
+
+    def stop(self):
+        """Stop the periodic dispatching
+        """
+
+        self._stopped.set()
+
+
+def _get_request(stored):
+    """Return JSON encoded job description of the stored request
+    """
+
+    request = stored.request
+    if isinstance(request, bytes):
+        request = request.decode('utf-8')
+    return request
+
+
+def _load_job(stored):
+    """Return job description of the stored request, None if it is invalid
+    """
+
+    try:
+        job = json.loads(_get_request(stored))
+    except (ValueError, TypeError):
+        return None
+    return job if isinstance(job, dict) else None
+
+
+def _is_accessible(job):
+    """Check, whether this node can start the queued request
+
+    Requests queued by other nodes are started only, if their working
+    directory, which holds the inputs, is shared with this node. Requests
+    queued by this node (or invalid ones) are always started, failing if the
+    working directory is gone.
+    """
+
+    if job is None or job.get('node', dblog.get_node()) == dblog.get_node():
+        return True
+    return os.path.isdir(job.get('workdir') or '')
+
+
+class Heartbeat(threading.Thread):
+    """Thread renewing the leases of the slots held by this operating system
+    process every third of the lease time
+
+    :param lease: lease time in seconds
+    """
+
+    def __init__(self, lease):
+        threading.Thread.__init__(self, name='pywps-heartbeat')
+        self.daemon = True
+        self.lease = lease
+        self._uuids = set()
+        self._lock = threading.Lock()
+
+    def add(self, uuid):
+        with self._lock:
+            self._uuids.add(str(uuid))
+
+    def discard(self, uuid):
+        with self._lock:
+            self._uuids.discard(str(uuid))
+
+    def run(self):
+        while True:
+            time.sleep(self.lease / 3.0)
+            with self._lock:
+                uuids = list(self._uuids)
+            if not uuids:
+                continue
+            try:
+                renewed = dblog.renew_slots(uuids, self.lease)
+            except Exception as e:
+                LOGGER.error('Could not renew slots: %s', e)
+                continue
+            # released or taken over by the process running the request
+            with self._lock:
+                self._uuids.difference_update(set(uuids) - renewed)
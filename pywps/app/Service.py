@@ -5,30 +5,39 @@
 ##################################################################
 
 
+import copy
 import logging
+import shutil
 import tempfile
 from werkzeug.exceptions import HTTPException
 from werkzeug.wrappers import Request, Response
-from pywps import WPS, OWS
+from pywps import WPS, OWS, E
 from pywps._compat import PY2
-from pywps._compat import urlopen
 from pywps._compat import urlparse
-from pywps.app.basic import xml_response
+from pywps.app.basic import xml_response, xml_serialize, xml_envelope, file_response, CachedDocument, \
+    compress_response
 from pywps.app.WPSRequest import WPSRequest
+from pywps.app.Scheduler import register_process
+from pywps.app.WorkdirManager import get_workdir_manager
 import pywps.configuration as config
 from pywps.exceptions import MissingParameterValue, NoApplicableCode, InvalidParameterValue, FileSizeExceeded, \
     StorageNotSupported
 from pywps.inout.inputs import ComplexInput, LiteralInput, BoundingBoxInput
+from pywps.inout.basic import SOURCE_TYPE
+from pywps.inout.fetch import ReferenceFetcher, openurl, download
+from pywps.inout.cache import get_input_cache
 from pywps.dblog import log_request, update_response
 
 from collections import deque, OrderedDict
 import os
 import sys
 import uuid
-import copy
 
 LOGGER = logging.getLogger("PYWPS")
 
+# number of cached DescribeProcess documents
+DESCRIBE_CACHE_SIZE = 100
+
 
 class Service(object):
 
@@ -44,6 +53,12 @@ class Service(object):
     def __init__(self, processes=[], cfgfiles=None):
         # ordered dict of processes
         self.processes = OrderedDict((p.identifier, p) for p in processes)
+        for process in processes:
+            register_process(process)
+        self._capabilities = None
+        self._descriptions = {}
+        self._descriptions_envelope = None
+        self._describe_documents = OrderedDict()
 
         if cfgfiles:
             config.load_configuration(cfgfiles)
@@ -56,7 +71,33 @@ class Service(object):
         else:  # NullHandler
             LOGGER.addHandler(logging.NullHandler())
 
-    def get_capabilities(self):
+    def _processes_key(self):
+        """Return value identifying the current set of processes
+        """
+
+        return tuple((identifier, id(process)) for (identifier, process) in self.processes.items())
+
+    def get_capabilities(self, http_request=None):
+        """Return GetCapabilities response
+
+        The serialized document is cached and rebuilt only, when the set of
+        processes or the configuration changes.
+
+        :param http_request: werkzeug request used for answering conditional
+            requests with 304 Not Modified
+        """
+
+        key = (config.get_config_generation(), self._processes_key())
+        if self._capabilities is None or self._capabilities.key != key:
+            LOGGER.debug('Building GetCapabilities document')
+            self._capabilities = CachedDocument(key, xml_serialize(self.capabilities_xml()))
+
+        return self._capabilities.response(http_request)
+
+    def capabilities_xml(self):
+        """Build GetCapabilities document
+        """
+
         process_elements = [p.capabilities_xml()
                             for p in self.processes.values()]
 
@@ -240,43 +281,103 @@ class Service(object):
 
         doc.append(languages_doc)
 
-        return xml_response(doc)
+        return doc
+
+    def describe(self, identifiers, http_request=None):
+        """Return DescribeProcess response
+
+        Documents of the last requested sets of processes are cached, so that
+        they are compressed only once.
+
+        :param identifiers: list of process identifiers or 'all'
+        :param http_request: werkzeug request used for answering conditional
+            requests with 304 Not Modified
+        """
 
-    def describe(self, identifiers):
         if not identifiers:
             raise MissingParameterValue('', 'identifier')
 
-        identifier_elements = []
+        processes = []
         # 'all' keyword means all processes
         if 'all' in (ident.lower() for ident in identifiers):
-            for process in self.processes:
-                try:
-                    identifier_elements.append(
-                        self.processes[process].describe_xml())
-                except Exception as e:
-                    raise NoApplicableCode(e)
+            processes = list(self.processes.values())
         else:
             for identifier in identifiers:
                 try:
-                    process = self.processes[identifier]
+                    processes.append(self.processes[identifier])
                 except KeyError:
                     raise InvalidParameterValue(
                         "Unknown process %r" % identifier, "identifier")
-                else:
-                    try:
-                        identifier_elements.append(process.describe_xml())
-                    except Exception as e:
-                        raise NoApplicableCode(e)
 
-        doc = WPS.ProcessDescriptions(
-            *identifier_elements
-        )
+        key = (config.get_config_generation(), tuple((p.identifier, id(p)) for p in processes))
+        document = self._describe_documents.pop(key[1], None)
+        if document is None or document.key != key:
+            fragments = []
+            for process in processes:
+                try:
+                    fragments.append(self._describe_fragment(process))
+                except Exception as e:
+                    raise NoApplicableCode(e)
+
+            (head, tail) = self._describe_envelope()
+            if fragments:
+                # whitespace before each child element
+                separator = head[len(head.rstrip()):]
+                document = CachedDocument(key, head + separator.join(fragments) + tail)
+            else:
+                document = CachedDocument(key, xml_serialize(self._describe_root()))
+        self._describe_documents[key[1]] = document
+        while len(self._describe_documents) > DESCRIBE_CACHE_SIZE:
+            self._describe_documents.popitem(last=False)
+
+        return document.response(http_request)
+
+    def _describe_fragment(self, process):
+        """Return serialized ProcessDescription element of given process
+
+        The serialized element is cached, the cache entry is replaced as soon
+        as another process is registered under the same identifier or the
+        configuration changes.
+        """
+
+        generation = config.get_config_generation()
+        cached = self._descriptions.get(process.identifier)
+        if cached is None or cached[0] is not process or cached[2] != generation:
+            LOGGER.debug('Building ProcessDescription of %s', process.identifier)
+            # serialize within the document, so that namespace declarations
+            # and indentation are the same as in the complete document
+            doc = self._describe_root()
+            doc.append(process.describe_xml())
+            xml = xml_serialize(doc)
+            (head, tail) = self._describe_envelope()
+            fragment = xml[len(head):len(xml) - len(tail)]
+            cached = (process, fragment, generation)
+            self._descriptions[process.identifier] = cached
+
+        return cached[1]
+
+    def _describe_envelope(self):
+        """Return serialized ProcessDescriptions document without content
+        """
+
+        generation = config.get_config_generation()
+        if self._descriptions_envelope is None or self._descriptions_envelope[0] != generation:
+            self._descriptions_envelope = (generation, xml_envelope(self._describe_root()))
+
+        return self._descriptions_envelope[1]
+
+    @staticmethod
+    def _describe_root():
+        """Return empty ProcessDescriptions element
+        """
+
+        doc = WPS.ProcessDescriptions()
         doc.attrib['{http://www.w3.org/2001/XMLSchema-instance}schemaLocation'] = \
             'http://www.opengis.net/wps/1.0.0 http://schemas.opengis.net/wps/1.0.0/wpsDescribeProcess_response.xsd'
         doc.attrib['service'] = 'WPS'
         doc.attrib['version'] = '1.0.0'
         doc.attrib['{http://www.w3.org/XML/1998/namespace}lang'] = 'en-US'
-        return xml_response(doc)
+        return doc
 
     def execute(self, identifier, wps_request, uuid):
         """Parse and perform Execute WPS request call
@@ -286,32 +387,115 @@ class Service(object):
         :param uuid: string identifier of the request
         """
         self._set_grass()
-        response = None
+        if getattr(wps_request, 'batch', None) is not None:
+            return self._execute_batch(identifier, wps_request, uuid)
         try:
             process = self.processes[identifier]
 
-            # make deep copy of the process instace
-            # so that processes are not overriding each other
-            # just for execute
-            process = copy.deepcopy(process)
+            # get own instance of the process for this request,
+            # so that requests are not overriding each other
+            process = process.new_instance()
+            process.set_workdir(get_workdir_manager().create('pywps_process_', uuid))
+        except KeyError:
+            raise InvalidParameterValue("Unknown process '%r'" % identifier, 'Identifier')
+
+        # the current working directory is not changed, it is shared by all
+        # threads of the server - relative file names are resolved against
+        # process.workdir instead
+        return self._parse_and_execute(process, wps_request, uuid)
 
-            workdir = os.path.abspath(config.get_config_value('server', 'workdir'))
-            tempdir = tempfile.mkdtemp(prefix='pywps_process_', dir=workdir)
-            process.set_workdir(tempdir)
+    def _parse_and_execute(self, process, wps_request, uuid):
+        """Parse and execute request
+        """
+        fetcher = ReferenceFetcher()
+        self._parse_inputs(process, wps_request, fetcher)
+
+        # download all reference inputs at once
+        fetcher.fetch()
+
+        # catch error generated by process code
+        try:
+            wps_response = process.execute(wps_request, uuid)
+        except Exception as e:
+            if not isinstance(e, NoApplicableCode):
+                raise NoApplicableCode('Service error: %s' % e)
+            raise e
+
+        # get the specified output as raw
+        if wps_request.raw:
+            for outpt in wps_request.outputs:
+                for proc_outpt in process.outputs:
+                    if outpt == proc_outpt.identifier:
+                        try:
+                            resp = _raw_response(proc_outpt, wps_request.http_request)
+                        except Exception:
+                            process.clean()
+                            raise
+                        resp.call_on_close(process.clean)
+                        return resp
+
+            # if the specified identifier was not found raise error
+            raise InvalidParameterValue('')
+
+        return wps_response
+
+    def _execute_batch(self, identifier, wps_request, uuid):
+        """Execute the process for each input set of the batch request
+
+        The batch runs synchronously in one slot of `parallelprocesses` and
+        is logged as one request. The response contains an ExecuteResponse
+        document for each input set, in the order of the input sets.
+        """
+
+        try:
+            prototype = self.processes[identifier]
         except KeyError:
             raise InvalidParameterValue("Unknown process '%r'" % identifier, 'Identifier')
 
-        olddir = os.path.abspath(os.curdir)
+        if wps_request.raw or wps_request.store_execute == 'true':
+            raise InvalidParameterValue(
+                'Batch execution supports only synchronous response documents', 'DataInputs')
+        maxbatchsize = int(config.get_config_value('server', 'maxbatchsize'))
+        if len(wps_request.batch) > maxbatchsize:
+            raise InvalidParameterValue(
+                'Number of input sets exceeds the maximum batch size %i' % maxbatchsize, 'DataInputs')
+
+        batch_workdir = get_workdir_manager().create('pywps_batch_', uuid)
         try:
-            os.chdir(process.workdir)
-            response = self._parse_and_execute(process, wps_request, uuid)
+            processes = []
+            wps_requests = []
+            fetcher = ReferenceFetcher()
+            for (index, inputs) in enumerate(wps_request.batch):
+                process = prototype.new_instance()
+                # own working directory also for the batch handler, outputs
+                # of the input sets must not overwrite each other
+                process.set_workdir(os.path.join(batch_workdir, str(index)))
+                item_request = copy.copy(wps_request)
+                item_request.inputs = inputs
+                item_request.batch = None
+                self._parse_inputs(process, item_request, fetcher)
+                processes.append(process)
+                wps_requests.append(item_request)
+            fetcher.fetch()
+
+            try:
+                wps_responses = prototype.execute_batch(processes, wps_requests, uuid)
+            except Exception as e:
+                if not isinstance(e, NoApplicableCode):
+                    raise NoApplicableCode('Service error: %s' % e)
+                raise e
+            # outputs by reference are stored while the documents are built
+            doc = E.BatchExecuteResponse(*[wps_response._construct_doc() for wps_response in wps_responses])
         finally:
-            os.chdir(olddir)
+            get_workdir_manager().remove(batch_workdir)
+        return xml_response(doc)
 
-        return response
+    def _parse_inputs(self, process, wps_request, fetcher):
+        """Replace the input dicts of the request with inputs of the process
+        and set the outputs requested as reference
 
-    def _parse_and_execute(self, process, wps_request, uuid):
-        """Parse and execute request
+        :param fetcher: :class:`pywps.inout.fetch.ReferenceFetcher` collecting
+            the downloads of reference inputs
         """
         LOGGER.debug('Checking if datainputs is required and has been passed')
         if process.inputs:
@@ -336,7 +520,7 @@ class Service(object):
                 # set the input to the type defined in the process.
                 if isinstance(inpt, ComplexInput):
                     data_inputs[inpt.identifier] = self.create_complex_inputs(
-                        inpt, wps_request.inputs[inpt.identifier])
+                        inpt, wps_request.inputs[inpt.identifier], fetcher)
                 elif isinstance(inpt, LiteralInput):
                     data_inputs[inpt.identifier] = self.create_literal_inputs(
                         inpt, wps_request.inputs[inpt.identifier])
@@ -367,31 +551,11 @@ class Service(object):
                     if outpt.identifier == wps_outpt:
                         outpt.as_reference = is_reference
 
-        # catch error generated by process code
-        try:
-            wps_response = process.execute(wps_request, uuid)
-        except Exception as e:
-            if not isinstance(e, NoApplicableCode):
-                raise NoApplicableCode('Service error: %s' % e)
-            raise e
-
-        # get the specified output as raw
-        if wps_request.raw:
-            for outpt in wps_request.outputs:
-                for proc_outpt in process.outputs:
-                    if outpt == proc_outpt.identifier:
-                        resp = Response(proc_outpt.data)
-                        resp.call_on_close(process.clean)
-                        return resp
-
-            # if the specified identifier was not found raise error
-            raise InvalidParameterValue('')
-
-        return wps_response
-
-    def _get_complex_input_handler(self, href):
+    def _get_complex_input_handler(self, href, fetcher=None):
         """Return function for parsing and storing complexdata
         :param href: href object yes or not
+        :param fetcher: :class:`pywps.inout.fetch.ReferenceFetcher` collecting
+            the downloads, if not given, reference is downloaded immediately
         """
 
         def href_handler(complexinput, datain):
@@ -401,32 +565,32 @@ class Service(object):
                 href=datain.get('href'),
                 workdir=complexinput.workdir,
                 extension=_extension(complexinput))
+            # reserve the name, other inputs may be fetched concurrently
+            open(tmp_file, 'wb').close()
 
-            try:
-                (reference_file, reference_file_data) = _openurl(datain)
-                data_size = reference_file.headers.get('Content-Length', 0)
-            except Exception as e:
-                raise NoApplicableCode('File reference error: %s' % e)
+            if fetcher is None:
+                fetch_reference(complexinput, datain, tmp_file)
+            else:
+                fetcher.add(datain.get('href'), fetch_reference, complexinput, datain, tmp_file)
 
-            # if the response did not return a 'Content-Length' header then
-            # calculate the size
-            if data_size == 0:
-                LOGGER.debug('no Content-Length, calculating size')
-                data_size = _get_datasize(reference_file_data)
+        def fetch_reference(complexinput, datain, tmp_file):
+            """Download the reference to tmp_file"""
 
             # check if input file size was not exceeded
             complexinput.calculate_max_input_size()
             byte_size = complexinput.max_size * 1024 * 1024
-            if int(data_size) > int(byte_size):
+            cache = get_input_cache()
+            try:
+                if cache is None:
+                    download(openurl(datain), tmp_file, byte_size)
+                else:
+                    cache.fetch(datain, tmp_file, byte_size)
+            except FileSizeExceeded:
                 raise FileSizeExceeded('File size for input exceeded.'
                                        ' Maximum allowed: %i megabytes' %
                                        complexinput.max_size, complexinput.identifier)
-
-            try:
-                with open(tmp_file, 'w') as f:
-                    f.write(reference_file_data)
             except Exception as e:
-                raise NoApplicableCode(e)
+                raise NoApplicableCode('File reference error: %s' % e, complexinput.identifier)
 
             complexinput.file = tmp_file
             complexinput.url = datain.get('href')
@@ -464,9 +628,11 @@ class Service(object):
         else:
             return data_handler
 
-    def create_complex_inputs(self, source, inputs):
+    def create_complex_inputs(self, source, inputs, fetcher=None):
         """Create new ComplexInput as clone of original ComplexInput
         because of inputs can be more then one, take it just as Prototype
+        :param fetcher: optional :class:`pywps.inout.fetch.ReferenceFetcher`,
+            reference inputs are downloaded when it is fetched
         :return collections.deque:
         """
 
@@ -494,7 +660,7 @@ class Service(object):
             # get the referenced input otherwise get the value of the field
             href = inpt.get('href', None)
 
-            complex_data_handler = self._get_complex_input_handler(href)
+            complex_data_handler = self._get_complex_input_handler(href, fetcher)
             complex_data_handler(data_input, inpt)
 
             outinputs.append(data_input)
@@ -580,6 +746,17 @@ class Service(object):
 
     @Request.application
     def __call__(self, http_request):
+        return self.call(http_request)
+
+    def call(self, http_request):
+        """Handle the request and return the response
+
+        Used by the WSGI application as well as by
+        :class:`pywps.app.asgi.AsyncService`.
+
+        :param http_request: werkzeug request
+        :return: response or :class:`pywps.exceptions.NoApplicableCode`
+        """
 
         request_uuid = uuid.uuid1()
 
@@ -597,10 +774,10 @@ class Service(object):
                 log_request(request_uuid, wps_request)
                 response = None
                 if wps_request.operation == 'getcapabilities':
-                    response = self.get_capabilities()
+                    response = self.get_capabilities(http_request)
 
                 elif wps_request.operation == 'describeprocess':
-                    response = self.describe(wps_request.identifiers)
+                    response = self.describe(wps_request.identifiers, http_request)
 
                 elif wps_request.operation == 'execute':
                     response = self.execute(
@@ -609,7 +786,7 @@ class Service(object):
                         request_uuid
                     )
                 update_response(request_uuid, response, close=True)
-                return response
+                return compress_response(response, http_request)
             else:
                 update_response(request_uuid, response, close=True)
                 raise RuntimeError("Unknown operation %r"
@@ -634,50 +811,23 @@ class Service(object):
             return e
 
 
-def _openurl(inpt):
-    """use urllib to open given href
-    """
-    data = None
-    reference_file = None
-    href = inpt.get('href')
-
-    LOGGER.debug('Fetching URL %s', href)
-    if inpt.get('method') == 'POST':
-        if 'body' in inpt:
-            data = inpt.get('body')
-        elif 'bodyreference' in inpt:
-            data = urlopen(url=inpt.get('bodyreference')).read()
+def _raw_response(output, http_request=None):
+    """Return response with the raw content of the output
 
-        reference_file = urlopen(url=href, data=data)
-    else:
-        reference_file = urlopen(url=href)
-
-    if PY2:
-        reference_file_data = reference_file.read()
-    else:
-        reference_file_data = reference_file.read().decode('utf-8')
-
-    return (reference_file, reference_file_data)
-
-
-def _get_datasize(reference_file_data):
-
-    tmp_sio = None
-    data_size = 0
-
-    if PY2:
-        from StringIO import StringIO
+    Files are streamed from the disk, other data are sent from memory.
+    """
 
-        tmp_sio = StringIO(reference_file_data)
-        data_size = tmp_sio.len
-    else:
-        from io import StringIO
+    content_type = 'text/plain'
+    data_format = getattr(output, 'data_format', None)
+    if data_format and data_format.mime_type:
+        content_type = data_format.mime_type
 
-        tmp_sio = StringIO()
-        data_size = tmp_sio.write(reference_file_data)
-    tmp_sio.close()
+    if output.source_type == SOURCE_TYPE.FILE:
+        return file_response(output.file, content_type, http_request)
 
-    return data_size
+    response = Response(output.data, content_type=content_type)
+    response.status_percentage = 100
+    return response
 
 
 def _build_input_file_name(href, workdir, extension=None):
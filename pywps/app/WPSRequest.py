@@ -43,6 +43,10 @@ class WPSRequest(object):
         self.inputs = None
         self.outputs = None
         self.raw = None
+        # encoding of the ExecuteResponse and the status, 'xml' or 'json'
+        self.response_format = 'xml'
+        # list of input sets of a batch execution, see Service.execute
+        self.batch = None
 
         if self.http_request:
             request_parser = self._get_request_parser_method(http_request.method)
@@ -137,8 +141,13 @@ class WPSRequest(object):
             wpsrequest.status = _get_get_param(http_request, 'status', 'false')
             wpsrequest.lineage = _get_get_param(
                 http_request, 'lineage', 'false')
+            wpsrequest.response_format = _get_response_format(http_request)
+            data_inputs = _get_get_params(http_request, 'DataInputs')
             wpsrequest.inputs = get_data_from_kvp(
-                _get_get_param(http_request, 'DataInputs'), 'DataInputs')
+                data_inputs[0] if data_inputs else None, 'DataInputs')
+            if len(data_inputs) > 1:
+                # repeated DataInputs parameter, one input set each
+                wpsrequest.batch = [get_data_from_kvp(d, 'DataInputs') for d in data_inputs]
             wpsrequest.outputs = {}
 
             # take responseDocument preferably
@@ -223,7 +232,13 @@ class WPSRequest(object):
             wpsrequest.lineage = 'false'
             wpsrequest.store_execute = 'false'
             wpsrequest.status = 'false'
+            wpsrequest.response_format = _get_response_format(wpsrequest.http_request)
             wpsrequest.inputs = get_inputs_from_xml(doc)
+            data_inputs = xpath_ns(doc, './wps:DataInputs')
+            if len(data_inputs) > 1:
+                # several DataInputs elements, one input set each
+                wpsrequest.batch = [get_inputs_from_xml(el) for el in data_inputs]
+                wpsrequest.inputs = wpsrequest.batch[0]
             wpsrequest.outputs = get_output_from_xml(doc)
             wpsrequest.raw = False
             if xpath_ns(doc, '/wps:Execute/wps:ResponseForm/wps:RawDataOutput'):
@@ -322,7 +337,8 @@ class WPSRequest(object):
             'lineage': self.lineage,
             'inputs': dict((i, [inpt.json for inpt in self.inputs[i]]) for i in self.inputs),
             'outputs': self.outputs,
-            'raw': self.raw
+            'raw': self.raw,
+            'response_format': self.response_format
         }
 
         return json.dumps(obj, allow_nan=False, cls=ExtendedJSONEncoder)
@@ -343,6 +359,7 @@ class WPSRequest(object):
         self.lineage = value['lineage']
         self.outputs = value['outputs']
         self.raw = value['raw']
+        self.response_format = value.get('response_format', 'xml')
         self.inputs = {}
 
         for identifier in value['inputs']:
@@ -427,8 +444,14 @@ class WPSRequest(object):
 
 
 def get_inputs_from_xml(doc):
+    """Get execute DataInputs from the Execute document or a DataInputs element
+    """
     the_inputs = {}
-    for input_el in xpath_ns(doc, '/wps:Execute/wps:DataInputs/wps:Input'):
+    if doc.tag == WPS.DataInputs().tag:
+        input_els = xpath_ns(doc, './wps:Input')
+    else:
+        input_els = xpath_ns(doc, '/wps:Execute/wps:DataInputs/wps:Input')
+    for input_el in input_els:
         [identifier_el] = xpath_ns(input_el, './ows:Identifier')
         identifier = identifier_el.text
 
@@ -601,6 +624,42 @@ def _get_get_param(http_request, key, default=None, aslist=False):
     return value
 
 
+def _get_response_format(http_request):
+    """Return encoding of the ExecuteResponse requested by the
+    ResponseFormat parameter or, without it, the Accept header
+
+    :param http_request: http_request object
+    :return: 'xml' or 'json'
+    """
+
+    response_format = _get_get_param(http_request, 'ResponseFormat')
+    if response_format:
+        if response_format.lower() not in ('xml', 'json'):
+            raise InvalidParameterValue(
+                'The requested response format "%s" is not supported' % response_format, 'ResponseFormat')
+        return response_format.lower()
+
+    if http_request.accept_mimetypes.best_match(['text/xml', 'application/json']) == 'application/json':
+        return 'json'
+    return 'xml'
+
+
+def _get_get_params(http_request, key):
+    """Returns all values of the key in the HTTP GET request, which may be
+    repeated
+
+    :param http_request: http_request object
+    :param key: key value you need to dig out of the HTTP GET request
+    """
+
+    key = key.lower()
+    values = []
+    for k in http_request.args.keys():
+        if k.lower() == key:
+            values.extend(http_request.args.getlist(k))
+    return values
+
+
 def _get_dataelement_value(value_el):
     """Return real value of XML Element (e.g. convert Element.FeatureCollection
     to String
@@ -5,14 +5,18 @@
 ##################################################################
 
 
+import json
 import logging
 import os
+import tempfile
+import threading
 from lxml import etree
 import time
-from werkzeug.wrappers import Request
 from werkzeug.exceptions import HTTPException
+from werkzeug.wrappers import Request, Response
 from pywps import WPS, OWS
-from pywps.app.basic import xml_response
+from pywps._compat import text_type
+from pywps.app.basic import xml_envelope, pretty_print, compress_response
 from pywps.exceptions import NoApplicableCode
 import pywps.configuration as config
 from pywps.dblog import update_response
@@ -25,6 +29,11 @@ STATUS = _STATUS(0, 10, 20, 30, 40)
 
 LOGGER = logging.getLogger("PYWPS")
 
+# rename replacing existing file, also on Windows
+_replace = getattr(os, 'replace', os.rename)
+
+_PROCESS_OUTPUTS = WPS.ProcessOutputs().tag
+
 
 class WPSResponse(object):
 
@@ -44,49 +53,144 @@ class WPSResponse(object):
         self.status_percentage = 0
         self.doc = None
         self.uuid = uuid
+        # coalescing of status updates
+        self._status_lock = threading.RLock()
+        self._flushed_state = None
+        self._flushed_time = 0
+        self._pending = False
+        self._timer = None
+        # serialized ExecuteResponse and Process elements of the status
+        self._envelope = None
+
+    @property
+    def workdir(self):
+        """Working directory of this request
+
+        Handlers shall store their files here, relative file names of the
+        outputs are resolved against this directory.
+        """
+        return self.process.workdir
 
     def update_status(self, message=None, status_percentage=None, status=None,
                       clean=True):
         """
         Update status report of currently running process instance
 
+        Progress updates are coalesced: the status document and the database
+        are updated at most once per `statusupdateinterval` seconds with the
+        latest message and percentage. Changes of the status and final states
+        are written immediately.
+
         :param str message: Message you need to share with the client
         :param int status_percentage: Percent done (number betwen <0-100>)
         :param pywps.app.WPSResponse.STATUS status: process status - user should usually
             ommit this parameter
         """
 
-        if message:
-            self.message = message
+        with self._status_lock:
+            if message:
+                self.message = message
+
+            if status:
+                self.status = status
+
+            if status_percentage:
+                self.status_percentage = status_percentage
+
+            interval = float(config.get_config_value('server', 'statusupdateinterval'))
+            elapsed = time.time() - self._flushed_time
+            if self._get_state() == self._flushed_state and not self._is_final() and elapsed < interval:
+                self._pending = True
+                if self._timer is None:
+                    self._timer = threading.Timer(interval - elapsed, self._flush_pending)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+
+            self._flush(clean)
+
+    def _get_state(self):
+        """Return the part of the status, which changes are written
+        immediately
+        """
+
+        return (self.status, self.status_percentage == 0, self.status_percentage == -1)
+
+    def _is_final(self):
+        return self.status >= STATUS.DONE_STATUS or self.status_percentage == -1
 
-        if status:
-            self.status = status
+    def _flush(self, clean=True):
+        """Write the status document and update the database
+        """
 
-        if status_percentage:
-            self.status_percentage = status_percentage
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._pending = False
+        self._flushed_state = self._get_state()
+        self._flushed_time = time.time()
 
         # check if storing of the status is requested
         if self.status >= STATUS.STORE_AND_UPDATE_STATUS:
 
-            # rebuild the doc and update the status xml file
-            self.doc = self._construct_doc()
-            self.write_response_doc(self.doc, clean)
+            # update the status file
+            if self.wps_request.response_format == 'json':
+                self.write_response_doc(self._serialize_json(), clean)
+            else:
+                self.write_response_doc(self._serialize(), clean)
 
         update_response(self.uuid, self)
 
+    def _flush_pending(self):
+        """Write the coalesced updates
+        """
+
+        with self._status_lock:
+            self._timer = None
+            if not self._pending:
+                return
+            try:
+                self._flush()
+            except Exception as e:
+                LOGGER.error('Status update of request %s failed: %s', self.uuid, e)
+
     def write_response_doc(self, doc, clean=True):
-        # TODO: check if file/directory is still present, maybe deleted in mean time
+        """Replace the status document
+
+        The document is written to a temporary file, which is then renamed,
+        so that clients never read a partially written document.
+
+        :param doc: the document, its serialized bytes or an iterator of
+            serialized chunks
+        """
+
+        if isinstance(doc, bytes):
+            doc = [doc]
+        elif etree.iselement(doc):
+            doc = [etree.tostring(doc, pretty_print=pretty_print(), encoding='utf-8')]
 
         try:
-            with open(self.process.status_location, 'w') as f:
-                f.write(etree.tostring(doc, pretty_print=True, encoding='utf-8').decode('utf-8'))
-                f.flush()
-                os.fsync(f.fileno())
+            (directory, name) = os.path.split(self.process.status_location)
+            (fd, tmp_name) = tempfile.mkstemp(prefix='.{}.'.format(name), dir=directory)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in doc:
+                        f.write(chunk)
+                    # progress may be lost on a crash, final states not
+                    if self._is_final():
+                        f.flush()
+                        os.fsync(f.fileno())
+                os.chmod(tmp_name, 0o644)
+                _replace(tmp_name, self.process.status_location)
+            except Exception:
+                if os.path.exists(tmp_name):
+                    os.remove(tmp_name)
+                raise
 
             if self.status >= STATUS.DONE_STATUS and clean:
                 self.process.clean()
 
-        except IOError as e:
+        except (IOError, OSError) as e:
             raise NoApplicableCode('Writing Response Document failed with : %s' % e)
 
     def _process_accepted(self):
@@ -134,6 +238,50 @@ class WPSResponse(object):
         )
 
     def _construct_doc(self):
+        doc = self._construct_envelope()
+        for element in self._construct_content():
+            doc.append(element)
+        return doc
+
+    def _serialize(self):
+        """Return iterator of the serialized document
+
+        The ExecuteResponse and Process elements are serialized once and
+        cached. The rest of the document is serialized right away, so that
+        errors are raised before the response is sent, only the payload of
+        inline complex outputs is read from their files in chunks, while the
+        iterator is consumed.
+        """
+
+        if self._envelope is None:
+            self._envelope = xml_envelope(self._construct_envelope())
+        (head, tail) = self._envelope
+        pretty = pretty_print()
+
+        parts = [head]
+        for element in self._construct_content(outputs=False):
+            if element.tag != _PROCESS_OUTPUTS:
+                parts.append(etree.tostring(element, pretty_print=pretty))
+                continue
+            (outputs_head, outputs_tail) = xml_envelope(element, comment=False)
+            parts.append(outputs_head)
+            for outpt in self.outputs.values():
+                if hasattr(outpt, 'execute_xml_chunks'):
+                    chunks = outpt.execute_xml_chunks(pretty)
+                    # the first chunk is the output up to the payload
+                    parts.append(next(chunks))
+                    parts.append(chunks)
+                else:
+                    parts.append(etree.tostring(outpt.execute_xml(), pretty_print=pretty))
+            parts.append(outputs_tail)
+        parts.append(tail)
+        return _iter_parts(parts)
+
+    def _construct_envelope(self):
+        """Return the ExecuteResponse element with the Process element,
+        which do not change while the process is running
+        """
+
         doc = WPS.ExecuteResponse()
         doc.attrib['{http://www.w3.org/2001/XMLSchema-instance}schemaLocation'] = \
             'http://www.opengis.net/wps/1.0.0 http://schemas.opengis.net/wps/1.0.0/wpsExecute_response.xsd'
@@ -164,31 +312,33 @@ class WPSResponse(object):
         process_doc.attrib['{http://www.opengis.net/wps/1.0.0}processVersion'] = self.process.version
 
         doc.append(process_doc)
+        return doc
+
+    def _construct_content(self, outputs=True):
+        """Return the Status element and, when the process succeeded, the
+        lineage and the ProcessOutputs elements
+
+        :param outputs: False to return empty ProcessOutputs element
+        """
 
         # Status XML
         # return the correct response depending on the progress of the process
         if self.status == STATUS.STORE_AND_UPDATE_STATUS:
             if self.status_percentage == 0:
                 self.message = 'PyWPS Process %s accepted' % self.process.identifier
-                status_doc = self._process_accepted()
-                doc.append(status_doc)
-                return doc
+                return [self._process_accepted()]
             elif self.status_percentage > 0:
-                status_doc = self._process_started()
-                doc.append(status_doc)
-                return doc
+                return [self._process_started()]
 
         # check if process failed and display fail message
         if self.status_percentage == -1:
-            status_doc = self._process_failed()
-            doc.append(status_doc)
-            return doc
+            return [self._process_failed()]
 
         # TODO: add paused status
 
+        content = []
         if self.status == STATUS.DONE_STATUS:
-            status_doc = self._process_succeeded()
-            doc.append(status_doc)
+            content.append(self._process_succeeded())
 
             # DataInputs and DataOutputs definition XML if lineage=true
             if self.wps_request.lineage == 'true':
@@ -196,18 +346,59 @@ class WPSResponse(object):
                     # TODO: stored process has ``pywps.inout.basic.LiteralInput``
                     # instead of a ``pywps.inout.inputs.LiteralInput``.
                     data_inputs = [self.wps_request.inputs[i][0].execute_xml() for i in self.wps_request.inputs]
-                    doc.append(WPS.DataInputs(*data_inputs))
+                    content.append(WPS.DataInputs(*data_inputs))
                 except Exception as e:
                     LOGGER.error("Failed to update lineage for input parameter. %s", e)
 
                 output_definitions = [self.outputs[o].execute_xml_lineage() for o in self.outputs]
-                doc.append(WPS.OutputDefinitions(*output_definitions))
+                content.append(WPS.OutputDefinitions(*output_definitions))
 
             # Process outputs XML
-            output_elements = [self.outputs[o].execute_xml() for o in self.outputs]
-            doc.append(WPS.ProcessOutputs(*output_elements))
+            output_elements = [self.outputs[o].execute_xml() for o in self.outputs] if outputs else []
+            content.append(WPS.ProcessOutputs(*output_elements))
+        return content
+
+    def _construct_json(self):
+        """Return the response document as dict, which is encoded as JSON
+        instead of the ExecuteResponse XML
+
+        The status has the same states as in the XML document, the outputs
+        are rendered by their `execute_json` method. Lineage is not included.
+        """
+
+        doc = {
+            'process': {
+                'identifier': self.process.identifier,
+                'title': self.process.title,
+                'version': self.process.version
+            },
+            'uuid': str(self.uuid),
+            'creation_time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.localtime()),
+            'status': None,
+            'message': self.message,
+            'percent_completed': None
+        }
+        if self.status >= STATUS.STORE_STATUS and self.process.status_location:
+            doc['status_location'] = self.process.status_url
+
+        if self.status == STATUS.STORE_AND_UPDATE_STATUS and self.status_percentage == 0:
+            self.message = 'PyWPS Process %s accepted' % self.process.identifier
+            doc.update(status='accepted', message=self.message)
+        elif self.status == STATUS.STORE_AND_UPDATE_STATUS and self.status_percentage > 0:
+            doc.update(status='started', percent_completed=self.status_percentage)
+        elif self.status_percentage == -1:
+            doc['status'] = 'failed'
+        elif self.status == STATUS.DONE_STATUS:
+            doc.update(status='succeeded', percent_completed=100)
+            doc['outputs'] = [self.outputs[o].execute_json() for o in self.outputs]
         return doc
 
+    def _serialize_json(self):
+        """Return the JSON encoded response document as bytes
+        """
+
+        return json.dumps(self._construct_json(), default=_json_default).encode('utf-8')
+
     def call_on_close(self, function):
         """Custom implementation of call_on_close of werkzeug
         TODO: rewrite this using werkzeug's tools
@@ -216,15 +407,55 @@ class WPSResponse(object):
 
     @Request.application
     def __call__(self, request):
-        doc = None
         try:
-            doc = self._construct_doc()
+            if self.wps_request.response_format == 'json':
+                response = Response(self._serialize_json(), content_type='application/json')
+            else:
+                response = Response(self._send_chunks(self._serialize()), content_type='text/xml')
         except HTTPException as httpexp:
             raise httpexp
         except Exception as exp:
             raise NoApplicableCode(exp)
 
+        response.status_percentage = 100
         if self.status >= STATUS.DONE_STATUS:
-            self.process.clean()
+            # outputs are read while the response is sent
+            response.call_on_close(self.process.clean)
+        return compress_response(response, request)
+
+    def _send_chunks(self, chunks):
+        """Pass the chunks of the response through
+
+        An error after the headers were sent is logged and raised again, so
+        that the server aborts the connection instead of finishing the
+        truncated document.
+        """
+
+        try:
+            for chunk in chunks:
+                yield chunk
+        except Exception as e:
+            LOGGER.error('Sending response of request %s failed: %s', self.uuid, e)
+            raise
+
+
+def _iter_parts(parts):
+    """Return iterator of the chunks of serialized parts, which are bytes
+    or iterators of bytes
+    """
+
+    for part in parts:
+        if isinstance(part, bytes):
+            yield part
+        else:
+            for chunk in part:
+                yield chunk
+
+
+def _json_default(obj):
+    """Encode values of literal outputs, which are not JSON types
+    """
 
-        return xml_response(doc)
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    return text_type(obj)
@@ -0,0 +1,210 @@
+##################################################################
+# Copyright 2016 OSGeo Foundation,                               #
+# represented by PyWPS Project Steering Committee,               #
+# licensed under MIT, Please consult LICENSE.txt for details     #
+##################################################################
+
+"""
+Creation and deferred removal of working directories of requests
+"""
+
+import errno
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid as _uuid
+
+import pywps.configuration as config
+from pywps import dblog
+from pywps._compat import queue
+
+LOGGER = logging.getLogger('PYWPS')
+
+# directories in workdir
+TRASH = '.pywps_trash'
+POOL_PREFIX = '.pywps_pool_'
+# working directories of requests, named <prefix><uuid>_<random>
+PREFIXES = ('pywps_process_', 'pywps_batch_')
+# length of <random>
+SUFFIX_LENGTH = 8
+
+_MANAGER = None
+_MANAGER_LOCK = threading.Lock()
+
+
+def get_workdir_manager():
+    """Return the :class:`WorkdirManager` of this operating system process
+    """
+
+    global _MANAGER
+
+    path = os.path.abspath(config.get_config_value('server', 'workdir'))
+    with _MANAGER_LOCK:
+        if _MANAGER is None or _MANAGER.pid != os.getpid() or _MANAGER.path != path:
+            _MANAGER = WorkdirManager(
+                path,
+                int(config.get_config_value('server', 'workdirpoolsize')),
+                float(config.get_config_value('server', 'workdirmaxage')),
+                float(config.get_config_value('server', 'workdircleanupinterval'))
+            )
+            _MANAGER.start()
+        return _MANAGER
+
+
+class WorkdirManager(threading.Thread):
+    """Thread removing working directories outside of the request path
+
+    Removed directories are renamed into a trash directory first, which is
+    fast, then deleted by this thread. The thread also keeps `pool_size`
+    empty directories ready to be taken by new requests, and every
+    `interval` seconds empties the trash (left by exited child processes) and
+    removes working directories older than `max_age` seconds, whose request
+    neither holds a slot nor waits in the queue (left by crashed processes),
+    if the database is shared with the child processes running requests.
+
+    :param path: the `workdir` directory
+    :param pool_size: number of directories created in advance
+    :param max_age: minimal age of leftover directories in seconds, 0 to
+        keep them
+    :param interval: interval of the garbage collection in seconds
+    """
+
+    def __init__(self, path, pool_size=0, max_age=0, interval=60):
+        threading.Thread.__init__(self, name='pywps-workdirs')
+        self.daemon = True
+        self.pid = os.getpid()
+        self.path = path
+        self.trash = os.path.join(path, TRASH)
+        self.pool_size = pool_size
+        self.max_age = max_age
+        self.interval = interval
+        self._queue = queue.Queue()
+        self._pool = []
+        self._lock = threading.Lock()
+        # fill the pool and collect leftovers at start
+        self._queue.put(None)
+        if not os.path.isdir(self.trash):
+            try:
+                os.makedirs(self.trash)
+            except OSError:
+                # created by another process meanwhile
+                pass
+
+    def create(self, prefix, uuid):
+        """Return new empty working directory of the request
+
+        :param prefix: one of :data:`PREFIXES`
+        :param uuid: identifier of the request
+        """
+
+        target = os.path.join(self.path, '{}{}_{}'.format(prefix, uuid, _uuid.uuid4().hex[:SUFFIX_LENGTH]))
+        with self._lock:
+            pooled = self._pool.pop() if self._pool else None
+        if pooled is not None:
+            try:
+                os.rename(pooled, target)
+                # the age of the directory is the age of the request
+                os.utime(target, None)
+                self._queue.put(None)
+                return target
+            except OSError as e:
+                LOGGER.debug('Could not take pooled directory %s: %s', pooled, e)
+        os.mkdir(target, 0o700)
+        return target
+
+    def remove(self, path):
+        """Remove the directory in the background
+        """
+
+        target = os.path.join(self.trash, '{}.{}'.format(os.path.basename(path), _uuid.uuid4().hex[:SUFFIX_LENGTH]))
+        try:
+            os.rename(path, target)
+        except OSError:
+            # other file system
+            target = path
+        self._queue.put(target)
+
+    def wait(self):
+        """Wait until the directories removed so far are deleted
+        """
+
+        self._queue.join()
+
+    def run(self):
+        next_collect = time.time()
+        while True:
+            timeout = max(next_collect - time.time(), 0)
+            try:
+                path = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                path = None
+                done = False
+            else:
+                done = True
+            try:
+                if path is not None:
+                    shutil.rmtree(path, ignore_errors=True)
+                self._fill_pool()
+                if time.time() >= next_collect:
+                    next_collect = time.time() + self.interval
+                    self.collect()
+            except Exception as e:
+                LOGGER.error('Working directory cleanup failed: %s', e)
+            finally:
+                if done:
+                    self._queue.task_done()
+
+    def _fill_pool(self):
+        while len(self._pool) < self.pool_size:
+            pooled = tempfile.mkdtemp(prefix='{}{}_'.format(POOL_PREFIX, self.pid), dir=self.path)
+            with self._lock:
+                self._pool.append(pooled)
+
+    def collect(self):
+        """Delete the trash and leftover working directories
+        """
+
+        for name in os.listdir(self.trash):
+            shutil.rmtree(os.path.join(self.trash, name), ignore_errors=True)
+
+        if not self.max_age:
+            return
+        # slots of requests running in child processes are not visible in
+        # an in-memory database, only pools of exited processes are removed
+        shared = dblog.is_shared()
+        now = time.time()
+        running = None
+        for name in os.listdir(self.path):
+            if name.startswith(POOL_PREFIX):
+                # pool of an exited process
+                pid = name[len(POOL_PREFIX):].split('_', 1)[0]
+                if pid.isdigit() and not _is_alive(int(pid)):
+                    self.remove(os.path.join(self.path, name))
+                continue
+            prefix = [p for p in PREFIXES if name.startswith(p)]
+            path = os.path.join(self.path, name)
+            if not shared or not prefix or not os.path.isdir(path):
+                continue
+            try:
+                if now - os.path.getmtime(path) < self.max_age:
+                    continue
+            except OSError:
+                continue
+            if running is None:
+                running = set(slot.uuid for slot in dblog.get_slots())
+                running.update(request.uuid for request in dblog.get_stored())
+            if name[len(prefix[0]):-SUFFIX_LENGTH - 1] in running:
+                continue
+            LOGGER.info('Removing leftover working directory %s', path)
+            self.remove(path)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
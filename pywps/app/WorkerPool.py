@@ -0,0 +1,165 @@
+##################################################################
+# Copyright 2016 OSGeo Foundation,                               #
+# represented by PyWPS Project Steering Committee,               #
+# licensed under MIT, Please consult LICENSE.txt for details     #
+##################################################################
+
+"""
+Pool of pre-started worker processes running asynchronous requests
+"""
+
+import atexit
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+import pywps.configuration as config
+from pywps._compat import reset_logging_locks
+from pywps.app import Scheduler
+
+LOGGER = logging.getLogger('PYWPS')
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_worker_pool():
+    """Return the :class:`WorkerPool` of this server process
+
+    :return: the pool or None if the `workers` configuration value is 0
+    """
+
+    global _POOL
+
+    size = int(config.get_config_value('server', 'workers'))
+    if size <= 0:
+        return None
+
+    with _POOL_LOCK:
+        if _POOL is None:
+            max_tasks = int(config.get_config_value('server', 'maxtasksperworker'))
+            _POOL = WorkerPool(size, max_tasks)
+            atexit.register(_POOL.close)
+        return _POOL
+
+
+class WorkerPool(object):
+    """Pre-forked worker processes taking asynchronous requests from a queue
+
+    Workers are forked from the server process when the first request is
+    submitted, and inherit all processes registered by
+    :func:`pywps.app.Scheduler.register_process` until then. A request is
+    passed to a worker as a small job description (process identifier, uuid,
+    working directory and the JSON encoded request), the worker runs it with
+    a new instance of its copy of the process, so the result of the `setup`
+    hook of the process is kept in the worker between requests. Workers exit
+    after `max_tasks` requests and are replaced, as are crashed workers.
+
+    :param int size: number of worker processes
+    :param int max_tasks: number of requests run by one worker before it is
+        replaced, 0 for no limit
+    """
+
+    def __init__(self, size, max_tasks=0):
+        self.size = size
+        self.max_tasks = max_tasks
+        self._jobs = multiprocessing.Queue()
+        self._workers = []
+        self._processes = None
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def submit(self, process, wps_request, wps_response):
+        """Queue the request for the next free worker
+
+        :return: False if the workers do not know the process, the request
+            has to be run otherwise
+        """
+
+        if os.getpid() == self._pid:
+            self._start()
+        known = self._processes.get(process.identifier)
+        if known is None or known.handler is not process.handler:
+            return False
+
+        LOGGER.debug('Submitting process %s to worker pool, uuid=%s', process.identifier, process.uuid)
+        self._jobs.put(Scheduler.job_description(process, wps_request, wps_response))
+        return True
+
+    def _start(self):
+        with self._lock:
+            if self._processes is not None:
+                return
+            self._processes = dict(Scheduler._PROCESSES)
+            for _ in range(self.size):
+                self._workers.append(self._start_worker())
+            supervisor = threading.Thread(target=self._supervise, name='pywps-workers')
+            supervisor.daemon = True
+            supervisor.start()
+
+    def _start_worker(self):
+        worker = multiprocessing.Process(
+            target=_work,
+            args=(self._jobs, self._processes, self.max_tasks)
+        )
+        worker.start()
+        return worker
+
+    def _supervise(self):
+        """Replace workers, which exited after max_tasks requests or crashed
+        """
+
+        while not self._closed:
+            time.sleep(0.2)
+            with self._lock:
+                if self._closed:
+                    return
+                for (index, worker) in enumerate(self._workers):
+                    if not worker.is_alive():
+                        worker.join()
+                        if worker.exitcode:
+                            LOGGER.warning('Worker %s exited with code %s', worker.pid, worker.exitcode)
+                        self._workers[index] = self._start_worker()
+
+    def close(self):
+        """Stop the workers once the queued requests are done
+        """
+
+        if os.getpid() != self._pid:
+            return
+        with self._lock:
+            self._closed = True
+            for _ in self._workers:
+                self._jobs.put(None)
+
+
+def _work(jobs, processes, max_tasks):
+    """Main loop of the worker process
+    """
+
+    reset_logging_locks()
+    done = 0
+    while not max_tasks or done < max_tasks:
+        job = jobs.get()
+        if job is None:
+            break
+        try:
+            _run_job(processes, job)
+        except Exception as e:
+            LOGGER.error('Worker could not run process %s: %s', job['identifier'], e)
+        done += 1
+
+    # release the state of the setup hooks before the worker is replaced
+    for process in processes.values():
+        process._teardown_setup()
+
+
+def _run_job(processes, job):
+    """Run the described request with a new instance of its process
+    """
+
+    (process, wps_request, wps_response) = Scheduler.restore_job(job, processes)
+    process._run_detached(wps_request, wps_response)
@@ -0,0 +1,241 @@
+##################################################################
+# Copyright 2016 OSGeo Foundation,                               #
+# represented by PyWPS Project Steering Committee,               #
+# licensed under MIT, Please consult LICENSE.txt for details     #
+##################################################################
+
+"""
+ASGI application serving a :class:`pywps.app.Service.Service`
+
+Requires Python 3.5 or newer.
+"""
+
+import asyncio
+import logging
+import mimetypes
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from werkzeug.exceptions import HTTPException, NotFound
+from werkzeug.security import safe_join
+from werkzeug.wrappers import BaseResponse, Request, Response
+
+from pywps import configuration as config
+from pywps._compat import urlparse
+from pywps.app.basic import file_response
+
+LOGGER = logging.getLogger('PYWPS')
+
+
+class AsyncService(object):
+    """ASGI application serving the processes of a :class:`Service`
+
+    Requests are parsed and answered by the same code as in the WSGI
+    application, but the event loop never blocks: request handling
+    (including downloads of reference inputs and process handlers) runs in
+    `executor`, file reads in `io_executor`. Status documents and outputs
+    stored in `outputpath` are served under the path of `outputurl` (if it is
+    an http URL) directly from `io_executor`, so a lot of status polls can be
+    answered concurrently without occupying `executor`.
+
+    Example, with uvicorn::
+
+        application = AsyncService(Service(processes, ['pywps.cfg']))
+
+        $ uvicorn pywps_asgi:application
+
+    :param service: :class:`pywps.app.Service.Service` instance
+    :param executor: :class:`concurrent.futures.Executor` running the
+        request handling, by default a new thread pool
+    :param io_executor: :class:`concurrent.futures.Executor` reading and
+        streaming files, by default a new thread pool
+    """
+
+    def __init__(self, service, executor=None, io_executor=None):
+        self.service = service
+        self._own_executors = []
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 5)
+            self._own_executors.append(executor)
+        if io_executor is None:
+            io_executor = ThreadPoolExecutor(max_workers=32)
+            self._own_executors.append(io_executor)
+        self.executor = executor
+        self.io_executor = io_executor
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope type %s' % scope['type'])
+
+        loop = asyncio.get_event_loop()
+        body = await _read_body(receive)
+        environ = _get_environ(scope, body)
+        http_request = Request(environ)
+
+        try:
+            output_file = _get_output_file(http_request)
+            if output_file is not None:
+                response = await loop.run_in_executor(
+                    self.io_executor, _output_response, output_file, http_request)
+            else:
+                response = await loop.run_in_executor(
+                    self.executor, _call_service, self.service, http_request)
+        except HTTPException as e:
+            response = e
+
+        await self._send_response(response, environ, send)
+
+    async def _send_response(self, response, environ, send):
+        """Send werkzeug response, iterating streamed content in io_executor
+        """
+
+        loop = asyncio.get_event_loop()
+        if isinstance(response, HTTPException):
+            response = response.get_response(environ)
+
+        (app_iter, status, headers) = response.get_wsgi_response(environ)
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for (name, value) in headers]
+            })
+
+            chunks = iter(app_iter)
+            while True:
+                if response.is_streamed:
+                    chunk = await loop.run_in_executor(self.io_executor, next, chunks, None)
+                else:
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(app_iter, 'close'):
+                # removes the process workdir of raw outputs
+                await loop.run_in_executor(self.io_executor, app_iter.close)
+
+    async def _lifespan(self, receive, send):
+        loop = asyncio.get_event_loop()
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await loop.run_in_executor(None, self.close)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def close(self):
+        """Wait for running requests and stop the executors created by this
+        application
+        """
+
+        for executor in self._own_executors:
+            executor.shutdown(wait=True)
+
+
+async def _read_body(receive):
+    chunks = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        more_body = message.get('more_body', False)
+    return b''.join(chunks)
+
+
+def _get_environ(scope, body):
+    """Return WSGI environment of the ASGI http request
+    """
+
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    (server_name, server_port) = scope.get('server') or ('localhost', 80)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path,
+        'PATH_INFO': path,
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+
+    for (name, value) in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    environ['CONTENT_LENGTH'] = str(len(body))
+
+    return environ
+
+
+def _call_service(service, http_request):
+    """Return werkzeug response of the service
+
+    Responses of operations (e.g. :class:`pywps.app.WPSResponse`) are WSGI
+    applications themselves, they are run to get the response, its content
+    is still read later.
+    """
+
+    response = service.call(http_request)
+    if isinstance(response, (BaseResponse, HTTPException)):
+        return response
+    return Response.from_app(response, http_request.environ)
+
+
+def _get_output_file(http_request):
+    """Return name of the file in outputpath requested under the path of
+    outputurl, None if the request is not for a stored file
+    """
+
+    if http_request.method not in ('GET', 'HEAD'):
+        return None
+
+    outputurl = urlparse(config.get_config_value('server', 'outputurl'))
+    if outputurl.scheme not in ('http', 'https'):
+        return None
+
+    prefix = outputurl.path.rstrip('/') + '/'
+    path = http_request.script_root + http_request.path
+    if not path.startswith(prefix):
+        return None
+
+    file_name = safe_join(config.get_config_value('server', 'outputpath'), path[len(prefix):])
+    if file_name is None:
+        raise NotFound()
+    return file_name
+
+
+def _output_response(file_name, http_request):
+    if not os.path.isfile(file_name):
+        raise NotFound()
+    content_type = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+    return file_response(file_name, content_type, http_request)
@@ -5,25 +5,264 @@
 ##################################################################
 
 
+import datetime
+import hashlib
 import logging
+import os
+import zlib
 import lxml
 from werkzeug.wrappers import Response
+from werkzeug.wsgi import wrap_file, FileWrapper
 from pywps import __version__, NAMESPACES
+import pywps.configuration as config
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 LOGGER = logging.getLogger('PYWPS')
 
+# smaller documents are not compressed
+MIN_COMPRESS_SIZE = 1024
+
+COMPRESSIBLE_TYPES = ('text/xml', 'application/xml', 'application/json')
+
 
 def xpath_ns(el, path):
     return el.xpath(path, namespaces=NAMESPACES)
 
 
-def xml_response(doc):
-    """XML response serializer"""
+def pretty_print():
+    """Return True, if XML documents are indented (`prettyprint`
+    configuration), False for compact documents
+    """
+
+    return config.get_config_value('server', 'prettyprint') is not False
+
+
+def xml_serialize(doc):
+    """Serialize XML document to bytes, including the PyWPS version comment"""
 
     LOGGER.debug('Serializing XML response')
     pywps_version_comment = '<!-- PyWPS %s -->\n' % __version__
-    xml = lxml.etree.tostring(doc, pretty_print=True)
-    response = Response(pywps_version_comment.encode('utf8') + xml,
-                        content_type='text/xml')
+    xml = lxml.etree.tostring(doc, pretty_print=pretty_print())
+    return pywps_version_comment.encode('utf8') + xml
+
+
+def xml_envelope(doc, comment=True):
+    """Serialize empty XML document to bytes, split before and after its
+    content, so that already serialized elements can be put in between
+
+    :param comment: False to omit the PyWPS version comment, when the
+        element is not the root of the document
+    :return: (head, tail) bytes
+    """
+
+    marker = lxml.etree.Comment('pywps-content')
+    doc.append(marker)
+    if comment:
+        xml = xml_serialize(doc)
+    else:
+        xml = lxml.etree.tostring(doc, pretty_print=pretty_print())
+    doc.remove(marker)
+    (head, tail) = xml.split(lxml.etree.tostring(marker))
+    return (head, tail)
+
+
+def xml_response(doc):
+    """XML response serializer"""
+
+    response = Response(xml_serialize(doc), content_type='text/xml')
     response.status_percentage = 100
     return response
+
+
+class _BrotliCompressor(object):
+    """brotli.Compressor with the interface of zlib compression objects"""
+
+    def __init__(self):
+        self._compressor = brotli.Compressor()
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+def _get_compressors():
+    """Return compression object factories of the encodings enabled by the
+    `compression` configuration, which are available, in order of preference
+    """
+
+    factories = {
+        'gzip': lambda: zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    }
+    if brotli is not None:
+        factories['br'] = _BrotliCompressor
+    if zstandard is not None:
+        factories['zstd'] = lambda: zstandard.ZstdCompressor().compressobj()
+
+    compressors = []
+    for encoding in (config.get_config_value('server', 'compression') or '').split(','):
+        encoding = encoding.strip().lower()
+        if encoding in factories:
+            compressors.append((encoding, factories[encoding]))
+    return compressors
+
+
+def get_content_encoding(http_request):
+    """Return the content encoding accepted by the client, which the
+    response shall be compressed with
+
+    :param http_request: werkzeug request
+    :return: encoding name (gzip, br or zstd) or None
+    """
+
+    if http_request is None:
+        return None
+    encodings = [encoding for (encoding, _) in _get_compressors()]
+    if not encodings:
+        return None
+    return http_request.accept_encodings.best_match(encodings)
+
+
+def compress(data, encoding):
+    """Compress bytes with given content encoding"""
+
+    compressor = dict(_get_compressors())[encoding]()
+    return compressor.compress(data) + compressor.flush()
+
+
+def _compress_chunks(chunks, compressor):
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def compress_response(response, http_request):
+    """Compress XML or JSON response with the encoding accepted by the client
+
+    Responses already encoded, file responses and small documents are
+    returned unchanged, streamed documents are compressed chunk by chunk.
+
+    :param response: werkzeug response
+    :param http_request: werkzeug request
+    """
+
+    if not isinstance(response, Response) or response.direct_passthrough or \
+            response.status_code != 200 or response.mimetype not in COMPRESSIBLE_TYPES or \
+            'Content-Encoding' in response.headers:
+        return response
+
+    if not _get_compressors():
+        # compression is disabled, the response does not vary
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = get_content_encoding(http_request)
+    if encoding is None:
+        return response
+
+    if response.is_sequence:
+        data = response.get_data()
+        if len(data) < MIN_COMPRESS_SIZE:
+            return response
+        response.set_data(compress(data, encoding))
+    else:
+        compressor = dict(_get_compressors())[encoding]()
+        response.response = _compress_chunks(response.response, compressor)
+        response.headers.pop('Content-Length', None)
+    response.content_encoding = encoding
+    return response
+
+
+def file_response(file_name, content_type, http_request=None):
+    """Response streaming the content of the file
+
+    The file is not read into memory, it is passed to the server's
+    `wsgi.file_wrapper` (which may use sendfile) when available. If the
+    request is given, Range requests are answered with partial content.
+
+    :param file_name: name of the file
+    :param content_type: Content-Type of the response
+    :param http_request: werkzeug request
+    """
+
+    size = os.path.getsize(file_name)
+    stream = open(file_name, 'rb')
+    try:
+        if http_request is not None:
+            body = wrap_file(http_request.environ, stream)
+        else:
+            body = FileWrapper(stream)
+        response = Response(body, content_type=content_type, direct_passthrough=True)
+        response.content_length = size
+        response.status_percentage = 100
+        if http_request is not None:
+            response.make_conditional(http_request, accept_ranges=True, complete_length=size)
+    except Exception:
+        stream.close()
+        raise
+    return response
+
+
+class CachedDocument(object):
+    """Serialized XML document, which can be served many times
+
+    :param key: value identifying the state the document was built from
+    :param content: serialized document (bytes)
+    """
+
+    def __init__(self, key, content):
+        self.key = key
+        self.content = content
+        self.etag = hashlib.md5(content).hexdigest()
+        self.last_modified = datetime.datetime.utcnow().replace(microsecond=0)
+        # compressed content by encoding
+        self._encoded = {}
+
+    def response(self, http_request=None):
+        """Return response with the cached document
+
+        The document is compressed with the encoding accepted by the client,
+        compressed documents are kept, so that each encoding is compressed
+        only once.
+
+        :param http_request: werkzeug request, if given, conditional requests
+            (If-None-Match, If-Modified-Since) are answered with
+            304 Not Modified
+        """
+
+        encoding = None
+        if len(self.content) >= MIN_COMPRESS_SIZE:
+            encoding = get_content_encoding(http_request)
+
+        if encoding is None:
+            response = Response(self.content, content_type='text/xml')
+            response.set_etag(self.etag)
+        else:
+            content = self._encoded.get(encoding)
+            if content is None:
+                content = self._encoded[encoding] = compress(self.content, encoding)
+            response = Response(content, content_type='text/xml')
+            response.content_encoding = encoding
+            response.set_etag('%s-%s' % (self.etag, encoding))
+        if _get_compressors():
+            response.vary.add('Accept-Encoding')
+        response.last_modified = self.last_modified
+        response.status_percentage = 100
+        if http_request is not None:
+            response.make_conditional(http_request)
+        return response
@@ -25,6 +25,7 @@ __author__ = "Calin Ciociu"
 RAW_OPTIONS = [('logging', 'format'), ]
 
 CONFIG = None
+_CONFIG_GENERATION = 0
 LOGGER = logging.getLogger("PYWPS")
 
 
@@ -57,6 +58,19 @@ def get_config_value(section, option):
     return value
 
 
+def get_config_generation():
+    """Get number identifying the currently loaded configuration
+
+    The number changes every time the configuration is (re)loaded, so it can
+    be used to invalidate values derived from the configuration.
+
+    :returns: configuration generation
+    :rtype: int
+    """
+
+    return _CONFIG_GENERATION
+
+
 def load_configuration(cfgfiles=None):
     """Load PyWPS configuration from configuration files.
     The later configuration file in the array overwrites configuration
@@ -66,6 +80,7 @@ def load_configuration(cfgfiles=None):
     """
 
     global CONFIG
+    global _CONFIG_GENERATION
 
     LOGGER.info('loading configuration')
     if PY2:
@@ -80,6 +95,7 @@ def load_configuration(cfgfiles=None):
     CONFIG.set('server', 'url', 'http://localhost/wps')
     CONFIG.set('server', 'maxprocesses', '30')
     CONFIG.set('server', 'maxsingleinputsize', '1mb')
+    CONFIG.set('server', 'maxbatchsize', '100')
     CONFIG.set('server', 'maxrequestsize', '3mb')
     CONFIG.set('server', 'temp_path', tempfile.gettempdir())
     CONFIG.set('server', 'processes_path', '')
@@ -87,7 +103,28 @@ def load_configuration(cfgfiles=None):
     CONFIG.set('server', 'outputurl', 'file://%s' % outputpath)
     CONFIG.set('server', 'outputpath', outputpath)
     CONFIG.set('server', 'workdir', tempfile.gettempdir())
+    CONFIG.set('server', 'statusupdateinterval', '1')
+    CONFIG.set('server', 'workdirpoolsize', '0')
+    CONFIG.set('server', 'workdirmaxage', '86400')
+    CONFIG.set('server', 'workdircleanupinterval', '60')
     CONFIG.set('server', 'parallelprocesses', '2')
+    CONFIG.set('server', 'workers', '0')
+    CONFIG.set('server', 'maxtasksperworker', '100')
+    CONFIG.set('server', 'queueorder', 'fifo')
+    CONFIG.set('server', 'schedulerinterval', '5')
+    CONFIG.set('server', 'nodename', '')
+    CONFIG.set('server', 'claimtimeout', '60')
+    CONFIG.set('server', 'leasetime', '60')
+    CONFIG.set('server', 'parallelfetches', '4')
+    CONFIG.set('server', 'maxfetches', '16')
+    CONFIG.set('server', 'maxfetchesperhost', '2')
+    CONFIG.set('server', 'inputcachepath', '')
+    CONFIG.set('server', 'inputcachesize', '1gb')
+    CONFIG.set('server', 'resultcachepath', '')
+    CONFIG.set('server', 'resultcachesize', '1gb')
+    CONFIG.set('server', 'resultcachettl', '86400')
+    CONFIG.set('server', 'prettyprint', 'true')
+    CONFIG.set('server', 'compression', '')
     # If this flag is enabled it will set the HOME environment
     # for each process to its current workdir (a temp folder).
     CONFIG.set('server', 'sethomedir', 'false')
@@ -97,6 +134,8 @@ def load_configuration(cfgfiles=None):
     CONFIG.set('logging', 'level', 'DEBUG')
     CONFIG.set('logging', 'database', 'sqlite:///:memory:')
     CONFIG.set('logging', 'prefix', 'pywps_')
+    CONFIG.set('logging', 'queuesize', '1000')
+    CONFIG.set('logging', 'overflow', 'block')
     CONFIG.set('logging', 'format', '%(asctime)s] [%(levelname)s] file=%(pathname)s line=%(lineno)s module=%(module)s function=%(funcName)s %(message)s')  # noqa
 
     CONFIG.add_section('metadata:main')
@@ -125,6 +164,7 @@ def load_configuration(cfgfiles=None):
 
     CONFIG.add_section('grass')
     CONFIG.set('grass', 'gisbase', '')
+    CONFIG.set('grass', 'locations', '')
 
     if not cfgfiles:
         cfgfiles = _get_default_config_files_location()
@@ -139,6 +179,7 @@ def load_configuration(cfgfiles=None):
         LOGGER.info('No configuration files loaded. Using default values')
 
     _check_config()
+    _CONFIG_GENERATION += 1
 
 
 def _check_config():
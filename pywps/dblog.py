@@ -12,21 +12,35 @@ Implementation of logging for PyWPS-4
 import logging
 from pywps import configuration
 from pywps.exceptions import NoApplicableCode
-from pywps._compat import PY2
+from pywps._compat import PY2, queue
+import atexit
 import sqlite3
 import datetime
 import pickle
 import json
 import os
+import socket
+import threading
+import uuid as _uuid
 
 import sqlalchemy
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, VARCHAR, Float, DateTime, LargeBinary
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, Integer, String, VARCHAR, Float, DateTime, LargeBinary, or_, func
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import StaticPool
 
 LOGGER = logging.getLogger('PYWPS')
 _SESSION_MAKER = None
-_LAST_SESSION = None
+_ENGINE = None
+# serializes database access of the threads of this process
+_LOCK = threading.RLock()
+_WRITER = None
+_PID = os.getpid()
+
+# maximum number of log events written in one transaction
+BATCH_SIZE = 100
+# connection strings of in-memory databases
+_MEMORY_DATABASES = ('sqlite://', 'sqlite:///:memory:')
 
 
 _tableprefix = configuration.get_config_value('logging', 'prefix')
@@ -48,6 +62,7 @@ class ProcessInstance(Base):
     message = Column(String, nullable=True)
     percent_done = Column(Float, nullable=True)
     status = Column(Integer, nullable=True)
+    node = Column(VARCHAR(255), nullable=True)
 
 
 class RequestInstance(Base):
@@ -55,6 +70,36 @@ class RequestInstance(Base):
 
     uuid = Column(VARCHAR(255), primary_key=True, nullable=False)
     request = Column(LargeBinary, nullable=False)
+    priority = Column(Integer, nullable=False, default=0)
+    time_queued = Column(DateTime(), nullable=True)
+    claim = Column(VARCHAR(255), nullable=True)
+    time_claimed = Column(DateTime(), nullable=True)
+
+
+class SlotInstance(Base):
+    __tablename__ = '{}slots'.format(_tableprefix)
+
+    uuid = Column(VARCHAR(255), primary_key=True, nullable=False)
+    identifier = Column(VARCHAR(255), nullable=True)
+    weight = Column(Float, nullable=False, default=1)
+    node = Column(VARCHAR(255), nullable=True)
+    # node and pid of the operating system process renewing the lease
+    owner = Column(VARCHAR(255), nullable=True)
+    lease_expires = Column(DateTime(), nullable=False, index=True)
+
+
+# columns added to existing tables by later versions, see _upgrade_tables
+_ADDED_COLUMNS = (
+    (ProcessInstance, ('node',)),
+    (RequestInstance, ('priority', 'time_queued', 'claim', 'time_claimed')),
+)
+
+
+def get_node():
+    """Return name of this node, `nodename` or the host name
+    """
+
+    return configuration.get_config_value('server', 'nodename') or socket.gethostname()
 
 
 def log_request(uuid, request):
@@ -62,62 +107,207 @@ def log_request(uuid, request):
     system
     """
 
-    pid = os.getpid()
-    operation = request.operation
-    version = request.version
-    time_start = datetime.datetime.now()
-    identifier = _get_identifier(request)
+    _put(('request', {
+        'uuid': str(uuid),
+        'pid': os.getpid(),
+        'operation': request.operation,
+        'version': request.version,
+        'time_start': datetime.datetime.now(),
+        'identifier': _get_identifier(request),
+        'node': get_node()
+    }))
 
-    session = get_session()
-    request = ProcessInstance(
-        uuid=str(uuid), pid=pid, operation=operation, version=version,
-        time_start=time_start, identifier=identifier)
 
-    session.add(request)
-    session.commit()
-    session.close()
-    # NoApplicableCode("Could commit to database: {}".format(e.message))
+def get_running(node=None):
+    """Returns running processes ids
 
+    Requests waiting in the job queue are not running.
 
-def get_running():
-    """Returns running processes ids
+    :param node: return only requests running on the node
     """
 
-    session = get_session()
-    running = session.query(ProcessInstance).filter(
-        ProcessInstance.percent_done < 100).filter(
-            ProcessInstance.percent_done > -1)
-
-    session.close()
+    flush()
+    with _lock():
+        session = _get_session()
+        query = session.query(ProcessInstance).filter(
+            ProcessInstance.percent_done < 100).filter(
+                ProcessInstance.percent_done > -1).filter(
+                    ~ProcessInstance.uuid.in_(session.query(RequestInstance.uuid)))
+        if node is not None:
+            query = query.filter(ProcessInstance.node == node)
+        running = query.all()
+
+        session.close()
     return running
 
 
-def get_stored():
-    """Returns running processes ids
+def is_shared():
+    """Return False if the database exists in this operating system process
+    only, so that child processes write to their own copy of it
+    """
+
+    return configuration.get_config_value('logging', 'database') not in _MEMORY_DATABASES
+
+
+def get_owner():
+    """Return owner name of the slots held by this operating system process
+    """
+
+    return '{}:{}'.format(get_node(), os.getpid())
+
+
+def hold_slot(uuid, identifier, weight, lease):
+    """Take the slot of the request, or take it over from the process, which
+    admitted the request
+
+    :param lease: seconds until the slot is released, if it is not renewed
+    """
+
+    values = {
+        'identifier': identifier,
+        'weight': weight,
+        'node': get_node(),
+        'owner': get_owner(),
+        'lease_expires': datetime.datetime.now() + datetime.timedelta(seconds=lease)
+    }
+    with _lock():
+        session = _get_session()
+        try:
+            updated = session.query(SlotInstance).filter_by(uuid=str(uuid)).update(
+                values, synchronize_session=False)
+            if not updated:
+                session.add(SlotInstance(uuid=str(uuid), **values))
+            session.commit()
+        finally:
+            session.close()
+
+
+def renew_slots(uuids, lease):
+    """Extend leases of the slots held by this operating system process
+
+    :return: set of renewed uuids, the others were released or taken over
+    """
+
+    uuids = [str(uuid) for uuid in uuids]
+    with _lock():
+        session = _get_session()
+        try:
+            query = session.query(SlotInstance).filter(SlotInstance.uuid.in_(uuids)).filter(
+                SlotInstance.owner == get_owner())
+            renewed = set(row.uuid for row in query.all())
+            query.update({'lease_expires': datetime.datetime.now() + datetime.timedelta(seconds=lease)},
+                         synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+    return renewed
+
+
+def release_slot(uuid):
+    """Release the slot of the finished request
+    """
+
+    with _lock():
+        session = _get_session()
+        try:
+            session.query(SlotInstance).filter_by(uuid=str(uuid)).delete(synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+
+
+def get_slots(node=None):
+    """Returns slots with valid lease
+
+    :param node: return only slots of the node
     """
 
-    session = get_session()
-    stored = session.query(RequestInstance)
+    with _lock():
+        session = _get_session()
+        query = session.query(SlotInstance).filter(SlotInstance.lease_expires >= datetime.datetime.now())
+        if node is not None:
+            query = query.filter(SlotInstance.node == node)
+        slots = query.all()
+
+        session.close()
+    return slots
+
+
+def expire_slots():
+    """Remove slots with expired lease, their requests died
+
+    :return: list of uuids of the removed slots
+    """
+
+    now = datetime.datetime.now()
+    with _lock():
+        session = _get_session()
+        try:
+            query = session.query(SlotInstance).filter(SlotInstance.lease_expires < now)
+            expired = [row.uuid for row in query.all()]
+            if expired:
+                session.query(SlotInstance).filter(SlotInstance.uuid.in_(expired)).filter(
+                    SlotInstance.lease_expires < now).delete(synchronize_session=False)
+                session.commit()
+        finally:
+            session.close()
+    return expired
+
+
+def get_job(uuid):
+    """Returns logged request with given UUID, run by any node, or None
+    """
+
+    flush()
+    with _lock():
+        session = _get_session()
+        job = session.query(ProcessInstance).filter_by(uuid=str(uuid)).first()
+
+        session.close()
+    return job
+
 
-    session.close()
+def get_stored(priority=False):
+    """Returns stored requests in the order they shall be started
+
+    Requests claimed by a node are left out, unless the claim is older than
+    `claimtimeout` seconds.
+
+    :param priority: order by priority first, the default is FIFO
+    """
+
+    flush()
+    with _lock():
+        session = _get_session()
+        query = session.query(RequestInstance).filter(_unclaimed())
+        if priority:
+            query = query.order_by(RequestInstance.priority.desc())
+        stored = query.order_by(RequestInstance.time_queued, RequestInstance.uuid).all()
+
+        session.close()
     return stored
 
 
-def get_first_stored():
-    """Returns running processes ids
+def count_stored():
+    """Returns number of stored requests waiting to be started
     """
 
-    session = get_session()
-    request = session.query(RequestInstance).first()
+    flush()
+    with _lock():
+        session = _get_session()
+        count = session.query(func.count(RequestInstance.uuid)).filter(_unclaimed()).scalar()
 
-    return request
+        session.close()
+    return count
 
 
 def update_response(uuid, response, close=False):
     """Writes response to database
+
+    Progress updates of running processes may be dropped, if the log queue
+    is full and the `overflow` policy is ``drop``.
     """
 
-    session = get_session()
     message = None
     status_percentage = None
     status = None
@@ -129,20 +319,20 @@ def update_response(uuid, response, close=False):
     if hasattr(response, 'status'):
         status = response.status
 
-        if status == '200 OK':
+        if status in ('200 OK', '206 PARTIAL CONTENT', '304 NOT MODIFIED'):
             status = 3
         elif status == 400:
             status = 0
 
-    requests = session.query(ProcessInstance).filter_by(uuid=str(uuid))
-    if requests.count():
-        request = requests.one()
-        request.time_end = datetime.datetime.now()
-        request.message = message
-        request.percent_done = status_percentage
-        request.status = status
-        session.commit()
-    session.close()
+    # dropping intermediate progress never changes the number of running processes
+    droppable = not close and status_percentage is not None and 0 < status_percentage < 100
+    _put(('update', str(uuid), {
+        'time_end': datetime.datetime.now(),
+        'message': message,
+        'percent_done': status_percentage,
+        'status': status,
+        'node': get_node()
+    }), droppable)
 
 
 def _get_identifier(request):
@@ -162,61 +352,300 @@ def _get_identifier(request):
 
 def get_session():
     """Get Connection for database
+
+    Pending log events are written first, so that the session sees them.
+    Sessions are thread local, so that requests running in threads of the
+    same server process do not close each other's sessions.
     """
 
+    flush()
+    with _lock():
+        return _get_session()
+
+
+def _get_session():
     LOGGER.debug('Initializing database connection')
-    global _SESSION_MAKER
-    global _LAST_SESSION
+    global _SESSION_MAKER, _ENGINE
+
+    with _lock():
+        if _SESSION_MAKER:
+            return _SESSION_MAKER()
+
+        database = configuration.get_config_value('logging', 'database')
+        echo = True
+        level = configuration.get_config_value('logging', 'level')
+        if level in ['INFO']:
+            echo = False
+        engine_args = {}
+        if database in _MEMORY_DATABASES:
+            # in-memory database exists only within its connection,
+            # share the connection with all threads
+            engine_args['poolclass'] = StaticPool
+            engine_args['connect_args'] = {'check_same_thread': False}
+        try:
+            engine = sqlalchemy.create_engine(database, echo=echo, **engine_args)
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            raise NoApplicableCode("Could not connect to database: {}".format(e.message))
+
+        Session = scoped_session(sessionmaker(bind=engine))
+        ProcessInstance.metadata.create_all(engine)
+        RequestInstance.metadata.create_all(engine)
+        SlotInstance.metadata.create_all(engine)
+        _upgrade_tables(engine)
+
+        _SESSION_MAKER = Session
+        _ENGINE = engine
+
+        return _SESSION_MAKER()
+
+
+def _upgrade_tables(engine):
+    """Add columns missing in tables created by an older version of PyWPS
+
+    `create_all` creates missing tables only, so the columns of
+    :data:`_ADDED_COLUMNS` are added to existing tables here.
+    """
 
-    if _LAST_SESSION:
-        _LAST_SESSION.close()
+    inspector = sqlalchemy.inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    for model, names in _ADDED_COLUMNS:
+        table = model.__table__
+        existing = set(column['name'] for column in inspector.get_columns(table.name, schema=table.schema))
+        for name in names:
+            if name in existing:
+                continue
+            column = table.c[name]
+            ddl = 'ALTER TABLE {} ADD COLUMN {} {}'.format(
+                preparer.format_table(table), preparer.format_column(column),
+                column.type.compile(dialect=engine.dialect))
+            if not column.nullable:
+                # existing rows get the default value
+                ddl += ' NOT NULL DEFAULT {}'.format(column.default.arg)
+            LOGGER.info('Adding column %s to table %s', name, table.name)
+            with engine.begin() as connection:
+                connection.execute(sqlalchemy.text(ddl))
+
+
+def store_process(uuid, job, priority=0):
+    """Save given job under given UUID for later usage
+
+    :param job: JSON encoded job description
+    :param priority: jobs with higher priority are started first, if the
+        queue is ordered by priority
+    """
+
+    if not PY2:
+        # the BLOB type requires bytes on Python 3
+        job = job.encode('utf-8')
+    _put(('store', str(uuid), job, priority, datetime.datetime.now()))
 
-    if _SESSION_MAKER:
-        _SESSION_MAKER.close_all()
-        _LAST_SESSION = _SESSION_MAKER()
-        return _LAST_SESSION
 
-    database = configuration.get_config_value('logging', 'database')
-    echo = True
-    level = configuration.get_config_value('logging', 'level')
-    if level in ['INFO']:
-        echo = False
-    try:
-        engine = sqlalchemy.create_engine(database, echo=echo)
-    except sqlalchemy.exc.SQLAlchemyError as e:
-        raise NoApplicableCode("Could not connect to database: {}".format(e.message))
+def claim_stored(uuid):
+    """Claim given stored request for this node, before it is started
 
-    Session = sessionmaker(bind=engine)
-    ProcessInstance.metadata.create_all(engine)
-    RequestInstance.metadata.create_all(engine)
+    The claim is a single conditional UPDATE, so only one caller succeeds
+    for each stored request, even if processes of several nodes dispatch the
+    queue at the same time. A claim older than `claimtimeout` seconds can be
+    taken over, so that requests claimed by a crashed node are started by
+    another one.
 
-    _SESSION_MAKER = Session
+    :return: claim token, or None if the request is claimed by another caller
+    """
 
-    _LAST_SESSION = _SESSION_MAKER()
-    return _LAST_SESSION
+    token = '{}:{}'.format(get_node(), _uuid.uuid4().hex)
+    flush()
+    with _lock():
+        session = _get_session()
+        try:
+            claimed = session.query(RequestInstance).filter_by(uuid=str(uuid)).filter(_unclaimed()).update(
+                {'claim': token, 'time_claimed': datetime.datetime.now()}, synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+    if claimed == 1:
+        return token
+    return None
+
+
+def remove_stored(uuid, token):
+    """Remove given request from stored requests, once it is started
+
+    :param token: token returned by :func:`claim_stored`
+    :return: False if the claim has been taken over by another caller
+    """
 
+    with _lock():
+        session = _get_session()
+        try:
+            removed = session.query(RequestInstance).filter_by(uuid=str(uuid), claim=token).delete(
+                synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+    return removed == 1
 
-def store_process(uuid, request):
-    """Save given request under given UUID for later usage
+
+def _unclaimed():
+    """Return filter of stored requests without valid claim
     """
 
-    session = get_session()
-    request_json = request.json
-    if not PY2:
-        # the BLOB type requires bytes on Python 3
-        request_json = request_json.encode('utf-8')
-    request = RequestInstance(uuid=str(uuid), request=request_json)
-    session.add(request)
-    session.commit()
-    session.close()
+    timeout = float(configuration.get_config_value('server', 'claimtimeout'))
+    stale = datetime.datetime.now() - datetime.timedelta(seconds=timeout)
+    return or_(RequestInstance.claim.is_(None), RequestInstance.time_claimed < stale)
 
 
-def remove_stored(uuid):
-    """Remove given request from stored requests
+def flush():
+    """Wait until all log events queued so far are written to the database
     """
 
-    session = get_session()
-    request = session.query(RequestInstance).filter_by(uuid=str(uuid)).first()
-    session.delete(request)
-    session.commit()
-    session.close()
+    _lock()
+    writer = _WRITER
+    if writer is not None:
+        writer.flush()
+
+
+def _put(event, droppable=False):
+    """Queue log event, or write it immediately if the queue is disabled
+    """
+
+    writer = _get_writer()
+    if writer is None:
+        _write([event])
+    else:
+        writer.put(event, droppable)
+
+
+def _lock():
+    """Return the database lock of this operating system process
+
+    A forked child inherits the lock, the writer and the connection pool of
+    its parent: the lock may be held by a thread, which does not exist in the
+    child, and pooled connections must not be used by both processes. They
+    are replaced by new ones at the first database access of the child.
+    """
+
+    global _LOCK, _WRITER, _PID, _SESSION_MAKER, _ENGINE
+
+    if _PID != os.getpid():
+        _PID = os.getpid()
+        _LOCK = threading.RLock()
+        _WRITER = None
+        _SESSION_MAKER = None
+        if _ENGINE is not None:
+            try:
+                # leave the connections to the parent
+                _ENGINE.dispose(close=False)
+            except TypeError:
+                # SQLAlchemy < 1.4.33
+                _ENGINE.dispose()
+            _ENGINE = None
+    return _LOCK
+
+
+def _get_writer():
+    """Return log writer of this process, None if `queuesize` is 0
+    """
+
+    global _WRITER
+
+    lock = _lock()
+    size = int(configuration.get_config_value('logging', 'queuesize'))
+    if size <= 0:
+        return None
+
+    with lock:
+        if _WRITER is None:
+            _WRITER = _LogWriter(size, configuration.get_config_value('logging', 'overflow'))
+            _WRITER.start()
+        return _WRITER
+
+
+def _write(events):
+    """Write log events to the database in one transaction
+
+    Only the last update of each request is written, as it replaces all
+    previously updated columns.
+    """
+
+    last_update = {}
+    for (index, event) in enumerate(events):
+        if event[0] == 'update':
+            last_update[event[1]] = index
+
+    with _lock():
+        session = _get_session()
+        try:
+            for (index, event) in enumerate(events):
+                if event[0] == 'request':
+                    session.add(ProcessInstance(**event[1]))
+                elif event[0] == 'update' and last_update[event[1]] == index:
+                    session.query(ProcessInstance).filter_by(uuid=event[1]).update(
+                        event[2], synchronize_session=False)
+                elif event[0] == 'store':
+                    session.add(RequestInstance(uuid=event[1], request=event[2],
+                                                priority=event[3], time_queued=event[4]))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+
+class _LogWriter(threading.Thread):
+    """Thread writing queued log events in batches
+
+    :param size: maximum number of queued events
+    :param overflow: ``block`` to wait for free space in the full queue,
+        ``drop`` to drop progress updates of running processes
+    """
+
+    def __init__(self, size, overflow):
+        threading.Thread.__init__(self, name='pywps-dblog')
+        self.daemon = True
+        self.queue = queue.Queue(size)
+        self.overflow = overflow
+        self.dropped = 0
+
+    def put(self, event, droppable=False):
+        if droppable and self.overflow == 'drop':
+            try:
+                self.queue.put_nowait(event)
+            except queue.Full:
+                self.dropped += 1
+                LOGGER.warning('Log queue is full, dropping status update of %s', event[1])
+        else:
+            self.queue.put(event)
+
+    def flush(self):
+        done = threading.Event()
+        self.queue.put(('flush', done))
+        done.wait()
+
+    def run(self):
+        while True:
+            events = [self.queue.get()]
+            while len(events) < BATCH_SIZE:
+                try:
+                    events.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            writes = [event for event in events if event[0] != 'flush']
+            try:
+                if writes:
+                    _write(writes)
+            except Exception:
+                # write the events one by one, not to lose the valid ones
+                for event in writes:
+                    try:
+                        _write([event])
+                    except Exception as e:
+                        LOGGER.error('Could not write log event %s to database: %s', event[0], e)
+
+            for event in events:
+                if event[0] == 'flush':
+                    event[1].set()
+
+
+atexit.register(flush)
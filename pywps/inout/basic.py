@@ -19,6 +19,7 @@ from pywps.validator.literalvalidator import (validate_anyvalue,
 from pywps.exceptions import InvalidParameterValue
 from pywps._compat import PY2
 import base64
+import copy
 from collections import namedtuple
 from io import BytesIO
 
@@ -100,8 +101,13 @@ class IOHandler(object):
                                         'mode %s' % (self.valid_mode))
 
     def set_file(self, filename):
-        """Set source as file name"""
+        """Set source as file name
+
+        Relative file names are resolved against the working directory
+        """
         self.source_type = SOURCE_TYPE.FILE
+        if self.workdir and not os.path.isabs(filename):
+            filename = os.path.join(self.workdir, filename)
         self.source = os.path.abspath(filename)
         self._check_valid()
 
@@ -223,6 +229,15 @@ class IOHandler(object):
     def get_base64(self):
         return base64.b64encode(self.data)
 
+    def clone(self):
+        """Create copy of yourself
+
+        The copy is shallow: the definition (formats, validators, metadata,
+        allowed values, ...) is shared with the original and shall be treated
+        as read-only, only the data are owned by the copy.
+        """
+        return copy.copy(self)
+
     # Properties
     file = property(fget=get_file, fset=set_file)
     memory_object = property(fget=get_memory_object, fset=set_memory_object)
@@ -0,0 +1,258 @@
+##################################################################
+# Copyright 2016 OSGeo Foundation,                               #
+# represented by PyWPS Project Steering Committee,               #
+# licensed under MIT, Please consult LICENSE.txt for details     #
+##################################################################
+
+"""
+Node-local cache of remote reference inputs
+"""
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from pywps import configuration as config
+from pywps._compat import HTTPError
+from pywps.inout.fetch import openurl, download
+
+LOGGER = logging.getLogger('PYWPS')
+
+_INPUT_CACHE = None
+_INPUT_CACHE_LOCK = threading.Lock()
+
+
+def get_input_cache():
+    """Return the :class:`InputCache` of this server process
+
+    :return: the cache or None if `inputcachepath` is not configured
+    """
+
+    global _INPUT_CACHE
+
+    path = config.get_config_value('server', 'inputcachepath')
+    if not path:
+        return None
+
+    max_size = config.get_size_mb(config.get_config_value('server', 'inputcachesize')) * 1024 * 1024
+    with _INPUT_CACHE_LOCK:
+        if _INPUT_CACHE is None or _INPUT_CACHE.path != path or _INPUT_CACHE.max_size != max_size:
+            _INPUT_CACHE = InputCache(path, max_size)
+        return _INPUT_CACHE
+
+
+class InputCache(object):
+    """Cache of downloaded reference inputs shared by all requests of one node
+
+    Entries are keyed by the URL, method and body of the reference and stored
+    in `path`, together with the ETag and Last-Modified headers of the
+    response. Before an entry is used, it is revalidated with a conditional
+    request. Valid entries are hard linked (or copied, if the workdir is on
+    another file system) into the workdir, so processes must not modify their
+    input files. Least recently used entries are removed as soon as the total
+    size exceeds `max_size` bytes.
+
+    Counters of this server process are available in :attr:`stats`.
+
+    :param path: cache directory
+    :param max_size: maximum total size of the cached files in bytes
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'hit_bytes': 0,
+            'miss_bytes': 0,
+            'evicted_bytes': 0
+        }
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    @property
+    def stats(self):
+        """Copy of the hit, miss and byte counters
+        """
+
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, **counters):
+        with self._lock:
+            for (name, value) in counters.items():
+                self._stats[name] += value
+
+    @staticmethod
+    def key(inpt):
+        """Return cache key of the reference input
+
+        :param inpt: dict with href, method and body or bodyreference of the input
+        """
+
+        method = inpt.get('method', 'GET')
+        body = ''
+        if method == 'POST':
+            body = inpt.get('body') or inpt.get('bodyreference') or ''
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        digest = hashlib.sha256()
+        digest.update(method.encode('utf-8') + b'\n')
+        digest.update(inpt.get('href').encode('utf-8') + b'\n')
+        digest.update(body)
+        return digest.hexdigest()
+
+    def fetch(self, inpt, target, max_size):
+        """Provide the content of the reference input as target file
+
+        :param inpt: dict with href, method and body or bodyreference of the input
+        :param target: name of the target file in the workdir
+        :param max_size: maximum allowed size in bytes
+        :raises FileSizeExceeded: the content is larger than max_size
+        :return: size of the file in bytes
+        """
+
+        key = self.key(inpt)
+        data_file = os.path.join(self.path, key)
+        entry = self._read_entry(key)
+
+        headers = {}
+        if entry is not None and entry['size'] <= max_size:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        reference_file = None
+        if headers:
+            try:
+                reference_file = openurl(inpt, headers)
+            except HTTPError as e:
+                if e.code != 304:
+                    raise
+                e.close()
+                if self._link(data_file, target):
+                    self._touch(key)
+                    self._count(hits=1, hit_bytes=entry['size'])
+                    LOGGER.debug('Input cache hit for %s', inpt.get('href'))
+                    return entry['size']
+
+        if reference_file is None:
+            reference_file = openurl(inpt)
+
+        (fd, tmp_file) = tempfile.mkstemp(dir=self.path, prefix='.download_')
+        os.close(fd)
+        entry = {
+            'href': inpt.get('href'),
+            'etag': reference_file.headers.get('ETag'),
+            'last_modified': reference_file.headers.get('Last-Modified')
+        }
+        try:
+            entry['size'] = download(reference_file, tmp_file, max_size)
+        except Exception:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+        self._count(misses=1, miss_bytes=entry['size'])
+        LOGGER.debug('Input cache miss for %s', inpt.get('href'))
+
+        if (not entry['etag'] and not entry['last_modified']) or entry['size'] > self.max_size:
+            # the content can not be revalidated or does not fit in the cache
+            shutil.move(tmp_file, target)
+            return entry['size']
+
+        os.rename(tmp_file, data_file)
+        self._write_entry(key, entry)
+        self._evict(keep=key)
+        if not self._link(data_file, target):
+            shutil.copyfile(data_file, target)
+        return entry['size']
+
+    def _read_entry(self, key):
+        """Return metadata of the cached file or None
+        """
+
+        try:
+            with open(os.path.join(self.path, key + '.json')) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_entry(self, key, entry):
+        (fd, tmp_file) = tempfile.mkstemp(dir=self.path, prefix='.entry_')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmp_file, os.path.join(self.path, key + '.json'))
+
+    def _touch(self, key):
+        """Mark the entry as recently used
+        """
+
+        try:
+            os.utime(os.path.join(self.path, key + '.json'), None)
+        except OSError:
+            pass
+
+    def _link(self, data_file, target):
+        """Link or copy cached file to target
+
+        :return: False if the cached file does not exist anymore
+        """
+
+        if os.path.lexists(target):
+            os.remove(target)
+        try:
+            os.link(data_file, target)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            # other file system, a symbolic link would dangle or change when
+            # the entry is evicted or revalidated
+            try:
+                shutil.copyfile(data_file, target)
+            except (IOError, OSError) as e:
+                if e.errno == errno.ENOENT and not os.path.exists(data_file):
+                    return False
+                raise
+        return True
+
+    def _evict(self, keep=None):
+        """Remove least recently used entries until the cache fits in max_size
+        """
+
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.path):
+            if not name.endswith('.json') or name.startswith('.'):
+                continue
+            key = name[:-len('.json')]
+            entry = self._read_entry(key)
+            if entry is None:
+                continue
+            try:
+                used = os.path.getmtime(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((used, key, entry['size']))
+            total_size += entry['size']
+
+        for (used, key, size) in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            for name in (key + '.json', key):
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+            total_size -= size
+            self._count(evicted_bytes=size)
+            LOGGER.debug('Removed input %s from cache', key)
@@ -0,0 +1,176 @@
+##################################################################
+# Copyright 2016 OSGeo Foundation,                               #
+# represented by PyWPS Project Steering Committee,               #
+# licensed under MIT, Please consult LICENSE.txt for details     #
+##################################################################
+
+"""
+Concurrent fetching of reference inputs
+"""
+
+import logging
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+from pywps import configuration as config
+from pywps._compat import text_type, urlopen, urlparse, Request
+from pywps.exceptions import FileSizeExceeded
+
+LOGGER = logging.getLogger('PYWPS')
+
+# number of bytes held in memory when downloading reference inputs
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# limits shared by all requests of this server process
+_SLOTS = None
+_HOST_SLOTS = {}
+_SLOTS_LOCK = threading.Lock()
+
+
+def openurl(inpt, headers=None):
+    """use urllib to open given href
+
+    :param inpt: dict with href, method and body or bodyreference of the input
+    :param headers: additional http request headers
+    :return: file-like object with the response, the content is not read
+    """
+    data = None
+    href = inpt.get('href')
+
+    LOGGER.debug('Fetching URL %s', href)
+    if inpt.get('method') == 'POST':
+        if 'body' in inpt:
+            data = inpt.get('body')
+        elif 'bodyreference' in inpt:
+            data = urlopen(url=inpt.get('bodyreference')).read()
+
+        if isinstance(data, text_type):
+            data = data.encode('utf-8')
+
+    return urlopen(Request(href, data=data, headers=headers or {}))
+
+
+def download(reference_file, target, max_size):
+    """Store content of opened url to target file
+
+    The content is copied in chunks of DOWNLOAD_CHUNK_SIZE bytes, the download
+    is aborted as soon as more than max_size bytes arrive.
+
+    :param reference_file: file-like object returned by :func:`openurl`
+    :param target: name of the target file
+    :param max_size: maximum allowed size in bytes
+    :raises FileSizeExceeded: the content is larger than max_size
+    """
+
+    try:
+        data_size = reference_file.headers.get('Content-Length')
+        if data_size is not None and int(data_size) > max_size:
+            raise FileSizeExceeded('File size for input exceeded.')
+
+        data_size = 0
+        with open(target, 'wb') as f:
+            while True:
+                chunk = reference_file.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                data_size += len(chunk)
+                if data_size > max_size:
+                    raise FileSizeExceeded('File size for input exceeded.')
+                f.write(chunk)
+    except Exception:
+        if os.path.exists(target):
+            os.remove(target)
+        raise
+    finally:
+        reference_file.close()
+
+    LOGGER.debug('Downloaded %i bytes to %s', data_size, target)
+    return data_size
+
+
+def _get_slots(host):
+    """Return (global, per host) semaphores limiting concurrent downloads
+    """
+
+    global _SLOTS
+
+    with _SLOTS_LOCK:
+        if _SLOTS is None:
+            _SLOTS = threading.BoundedSemaphore(
+                max(int(config.get_config_value('server', 'maxfetches')), 1))
+        if host not in _HOST_SLOTS:
+            _HOST_SLOTS[host] = threading.BoundedSemaphore(
+                max(int(config.get_config_value('server', 'maxfetchesperhost')), 1))
+        return (_SLOTS, _HOST_SLOTS[host])
+
+
+class ReferenceFetcher(object):
+    """Collects reference inputs of one request and fetches them in parallel
+
+    Downloads are added with :meth:`add` and run by :meth:`fetch`. At most
+    `parallelfetches` downloads of one request run at the same time, and all
+    requests of the server process together respect the `maxfetches` and
+    `maxfetchesperhost` limits.
+
+    If some downloads fail, :meth:`fetch` raises the error of the first
+    failed download in the order they were added, so the reported error does
+    not depend on the timing of the downloads.
+
+    :param int parallel: maximum number of parallel downloads of this request,
+        defaults to `parallelfetches` configuration value
+    """
+
+    def __init__(self, parallel=None):
+        if parallel is None:
+            parallel = int(config.get_config_value('server', 'parallelfetches'))
+        self.parallel = max(parallel, 1)
+        self._jobs = []
+
+    def add(self, href, function, *args):
+        """Add download
+
+        :param href: url to be downloaded
+        :param function: function performing the download, called with args
+        """
+
+        self._jobs.append((urlparse(href).netloc, function, args))
+
+    def fetch(self):
+        """Run all added downloads and wait for them to finish
+        """
+
+        jobs = self._jobs
+        self._jobs = []
+        if not jobs:
+            return
+
+        errors = [None] * len(jobs)
+
+        def run(index):
+            (host, function, args) = jobs[index]
+            (slots, host_slots) = _get_slots(host)
+            with host_slots, slots:
+                try:
+                    function(*args)
+                except Exception as e:
+                    errors[index] = e
+
+        if self.parallel == 1 or len(jobs) == 1:
+            for index in range(len(jobs)):
+                run(index)
+                if errors[index] is not None:
+                    raise errors[index]
+            return
+
+        LOGGER.debug('Fetching %i references, %i in parallel', len(jobs), self.parallel)
+        pool = ThreadPool(min(self.parallel, len(jobs)))
+        try:
+            pool.map(run, range(len(jobs)))
+        finally:
+            pool.close()
+            pool.join()
+
+        for error in errors:
+            if error is not None:
+                raise error
@@ -7,7 +7,6 @@
 
 from pywps import configuration, E, OWS, WPS, OGCTYPE, NAMESPACES
 from pywps.inout import basic
-from copy import deepcopy
 from pywps.validator.mode import MODE
 from pywps.inout.literaltypes import AnyValue
 
@@ -108,11 +107,6 @@ class BoundingBoxInput(basic.BBoxInput):
         doc.append(bbox_data_doc)
         return doc
 
-    def clone(self):
-        """Create copy of yourself
-        """
-        return deepcopy(self)
-
 
 class ComplexInput(basic.ComplexInput):
     """
@@ -240,11 +234,6 @@ class ComplexInput(basic.ComplexInput):
         doc.append(complex_doc)
         return doc
 
-    def clone(self):
-        """Create copy of yourself
-        """
-        return deepcopy(self)
-
 
 class LiteralInput(basic.LiteralInput):
     """
@@ -379,8 +368,3 @@ class LiteralInput(basic.LiteralInput):
             literal_doc.attrib['uom'] = self.uom
         doc.append(literal_doc)
         return doc
-
-    def clone(self):
-        """Create copy of yourself
-        """
-        return deepcopy(self)
@@ -5,15 +5,26 @@
 ##################################################################
 
 
-from pywps._compat import text_type
+import base64
+import codecs
+import re
+from xml.sax.saxutils import escape
+
+from pywps._compat import text_type, PY2
 from pywps import E, WPS, OWS, OGCTYPE, NAMESPACES
 from pywps.inout import basic
+from pywps.inout.basic import SOURCE_TYPE
 from pywps.inout.storage import FileStorage
 from pywps.inout.formats import Format
 from pywps.validator.mode import MODE
 import lxml.etree as etree
 import six
 
+# multiple of 3, so that base64 encoded chunks can be concatenated
+CHUNK_SIZE = 48 * 1024
+
+XML_ENCODING = re.compile(br'encoding\s*=\s*["\']([A-Za-z0-9._-]+)["\']')
+
 
 class BoundingBoxOutput(basic.BBoxInput):
     """
@@ -102,6 +113,22 @@ class BoundingBoxOutput(basic.BBoxInput):
         doc.append(data_doc)
         return doc
 
+    def execute_json(self):
+        """Render Execute response JSON object
+
+        :rtype: dict
+        """
+
+        return {
+            'identifier': self.identifier,
+            'title': self.title,
+            'abstract': self.abstract,
+            'type': 'bbox',
+            'crs': self.crs,
+            'dimensions': self.dimensions,
+            'bbox': self.data
+        }
+
 
 class ComplexOutput(basic.ComplexOutput):
     """
@@ -210,12 +237,14 @@ class ComplexOutput(basic.ComplexOutput):
                 doc.attrib['schema'] = self.data_format.schema
         return doc
 
-    def _execute_xml_data(self):
+    def _execute_xml_data(self, content=True):
         """Return Data node
+
+        :param content: False to return empty ComplexData element
         """
         doc = WPS.Data()
 
-        if self.data is None:
+        if not content or self.data is None:
             complex_doc = WPS.ComplexData()
         else:
             complex_doc = WPS.ComplexData()
@@ -239,6 +268,161 @@ class ComplexOutput(basic.ComplexOutput):
         doc.append(complex_doc)
         return doc
 
+    def execute_json(self):
+        """Render Execute response JSON object
+
+        Binary data are encoded in base64 and marked with the `encoding` key.
+
+        :rtype: dict
+        """
+
+        doc = {
+            'identifier': self.identifier,
+            'title': self.title,
+            'abstract': self.abstract,
+            'type': 'complex',
+            'data_format': self.data_format.json if self.data_format else None
+        }
+
+        if self.as_reference:
+            # get_url will create the file and return the url for it
+            self.storage = FileStorage()
+            doc['href'] = self.get_url()
+        elif self.data is not None:
+            data = self.data
+            if isinstance(data, text_type):
+                doc['data'] = data
+            else:
+                doc['data'] = self.base64.decode('ascii')
+                doc['encoding'] = 'base64'
+        return doc
+
+    def execute_xml_chunks(self, pretty_print=True):
+        """Render Execute response XML node as serialized chunks
+
+        Data of outputs stored in files are read from the file in chunks
+        instead of being loaded into the XML tree, so that large outputs can
+        be written to the response or status document with little memory.
+
+        :param pretty_print: False for compact XML
+        :return: iterator of bytes
+        """
+
+        if self.as_reference or self.source_type != SOURCE_TYPE.FILE:
+            yield etree.tostring(self.execute_xml(), pretty_print=pretty_print)
+            return
+
+        root_offset = _get_xml_root_offset(self.file)
+        if root_offset is None and _is_xml(self.file):
+            # XML, which cannot be copied as it is
+            yield etree.tostring(self.execute_xml(), pretty_print=pretty_print)
+            return
+
+        data_doc = self._execute_xml_data(content=False)
+        doc = WPS.Output(
+            OWS.Identifier(self.identifier),
+            OWS.Title(self.title)
+        )
+        if self.abstract:
+            doc.append(OWS.Abstract(self.abstract))
+        doc.append(data_doc)
+
+        marker = etree.Comment('pywps-content')
+        data_doc[0].append(marker)
+        (head, tail) = etree.tostring(doc).split(etree.tostring(marker))
+
+        yield head
+        if root_offset is not None:
+            chunks = _read_chunks(self.file, root_offset)
+        elif PY2 or not self.data_format or self.data_format.encoding != 'base64':
+            chunks = _escape_chunks(_read_chunks(self.file))
+        else:
+            chunks = _base64_chunks(_read_chunks(self.file))
+        for chunk in chunks:
+            yield chunk
+        yield tail + (b'\n' if pretty_print else b'')
+
+
+def _read_chunks(file_name, offset=0):
+    with open(file_name, 'rb') as f:
+        f.seek(offset)
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            yield chunk
+
+
+def _escape_chunks(chunks):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for chunk in chunks:
+        yield escape(decoder.decode(chunk)).encode('utf-8')
+    yield escape(decoder.decode(b'', final=True)).encode('utf-8')
+
+
+def _base64_chunks(chunks):
+    yield b'<![CDATA['
+    for chunk in chunks:
+        yield base64.b64encode(chunk)
+    yield b']]>'
+
+
+def _is_xml(file_name):
+    """Check, whether the file is well-formed XML, without loading it
+    into memory
+    """
+
+    try:
+        for (_, element) in etree.iterparse(file_name, events=('end',), huge_tree=True):
+            element.clear()
+            parent = element.getparent()
+            if parent is not None:
+                while element.getprevious() is not None:
+                    del parent[0]
+    except (etree.XMLSyntaxError, ValueError):
+        return False
+    return True
+
+
+def _get_xml_root_offset(file_name):
+    """Return offset of the root element of UTF-8 encoded XML file, which
+    can be copied into the response as it is
+
+    :return: offset or None, if the file is not XML, has a document type
+        declaration or another encoding
+    """
+
+    with open(file_name, 'rb') as f:
+        head = f.read(CHUNK_SIZE)
+
+    offset = 0
+    if head.startswith(codecs.BOM_UTF8):
+        offset = len(codecs.BOM_UTF8)
+    while True:
+        while head[offset:offset + 1].isspace():
+            offset += 1
+        if head.startswith(b'<?xml', offset):
+            end = head.find(b'?>', offset)
+            encoding = XML_ENCODING.search(head, offset, end)
+            if end < 0 or (encoding and encoding.group(1).lower() not in (b'utf-8', b'utf8', b'ascii', b'us-ascii')):
+                return None
+            offset = end + 2
+        elif head.startswith(b'<?', offset):
+            end = head.find(b'?>', offset)
+            if end < 0:
+                return None
+            offset = end + 2
+        elif head.startswith(b'<!--', offset):
+            end = head.find(b'-->', offset)
+            if end < 0:
+                return None
+            offset = end + 3
+        elif head.startswith(b'<', offset) and not head.startswith(b'<!', offset):
+            break
+        else:
+            return None
+
+    if not _is_xml(file_name):
+        return None
+    return offset
+
 
 class LiteralOutput(basic.LiteralOutput):
     """
@@ -326,3 +510,19 @@ class LiteralOutput(basic.LiteralOutput):
         doc.append(data_doc)
 
         return doc
+
+    def execute_json(self):
+        """Render Execute response JSON object
+
+        :rtype: dict
+        """
+
+        return {
+            'identifier': self.identifier,
+            'title': self.title,
+            'abstract': self.abstract,
+            'type': 'literal',
+            'data_type': self.data_type,
+            'uom': self.uom.uom if self.uom else None,
+            'data': self.data
+        }
@@ -18,6 +18,7 @@ from tests import test_ows
 from tests import test_formats
 from tests import test_dblog
 from tests import test_wpsrequest
+from tests import test_asgi
 from tests.validator import test_complexvalidators
 from tests.validator import test_literalvalidators
 
@@ -36,7 +37,8 @@ def load_tests(loader=None, tests=None, pattern=None):
         test_literalvalidators.load_tests(),
         test_formats.load_tests(),
         test_dblog.load_tests(),
-        test_wpsrequest.load_tests()
+        test_wpsrequest.load_tests(),
+        test_asgi.load_tests()
     ])
 
 if __name__ == "__main__":
@@ -0,0 +1,139 @@
+##################################################################
+# Copyright 2016 OSGeo Foundation,                               #
+# represented by PyWPS Project Steering Committee,               #
+# licensed under MIT, Please consult LICENSE.txt for details     #
+##################################################################
+
+import os
+import tempfile
+import unittest
+
+import lxml.etree
+from pywps import Service, Process, LiteralInput, LiteralOutput
+from pywps import configuration
+from pywps._compat import PY2
+
+
+def create_greeter():
+    def greeter(request, response):
+        name = request.inputs['name'][0].data
+        response.outputs['message'].data = "Hello %s!" % name
+        return response
+
+    return Process(handler=greeter,
+                   identifier='greeter',
+                   title='Greeter',
+                   inputs=[LiteralInput('name', 'Input name', data_type='string')],
+                   outputs=[LiteralOutput('message', 'Output message', data_type='string')])
+
+
+@unittest.skipIf(PY2, 'ASGI requires Python 3')
+class AsyncServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        import asyncio
+        from pywps.app.asgi import AsyncService
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.application = AsyncService(Service(processes=[create_greeter()]))
+        self.addCleanup(self.application.close)
+
+    def request(self, method, path, query_string=b'', body=b'', headers=()):
+        """Run the application, return status, headers and body of the response
+        """
+
+        scope = {
+            'type': 'http',
+            'method': method,
+            'path': path,
+            'query_string': query_string,
+            'headers': list(headers)
+        }
+        messages = [{'type': 'http.request', 'body': body}]
+        sent = []
+
+        def receive():
+            future = self.loop.create_future()
+            future.set_result(messages.pop(0))
+            return future
+
+        def send(message):
+            sent.append(message)
+            future = self.loop.create_future()
+            future.set_result(None)
+            return future
+
+        self.loop.run_until_complete(self.application(scope, receive, send))
+        self.assertEqual(sent[0]['type'], 'http.response.start')
+        headers = dict((k.decode('latin-1'), v.decode('latin-1')) for (k, v) in sent[0]['headers'])
+        return (sent[0]['status'], headers, b''.join(m.get('body', b'') for m in sent[1:]))
+
+    def test_capabilities(self):
+        (status, headers, body) = self.request('GET', '/', b'service=wps&request=getcapabilities')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['content-type'], 'text/xml')
+        self.assertEqual(lxml.etree.fromstring(body).tag, '{http://www.opengis.net/wps/1.0.0}Capabilities')
+
+    def test_execute(self):
+        (status, headers, body) = self.request(
+            'GET', '/', b'service=wps&version=1.0.0&request=execute&identifier=greeter'
+            b'&datainputs=name=foo&RawDataOutput=message')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'Hello foo!')
+
+    def test_execute_document(self):
+        (status, headers, body) = self.request(
+            'GET', '/', b'service=wps&version=1.0.0&request=execute&identifier=greeter'
+            b'&datainputs=name=foo')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['content-type'], 'text/xml')
+        doc = lxml.etree.fromstring(body)
+        self.assertEqual(doc.tag, '{http://www.opengis.net/wps/1.0.0}ExecuteResponse')
+        self.assertIn(b'Hello foo!', body)
+
+    def test_execute_stored(self):
+        outputpath = tempfile.mkdtemp()
+        self.addCleanup(configuration.CONFIG.set, 'server', 'outputpath',
+                        configuration.get_config_value('server', 'outputpath'))
+        configuration.CONFIG.set('server', 'outputpath', outputpath)
+        process = create_greeter()
+        process.store_supported = 'true'
+        process.status_supported = 'true'
+        self.application.service = Service(processes=[process])
+
+        (status, headers, body) = self.request(
+            'GET', '/', b'service=wps&version=1.0.0&request=execute&identifier=greeter'
+            b'&datainputs=name=foo&storeExecuteResponse=true&status=true')
+        self.assertEqual(status, 200)
+        doc = lxml.etree.fromstring(body)
+        self.assertEqual(doc.tag, '{http://www.opengis.net/wps/1.0.0}ExecuteResponse')
+        self.assertIn('statusLocation', doc.attrib)
+
+    def test_exception(self):
+        (status, headers, body) = self.request('GET', '/', b'service=wps&request=foo')
+        self.assertEqual(status, 400)
+
+    def test_status_file(self):
+        outputpath = tempfile.mkdtemp()
+        with open(os.path.join(outputpath, 'status.xml'), 'w') as f:
+            f.write('<status/>')
+        for (option, value) in (('outputurl', 'http://localhost/wps/outputs'), ('outputpath', outputpath)):
+            self.addCleanup(configuration.CONFIG.set, 'server', option,
+                            configuration.get_config_value('server', option))
+            configuration.CONFIG.set('server', option, value)
+
+        (status, headers, body) = self.request('GET', '/wps/outputs/status.xml')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'<status/>')
+
+        (status, headers, body) = self.request('GET', '/wps/outputs/missing.xml')
+        self.assertEqual(status, 404)
+
+
+def load_tests(loader=None, tests=None, pattern=None):
+    if not loader:
+        loader = unittest.TestLoader()
+    suite_list = [
+        loader.loadTestsFromTestCase(AsyncServiceTest),
+    ]
+    return unittest.TestSuite(suite_list)
@@ -4,12 +4,17 @@
 # licensed under MIT, Please consult LICENSE.txt for details     #
 ##################################################################
 
+import gzip
+import io
 import unittest
 import lxml
 import lxml.etree
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
 from pywps.app import Process, Service
 from pywps.app.Common import Metadata
 from pywps import WPS, OWS
+from pywps import configuration
 from pywps.tests import assert_pywps_version, client_for
 
 class BadRequestTest(unittest.TestCase):
@@ -103,11 +108,97 @@ class CapabilitiesTest(unittest.TestCase):
         assert_pywps_version(resp)
 
 
+class CapabilitiesCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        def pr1(): pass
+        def pr2(): pass
+        self.pr2 = Process(pr2, 'pr2', 'Process 2')
+        self.service = Service(processes=[Process(pr1, 'pr1', 'Process 1')])
+        self.client = client_for(self.service)
+
+    def test_etag(self):
+        resp = self.client.get('?service=WPS&request=GetCapabilities')
+        assert resp.status_code == 200
+        etag = resp.headers['ETag']
+        assert resp.headers['Last-Modified']
+
+        resp = self.client.get('?service=WPS&request=GetCapabilities')
+        assert resp.headers['ETag'] == etag
+
+    def test_not_modified(self):
+        resp = self.client.get('?service=WPS&request=GetCapabilities')
+        etag = resp.headers['ETag']
+
+        resp = self.client.get('?service=WPS&request=GetCapabilities',
+                               headers={'If-None-Match': etag})
+        assert resp.status_code == 304
+        assert resp.get_data() == b''
+
+    def test_processes_changed(self):
+        resp = self.client.get('?service=WPS&request=GetCapabilities')
+        etag = resp.headers['ETag']
+
+        self.service.processes['pr2'] = self.pr2
+        resp = self.client.get('?service=WPS&request=GetCapabilities',
+                               headers={'If-None-Match': etag})
+        assert resp.status_code == 200
+        assert resp.headers['ETag'] != etag
+        names = resp.xpath_text('/wps:Capabilities'
+                                '/wps:ProcessOfferings'
+                                '/wps:Process'
+                                '/ows:Identifier')
+        assert sorted(names.split()) == ['pr1', 'pr2']
+
+
+class CompressionTest(unittest.TestCase):
+
+    def setUp(self):
+        def pr1(): pass
+        self.addCleanup(configuration.CONFIG.set, 'server', 'compression',
+                        configuration.CONFIG.get('server', 'compression'))
+        configuration.CONFIG.set('server', 'compression', 'zstd,br,gzip')
+        process = Process(pr1, 'pr1', 'Process 1', abstract='Long description. ' * 100)
+        self.client = Client(Service(processes=[process]), BaseResponse)
+
+    def _get(self, request, encoding):
+        return self.client.get('?service=WPS&version=1.0.0&request=%s&identifier=pr1' % request,
+                               headers={'Accept-Encoding': encoding})
+
+    def check_compressed(self, request):
+        plain = self._get(request, 'identity')
+        assert plain.status_code == 200
+        assert 'Content-Encoding' not in plain.headers
+        assert 'Accept-Encoding' in plain.headers['Vary']
+
+        resp = self._get(request, 'gzip')
+        assert resp.status_code == 200
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert resp.headers['ETag'] != plain.headers['ETag']
+        data = gzip.GzipFile(fileobj=io.BytesIO(resp.get_data())).read()
+        assert data == plain.get_data()
+
+    def test_capabilities(self):
+        self.check_compressed('GetCapabilities')
+
+    def test_describe(self):
+        self.check_compressed('DescribeProcess')
+
+    def test_disabled(self):
+        configuration.CONFIG.set('server', 'compression', '')
+        resp = self._get('GetCapabilities', 'gzip')
+        assert resp.status_code == 200
+        assert 'Content-Encoding' not in resp.headers
+        assert 'Vary' not in resp.headers
+
+
 def load_tests(loader=None, tests=None, pattern=None):
     if not loader:
         loader = unittest.TestLoader()
     suite_list = [
         loader.loadTestsFromTestCase(BadRequestTest),
         loader.loadTestsFromTestCase(CapabilitiesTest),
+        loader.loadTestsFromTestCase(CapabilitiesCacheTest),
+        loader.loadTestsFromTestCase(CompressionTest),
     ]
     return unittest.TestSuite(suite_list)
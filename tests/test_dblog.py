@@ -7,11 +7,18 @@
 """Unit tests for dblog
 """
 
+import datetime
+import threading
 import unittest
+import uuid
+
+import sqlalchemy
 
 from pywps import configuration
+from pywps import dblog
 from pywps.dblog import get_session
 from pywps.dblog import ProcessInstance
+from pywps.dblog import RequestInstance
 
 
 class DBLogTest(unittest.TestCase):
@@ -41,12 +48,108 @@ class DBLogTest(unittest.TestCase):
         self.assertEqual(null_percent.count(), 0,
                          'There are no processes without percent loged')
 
+
+class FakeRequest(object):
+    operation = 'execute'
+    version = '1.0.0'
+    identifier = 'fake'
+
+
+class FakeResponse(object):
+    message = 'running'
+    status = 20
+
+    def __init__(self, status_percentage):
+        self.status_percentage = status_percentage
+
+
+class LogWriterTest(unittest.TestCase):
+    """Background log writer test cases"""
+
+    def test_running_count(self):
+        request_uuid = uuid.uuid1()
+        running = len(dblog.get_running())
+        dblog.log_request(request_uuid, FakeRequest())
+        dblog.update_response(request_uuid, FakeResponse(0))
+        self.assertEqual(len(dblog.get_running()), running + 1)
+
+        dblog.update_response(request_uuid, FakeResponse(100), close=True)
+        self.assertEqual(len(dblog.get_running()), running)
+
+    def test_last_update_written(self):
+        request_uuid = str(uuid.uuid1())
+        dblog.log_request(request_uuid, FakeRequest())
+        dblog.flush()
+        dblog._write([
+            ('update', request_uuid, {'percent_done': 10, 'message': 'first', 'status': 20}),
+            ('update', request_uuid, {'percent_done': 100, 'message': 'second', 'status': 40,
+                                      'time_end': datetime.datetime.now()})
+        ])
+        session = get_session()
+        instance = session.query(ProcessInstance).filter_by(uuid=request_uuid).one()
+        self.assertEqual(instance.percent_done, 100)
+        self.assertEqual(instance.message, 'second')
+        session.close()
+
+    def test_forked_child(self):
+        lock = dblog._lock()
+        held = threading.Event()
+        done = threading.Event()
+
+        def hold():
+            with lock:
+                held.set()
+                done.wait()
+        thread = threading.Thread(target=hold)
+        thread.start()
+        held.wait()
+        self.addCleanup(thread.join)
+        self.addCleanup(done.set)
+
+        # as in a child forked while another thread held the lock
+        dblog._PID = -1
+        dblog.get_slots()
+        self.assertIsNot(dblog._lock(), lock)
+
+    def test_drop_overflow(self):
+        writer = dblog._LogWriter(1, 'drop')
+        writer.put(('update', 'a', {}), droppable=True)
+        writer.put(('update', 'b', {}), droppable=True)
+        self.assertEqual(writer.dropped, 1)
+        self.assertEqual(writer.queue.qsize(), 1)
+
+
+class UpgradeTest(unittest.TestCase):
+    """Upgrade of tables created by older versions"""
+
+    def test_added_columns(self):
+        engine = sqlalchemy.create_engine('sqlite://')
+        table = RequestInstance.__table__.name
+        engine.execute('CREATE TABLE {} (uuid VARCHAR(255) PRIMARY KEY, request BLOB NOT NULL)'.format(table))
+        engine.execute("INSERT INTO {} VALUES ('old', x'7b7d')".format(table))
+        engine.execute('CREATE TABLE {} (uuid VARCHAR(255) PRIMARY KEY)'.format(ProcessInstance.__table__.name))
+
+        dblog._upgrade_tables(engine)
+        columns = set(column['name'] for column in sqlalchemy.inspect(engine).get_columns(table))
+        self.assertEqual(columns, set(RequestInstance.__table__.c.keys()))
+        self.assertEqual(engine.execute('SELECT priority FROM {}'.format(table)).scalar(), 0)
+        self.assertIsNone(engine.execute('SELECT claim FROM {}'.format(table)).scalar())
+
+        columns = sqlalchemy.inspect(engine).get_columns(ProcessInstance.__table__.name)
+        self.assertIn('node', [column['name'] for column in columns])
+
+        # nothing to do the second time
+        dblog._upgrade_tables(engine)
+
+
 def load_tests(loader=None, tests=None, pattern=None):
     """Load local tests
     """
     if not loader:
         loader = unittest.TestLoader()
     suite_list = [
-        loader.loadTestsFromTestCase(DBLogTest)
+        loader.loadTestsFromTestCase(DBLogTest),
+        loader.loadTestsFromTestCase(LogWriterTest),
+        loader.loadTestsFromTestCase(UpgradeTest)
     ]
     return unittest.TestSuite(suite_list)
@@ -75,7 +75,8 @@ class DescribeProcessTest(unittest.TestCase):
                          role='http://www.opengis.net/spec/wps/2.0/def/process/description/documentation')]),
             Process(ping, 'ping', 'Process Ping', metadata=[Metadata('ping metadata', 'http://example.org/ping')]),
         ]
-        self.client = client_for(Service(processes=processes))
+        self.service = Service(processes=processes)
+        self.client = client_for(self.service)
 
     def test_get_request_all_args(self):
         resp = self.client.get('?Request=DescribeProcess&service=wps&version=1.0.0&identifier=all')
@@ -130,6 +131,46 @@ class DescribeProcessTest(unittest.TestCase):
         result = get_describe_result(resp)
         assert [pr.identifier for pr in result] == ['hello', 'ping']
 
+    def test_cached_description(self):
+        url = '?Request=DescribeProcess&service=wps&version=1.0.0&identifier=all'
+        resp = self.client.get(url)
+        assert resp.get_data() == self.client.get(url).get_data()
+
+    def test_cached_document(self):
+        from pywps.app.basic import xml_serialize
+        from pywps import configuration
+
+        self.addCleanup(configuration.CONFIG.set, 'server', 'prettyprint',
+                        configuration.CONFIG.get('server', 'prettyprint'))
+        for prettyprint in ('true', 'false'):
+            configuration.CONFIG.set('server', 'prettyprint', prettyprint)
+            # documents are cached until the configuration is reloaded
+            service = Service(processes=list(self.service.processes.values()))
+            # rendered as a whole, without cached fragments
+            doc = WPS.ProcessDescriptions(*[p.describe_xml() for p in service.processes.values()])
+            doc.attrib['{http://www.w3.org/2001/XMLSchema-instance}schemaLocation'] = \
+                'http://www.opengis.net/wps/1.0.0 http://schemas.opengis.net/wps/1.0.0/wpsDescribeProcess_response.xsd'
+            doc.attrib['service'] = 'WPS'
+            doc.attrib['version'] = '1.0.0'
+            doc.attrib['{http://www.w3.org/XML/1998/namespace}lang'] = 'en-US'
+
+            resp = client_for(service).get('?Request=DescribeProcess&service=wps&version=1.0.0&identifier=all')
+            assert resp.get_data() == xml_serialize(doc)
+
+    def test_replaced_process(self):
+        def hello(request):
+            pass
+
+        resp = self.client.get('?service=wps&version=1.0.0&Request=DescribeProcess&identifier=hello')
+        [result] = get_describe_result(resp)
+        assert result.metadata == ['hello metadata']
+
+        self.service.processes['hello'] = Process(hello, 'hello', 'Process Hello',
+                                                  metadata=[Metadata('new hello metadata')])
+        resp = self.client.get('?service=wps&version=1.0.0&Request=DescribeProcess&identifier=hello')
+        [result] = get_describe_result(resp)
+        assert result.metadata == ['new hello metadata']
+
 
 class DescribeProcessInputTest(unittest.TestCase):
 
@@ -7,8 +7,14 @@
 import unittest
 import lxml.etree
 import json
+import sys
 import tempfile
+import threading
+import time
+from io import BytesIO
+import os
 import os.path
+import types
 from pywps import Service, Process, LiteralOutput, LiteralInput,\
     BoundingBoxOutput, BoundingBoxInput, Format, ComplexInput, ComplexOutput
 from pywps.validator.base import emptyvalidator
@@ -16,6 +22,7 @@ from pywps.validator.complexvalidator import validategml
 from pywps.exceptions import InvalidParameterValue
 from pywps import get_inputs_from_xml, get_output_from_xml
 from pywps import E, WPS, OWS
+from pywps import configuration
 from pywps.app.basic import xpath_ns
 from pywps._compat import text_type
 from pywps.tests import client_for, assert_response_success
@@ -24,6 +31,9 @@ from pywps._compat import PY2
 from pywps._compat import StringIO
 if PY2:
     from owslib.ows import BoundingBox
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+else:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
 
 
 def create_ultimate_question():
@@ -91,7 +101,26 @@ def create_complex_proces():
              ])
 
 
+def create_file_writer():
+    def file_writer(request, response):
+        name = request.inputs['name'][0].data
+        with open(os.path.join(response.workdir, 'out.txt'), 'w') as out:
+            out.write(name)
+        response.outputs['message'].file = 'out.txt'
+        return response
+
+    return Process(handler=file_writer,
+                   identifier='file_writer',
+                   title='File writer',
+                   inputs=[LiteralInput('name', 'Input name', data_type='string')],
+                   outputs=[ComplexOutput('message', 'Output message',
+                                          supported_formats=[Format('text/plain')])])
+
+
 def get_output(doc):
+    if doc.getparent() is not None:
+        # ExecuteResponse of a batch
+        doc = lxml.etree.fromstring(lxml.etree.tostring(doc))
     output = {}
     for output_el in xpath_ns(doc, '/wps:ExecuteResponse'
                                    '/wps:ProcessOutputs/wps:Output'):
@@ -197,6 +226,181 @@ class ExecuteTest(unittest.TestCase):
         assert_response_success(resp)
         assert get_output(resp.xml) == {'message': "Hello foo!"}
 
+    def test_process_prototype_untouched(self):
+        process = create_greeter()
+        client = client_for(Service(processes=[process]))
+        resp = client.get('?service=wps&version=1.0.0&Request=Execute'
+                          '&identifier=greeter&datainputs=name=foo')
+        assert_response_success(resp)
+        assert get_output(resp.xml) == {'message': "Hello foo!"}
+
+        self.assertIsNone(process.uuid)
+        self.assertIsNone(process.workdir)
+        self.assertIsNone(process.outputs[0].data)
+
+    def test_raw_file_output(self):
+        client = client_for(Service(processes=[create_file_writer()]))
+        url = ('?service=wps&version=1.0.0&Request=Execute&identifier=file_writer'
+               '&datainputs=name=0123456789&RawDataOutput=message')
+        resp = client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Type'], 'text/plain')
+        self.assertEqual(resp.headers['Content-Length'], '10')
+        self.assertEqual(resp.get_data(), b'0123456789')
+
+        resp = client.get(url, headers={'Range': 'bytes=2-5'})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.headers['Content-Range'], 'bytes 2-5/10')
+        self.assertEqual(resp.get_data(), b'2345')
+
+    def test_concurrent_execute(self):
+        service = Service(processes=[create_file_writer()])
+        cwd = os.getcwd()
+        results = {}
+        parallelprocesses = configuration.get_config_value('server', 'parallelprocesses')
+        configuration.CONFIG.set('server', 'parallelprocesses', '-1')
+        self.addCleanup(configuration.CONFIG.set, 'server', 'parallelprocesses', parallelprocesses)
+
+        def execute(name):
+            client = client_for(service)
+            resp = client.get('?service=wps&version=1.0.0&Request=Execute'
+                              '&identifier=file_writer&datainputs=name=%s' % name)
+            [data] = resp.xpath('/wps:ExecuteResponse/wps:ProcessOutputs'
+                                '/wps:Output/wps:Data/wps:ComplexData')
+            results[name] = data.text
+
+        threads = [threading.Thread(target=execute, args=('t%d' % i,)) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, dict(('t%d' % i, 't%d' % i) for i in range(5)))
+        self.assertEqual(os.getcwd(), cwd)
+
+    def test_new_instance(self):
+        process = create_complex_proces()
+        instance = process.new_instance()
+        self.assertIsNot(instance.inputs[0], process.inputs[0])
+        self.assertIsNot(instance.outputs[0], process.outputs[0])
+        self.assertIs(instance.inputs[0].supported_formats, process.inputs[0].supported_formats)
+
+        instance.set_workdir(tempfile.mkdtemp())
+        self.assertIsNone(process.workdir)
+        self.assertIsNone(process.outputs[0].workdir)
+
+    def test_setup_hook(self):
+        calls = []
+
+        def setup():
+            calls.append('setup')
+            return 'Hello'
+
+        def greeter(request, response, greeting):
+            name = request.inputs['name'][0].data
+            response.outputs['message'].data = "%s %s!" % (greeting, name)
+            return response
+
+        process = Process(handler=greeter, identifier='greeter', title='Greeter',
+                          inputs=[LiteralInput('name', 'Input name', data_type='string')],
+                          outputs=[LiteralOutput('message', 'Output message', data_type='string')],
+                          setup=setup, teardown=calls.append)
+        client = client_for(Service(processes=[process]))
+        for name in ('foo', 'bar'):
+            resp = client.get('?service=wps&version=1.0.0&Request=Execute'
+                              '&identifier=greeter&datainputs=name=%s' % name)
+            assert_response_success(resp)
+            assert get_output(resp.xml) == {'message': "Hello %s!" % name}
+        self.assertEqual(calls, ['setup'])
+
+        process._teardown_setup()
+        self.assertEqual(calls, ['setup', 'Hello'])
+
+    def test_batch(self):
+        client = client_for(Service(processes=[create_greeter()]))
+        resp = client.get('?service=wps&version=1.0.0&Request=Execute&identifier=greeter'
+                          '&datainputs=name=foo&datainputs=name=bar')
+        self.assertEqual(resp.xml.tag, 'BatchExecuteResponse')
+        self.assertEqual([get_output(doc) for doc in resp.xml],
+                         [{'message': "Hello foo!"}, {'message': "Hello bar!"}])
+
+    def test_batch_handler(self):
+        calls = []
+
+        def batch_greeter(requests, responses):
+            calls.append(len(requests))
+            for (request, response) in zip(requests, responses):
+                response.outputs['message'].data = "Hi %s!" % request.inputs['name'][0].data
+
+        process = create_greeter()
+        process.batch_handler = batch_greeter
+        client = client_for(Service(processes=[process]))
+        request_doc = WPS.Execute(
+            OWS.Identifier('greeter'),
+            *[WPS.DataInputs(WPS.Input(OWS.Identifier('name'), WPS.Data(WPS.LiteralData(name))))
+              for name in ('foo', 'bar', 'baz')],
+            version='1.0.0'
+        )
+        resp = client.post_xml(doc=request_doc)
+        self.assertEqual([get_output(doc) for doc in resp.xml],
+                         [{'message': "Hi %s!" % name} for name in ('foo', 'bar', 'baz')])
+        self.assertEqual(calls, [3])
+
+    def test_batch_handler_workdir(self):
+        process = create_file_writer()
+
+        def batch_writer(requests, responses):
+            for (request, response) in zip(requests, responses):
+                process.handler(request, response)
+
+        process.batch_handler = batch_writer
+        client = client_for(Service(processes=[process]))
+        resp = client.get('?service=wps&version=1.0.0&Request=Execute&identifier=file_writer'
+                          '&datainputs=name=foo&datainputs=name=bar')
+        self.assertEqual(resp.xml.tag, 'BatchExecuteResponse')
+        data = [xpath_ns(doc, './wps:ProcessOutputs/wps:Output/wps:Data/wps:ComplexData')[0].text
+                for doc in resp.xml]
+        self.assertEqual(data, ['foo', 'bar'])
+
+    def test_output_error(self):
+        from werkzeug.test import Client
+        from werkzeug.wrappers import BaseResponse
+        from pywps.app.WPSResponse import WPSResponse, STATUS
+        from pywps.app.WPSRequest import WPSRequest
+        import uuid
+
+        process = create_file_writer().new_instance()
+        process._set_uuid(uuid.uuid1())
+        process.set_workdir(tempfile.mkdtemp())
+        wps_request = WPSRequest()
+        wps_request.lineage = 'false'
+        wps_response = WPSResponse(process, wps_request, process.uuid)
+        wps_response.status = STATUS.DONE_STATUS
+        wps_response.outputs['message'].file = os.path.join(process.workdir, 'missing.txt')
+
+        # the error is reported before the response is sent
+        resp = Client(wps_response, BaseResponse).get('/')
+        self.assertNotEqual(resp.status_code, 200)
+        self.assertIn(b'ExceptionReport', resp.get_data())
+
+    def test_json_response(self):
+        client = client_for(Service(processes=[create_greeter()]))
+        url = '?service=wps&version=1.0.0&Request=Execute&identifier=greeter&datainputs=name=foo'
+        for (query, headers) in (('&ResponseFormat=json', {}), ('', {'Accept': 'application/json'})):
+            resp = client.get(url + query, headers=headers)
+            self.assertEqual(resp.headers['Content-Type'], 'application/json')
+            doc = json.loads(resp.get_data(as_text=True))
+            self.assertEqual(doc['status'], 'succeeded')
+            self.assertEqual(doc['process']['identifier'], 'greeter')
+            self.assertEqual([(o['identifier'], o['data']) for o in doc['outputs']],
+                             [('message', 'Hello foo!')])
+
+    def test_bad_response_format(self):
+        client = client_for(Service(processes=[create_greeter()]))
+        resp = client.get('?service=wps&version=1.0.0&Request=Execute&identifier=greeter'
+                          '&datainputs=name=foo&ResponseFormat=yaml')
+        self.assertEqual(resp.status_code, 400)
+
     def test_bbox(self):
         if not PY2:
             self.skipTest('OWSlib not python 3 compatible')
@@ -395,6 +599,675 @@ class ExecuteXmlParserTest(unittest.TestCase):
         self.assertTrue(inpt_filename.startswith(os.path.join(workdir, 'duplicate_')))
         self.assertTrue(inpt_filename.endswith('.html'))
 
+    def test_download(self):
+        from pywps.inout.fetch import download, openurl
+        workdir = tempfile.mkdtemp()
+        source = os.path.join(workdir, 'source.bin')
+        content = bytes(bytearray(range(256))) * 1024
+        with open(source, 'wb') as f:
+            f.write(content)
+
+        target = os.path.join(workdir, 'target.bin')
+        size = download(openurl({'href': 'file://' + source}), target, len(content))
+        self.assertEqual(size, len(content))
+        with open(target, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_download_size_exceeded(self):
+        from pywps.inout.fetch import download
+        from pywps.exceptions import FileSizeExceeded
+        workdir = tempfile.mkdtemp()
+        target = os.path.join(workdir, 'target.bin')
+
+        class Reference(BytesIO):
+            headers = {}
+
+        with self.assertRaises(FileSizeExceeded):
+            download(Reference(b'x' * 200000), target, 100000)
+        self.assertFalse(os.path.exists(target))
+
+        class SizedReference(BytesIO):
+            headers = {'Content-Length': '200000'}
+
+        reference = SizedReference(b'x' * 200000)
+        with self.assertRaises(FileSizeExceeded):
+            download(reference, target, 100000)
+        self.assertTrue(reference.closed)
+
+
+class ReferenceFetcherTest(unittest.TestCase):
+    """Tests for concurrent fetching of reference inputs
+    """
+
+    def test_parallel(self):
+        from pywps.inout.fetch import ReferenceFetcher
+        started = [threading.Event(), threading.Event()]
+        done = []
+
+        def job(index):
+            started[index].set()
+            # passes only if the other download runs at the same time
+            if started[1 - index].wait(5):
+                done.append(index)
+
+        fetcher = ReferenceFetcher(parallel=2)
+        fetcher.add('http://a.example.com/1', job, 0)
+        fetcher.add('http://b.example.com/2', job, 1)
+        fetcher.fetch()
+        self.assertEqual(sorted(done), [0, 1])
+
+    def test_first_error(self):
+        from pywps.inout.fetch import ReferenceFetcher
+        second_failed = threading.Event()
+
+        def slow_failure():
+            second_failed.wait(5)
+            raise ValueError('first')
+
+        def fast_failure():
+            second_failed.set()
+            raise KeyError('second')
+
+        fetcher = ReferenceFetcher(parallel=2)
+        fetcher.add('http://a.example.com/1', slow_failure)
+        fetcher.add('http://b.example.com/2', fast_failure)
+        with self.assertRaises(ValueError):
+            fetcher.fetch()
+
+
+class ETagHandler(BaseHTTPRequestHandler):
+    """Serves the same content with ETag, answers 304 to conditional requests
+    """
+
+    content = b'x' * 1000
+
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(self.content)))
+        self.end_headers()
+        self.wfile.write(self.content)
+
+    def log_message(self, *args):
+        pass
+
+
+class InputCacheTest(unittest.TestCase):
+    """Tests for the cache of reference inputs
+    """
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), ETagHandler)
+        thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.href = 'http://127.0.0.1:%i/data.bin' % self.server.server_port
+
+    def test_hit(self):
+        from pywps.inout.cache import InputCache
+        cache = InputCache(tempfile.mkdtemp(), 10000)
+        workdir = tempfile.mkdtemp()
+        for name in ('first.bin', 'second.bin'):
+            target = os.path.join(workdir, name)
+            self.assertEqual(cache.fetch({'href': self.href}, target, 10000), 1000)
+            with open(target, 'rb') as f:
+                self.assertEqual(f.read(), ETagHandler.content)
+
+        self.assertEqual(cache.stats['misses'], 1)
+        self.assertEqual(cache.stats['hits'], 1)
+        self.assertEqual(cache.stats['hit_bytes'], 1000)
+
+    def test_key(self):
+        from pywps.inout.cache import InputCache
+        get = InputCache.key({'href': self.href})
+        post = InputCache.key({'href': self.href, 'method': 'POST', 'body': 'a'})
+        other_post = InputCache.key({'href': self.href, 'method': 'POST', 'body': 'b'})
+        self.assertEqual(len(set([get, post, other_post])), 3)
+
+    def test_eviction(self):
+        from pywps.inout.cache import InputCache
+        cache = InputCache(tempfile.mkdtemp(), 1500)
+        workdir = tempfile.mkdtemp()
+        for path in ('one', 'two'):
+            inpt = {'href': self.href + '?' + path}
+            cache.fetch(inpt, os.path.join(workdir, path), 10000)
+        self.assertEqual(cache.stats['evicted_bytes'], 1000)
+        self.assertFalse(os.path.exists(os.path.join(cache.path, cache.key({'href': self.href + '?one'}))))
+        # linked input survives the eviction
+        self.assertEqual(os.path.getsize(os.path.join(workdir, 'one')), 1000)
+
+    def test_other_file_system(self):
+        import errno
+        from pywps.inout import cache as cache_module
+        cache = cache_module.InputCache(tempfile.mkdtemp(), 10000)
+        workdir = tempfile.mkdtemp()
+
+        def link(source, target):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+        self.addCleanup(setattr, cache_module.os, 'link', cache_module.os.link)
+        cache_module.os.link = link
+        for name in ('first.bin', 'second.bin'):
+            target = os.path.join(workdir, name)
+            self.assertEqual(cache.fetch({'href': self.href}, target, 10000), 1000)
+            self.assertFalse(os.path.islink(target))
+        self.assertEqual(cache.stats['hits'], 1)
+        # copied input does not change with the cache entry
+        os.remove(os.path.join(cache.path, cache.key({'href': self.href})))
+        with open(os.path.join(workdir, 'second.bin'), 'rb') as f:
+            self.assertEqual(f.read(), ETagHandler.content)
+
+
+class ResultCacheTest(unittest.TestCase):
+    """Tests for the cache of results of deterministic processes
+    """
+
+    def setUp(self):
+        option = 'resultcachepath'
+        self.addCleanup(configuration.CONFIG.set, 'server', option,
+                        configuration.get_config_value('server', option))
+        configuration.CONFIG.set('server', option, tempfile.mkdtemp())
+        self.calls = []
+
+    def create_process(self):
+        process = create_file_writer()
+        handler = process.handler
+
+        def counting_handler(request, response):
+            self.calls.append(request.inputs['name'][0].data)
+            return handler(request, response)
+
+        process.handler = counting_handler
+        process.cacheable = True
+        return process
+
+    def execute(self, client, name):
+        resp = client.get('?service=wps&version=1.0.0&Request=Execute&identifier=file_writer'
+                          '&datainputs=name=%s&RawDataOutput=message' % name)
+        self.assertEqual(resp.status_code, 200)
+        return resp.get_data()
+
+    def test_hit(self):
+        from pywps.app.ResultCache import get_result_cache
+        client = client_for(Service(processes=[self.create_process()]))
+        self.assertEqual(self.execute(client, 'foo'), b'foo')
+        self.assertEqual(self.execute(client, 'foo'), b'foo')
+        self.assertEqual(self.execute(client, 'bar'), b'bar')
+        self.assertEqual(self.calls, ['foo', 'bar'])
+        self.assertEqual(get_result_cache().stats['hits'], 1)
+
+    def test_ttl(self):
+        from pywps.app.ResultCache import ResultCache
+        process = self.create_process()
+        process.set_workdir(tempfile.mkdtemp())
+        process.outputs[0].data = 'foo'
+        cache = ResultCache(tempfile.mkdtemp(), 1000, ttl=0.01)
+        cache.put('key', process)
+        time.sleep(0.05)
+        self.assertFalse(cache.get('key', process.new_instance()))
+
+
+class WorkdirManagerTest(unittest.TestCase):
+    """Tests for the creation and removal of working directories
+    """
+
+    def setUp(self):
+        from pywps.app.WorkdirManager import WorkdirManager
+        self.path = tempfile.mkdtemp()
+        self.manager = WorkdirManager(self.path, pool_size=2, max_age=60, interval=60)
+
+    def test_deferred_removal(self):
+        workdir = self.manager.create('pywps_process_', 'foo')
+        with open(os.path.join(workdir, 'file.txt'), 'w') as f:
+            f.write('foo')
+        self.manager.remove(workdir)
+        self.assertFalse(os.path.exists(workdir))
+
+        self.manager.start()
+        self.manager.wait()
+        self.assertEqual(os.listdir(self.manager.trash), [])
+
+    def test_pool(self):
+        self.manager.start()
+        self.manager.wait()
+        self.assertEqual(len(self.manager._pool), 2)
+        workdir = self.manager.create('pywps_process_', 'foo')
+        self.assertTrue(os.path.basename(workdir).startswith('pywps_process_foo_'))
+        self.assertEqual(os.listdir(workdir), [])
+        self.manager.wait()
+        self.assertEqual(len(self.manager._pool), 2)
+
+    def test_collect(self):
+        from pywps import dblog
+        self.addCleanup(setattr, dblog, 'is_shared', dblog.is_shared)
+        dblog.is_shared = lambda: True
+        leftover = self.manager.create('pywps_process_', 'died')
+        running = self.manager.create('pywps_process_', 'running')
+        queued = self.manager.create('pywps_process_', 'queued')
+        recent = self.manager.create('pywps_process_', 'recent')
+        for workdir in (leftover, running, queued):
+            os.utime(workdir, (time.time() - 120, time.time() - 120))
+        dblog.hold_slot('running', 'test', 1, 60)
+        self.addCleanup(dblog.release_slot, 'running')
+        dblog.store_process('queued', '{}')
+        self.addCleanup(lambda: dblog.remove_stored('queued', dblog.claim_stored('queued')))
+
+        self.manager.collect()
+        self.manager.start()
+        self.manager.wait()
+        self.assertFalse(os.path.exists(leftover))
+        self.assertTrue(os.path.exists(running))
+        self.assertTrue(os.path.exists(queued))
+        self.assertTrue(os.path.exists(recent))
+
+    def test_collect_memory_database(self):
+        # the default in-memory database does not know requests running in
+        # child processes
+        leftover = self.manager.create('pywps_process_', 'running')
+        os.utime(leftover, (time.time() - 120, time.time() - 120))
+
+        self.manager.collect()
+        self.manager.start()
+        self.manager.wait()
+        self.assertTrue(os.path.exists(leftover))
+
+    def test_pooled_age(self):
+        self.manager.start()
+        self.manager.wait()
+        for pooled in self.manager._pool:
+            os.utime(pooled, (time.time() - 120, time.time() - 120))
+        workdir = self.manager.create('pywps_process_', 'foo')
+        self.assertLess(time.time() - os.path.getmtime(workdir), 60)
+
+
+class GrassLocationTest(unittest.TestCase):
+    """Tests for the GRASS GIS locations created from EPSG codes
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(configuration.CONFIG.set, 'grass', 'locations',
+                        configuration.get_config_value('grass', 'locations'))
+        configuration.CONFIG.set('grass', 'locations', self.path)
+
+        # g.proj replaced by creating the PERMANENT mapset of the location
+        self.calls = []
+        # directories created by other processes while g.proj runs
+        self.created = []
+        core = types.ModuleType('grass.script.core')
+        core.run_command = self._run_command
+        script = types.ModuleType('grass.script')
+        script.core = core
+        grass = types.ModuleType('grass')
+        grass.script = script
+        for name, module in (('grass', grass), ('grass.script', script), ('grass.script.core', core)):
+            self.addCleanup(self._restore_module, name, sys.modules.get(name))
+            sys.modules[name] = module
+        self.returncode = 0
+
+    def _restore_module(self, name, module):
+        if module is None:
+            sys.modules.pop(name, None)
+        else:
+            sys.modules[name] = module
+
+    def _run_command(self, name, flags=None, location=None, epsg=None, env=None):
+        self.calls.append((name, epsg))
+        with open(env['GISRC']) as f:
+            dbase = f.readline().split(': ', 1)[1].strip()
+        os.makedirs(os.path.join(dbase, location, 'PERMANENT'))
+        for path in self.created:
+            os.makedirs(path)
+        return self.returncode
+
+    def test_write_gisrc(self):
+        from pywps.app.Process import _write_gisrc
+        gisrc = _write_gisrc(self.path, '/grassdata', 'location', 'mapset')
+        self.assertEqual(gisrc, os.path.join(self.path, 'GISRC'))
+        with open(gisrc) as f:
+            self.assertEqual(f.read(), 'GISDBASE: /grassdata\n'
+                                       'LOCATION_NAME: location\n'
+                                       'MAPSET: mapset\n'
+                                       'GUI: txt\n')
+
+    def test_template(self):
+        from pywps.app.Process import _get_grass_location
+        template = _get_grass_location('4326')
+        self.assertEqual(template, os.path.join(self.path, 'epsg_4326'))
+        self.assertTrue(os.path.isdir(os.path.join(template, 'PERMANENT')))
+        self.assertEqual(self.calls, [('g.proj', '4326')])
+
+        self.assertEqual(_get_grass_location('4326'), template)
+        self.assertEqual(self.calls, [('g.proj', '4326')])
+
+        _get_grass_location('3035')
+        self.assertEqual(self.calls, [('g.proj', '4326'), ('g.proj', '3035')])
+        self.assertEqual(sorted(os.listdir(self.path)), ['epsg_3035', 'epsg_4326'])
+
+    def test_created_meanwhile(self):
+        from pywps.app.Process import _get_grass_location
+        # another process renames its location to the template first
+        self.created.append(os.path.join(self.path, 'epsg_4326', 'PERMANENT'))
+        template = _get_grass_location('4326')
+        self.assertTrue(os.path.isdir(os.path.join(template, 'PERMANENT')))
+        self.assertEqual(os.listdir(self.path), ['epsg_4326'])
+
+    def test_failure(self):
+        from pywps.app.Process import _get_grass_location
+        from pywps.exceptions import NoApplicableCode
+        self.returncode = 1
+        with self.assertRaises(NoApplicableCode):
+            _get_grass_location('4326')
+        self.assertEqual(os.listdir(self.path), [])
+
+
+class StatusUpdateTest(unittest.TestCase):
+    """Tests for the coalescing of status updates
+    """
+
+    def setUp(self):
+        from pywps.app.WPSResponse import WPSResponse, STATUS
+        from pywps.app.WPSRequest import WPSRequest
+        from pywps import dblog
+        import uuid
+
+        for (option, value) in (('outputpath', tempfile.mkdtemp()), ('statusupdateinterval', '60')):
+            self.addCleanup(configuration.CONFIG.set, 'server', option,
+                            configuration.get_config_value('server', option))
+            configuration.CONFIG.set('server', option, value)
+
+        process = create_greeter()
+        process._set_uuid(uuid.uuid1())
+        process.set_workdir(tempfile.mkdtemp())
+        wps_request = WPSRequest()
+        wps_request.operation = 'execute'
+        wps_request.version = '1.0.0'
+        wps_request.identifier = process.identifier
+        dblog.log_request(process.uuid, wps_request)
+        self.addCleanup(dblog.update_response, process.uuid, FinishedResponse, True)
+        self.response = WPSResponse(process, wps_request, process.uuid)
+        self.response.status = STATUS.STORE_AND_UPDATE_STATUS
+
+    def read_status(self):
+        with open(self.response.process.status_location) as f:
+            return f.read()
+
+    def test_coalesce(self):
+        from pywps.app.WPSResponse import STATUS
+        self.response.update_status('accepted', 0)
+        self.assertIn('ProcessAccepted', self.read_status())
+        self.response.update_status('step 1', 10)
+        self.assertIn('step 1', self.read_status())
+        self.response.update_status('step 2', 20)
+        self.assertIn('step 1', self.read_status())
+        self.response.update_status('done', 100, STATUS.DONE_STATUS, clean=False)
+        self.assertIn('ProcessSucceeded', self.read_status())
+
+    def test_status_document(self):
+        self.response.update_status('step 1', 10)
+        doc = lxml.etree.fromstring(self.read_status().encode('utf-8'))
+        self.assertEqual(xpath_ns(doc, '/wps:ExecuteResponse/wps:Process/ows:Identifier')[0].text, 'greeter')
+        self.assertEqual(xpath_ns(doc, '/wps:ExecuteResponse/wps:Status/wps:ProcessStarted')[0].text, 'step 1')
+        # no temporary files are left
+        self.assertEqual(os.listdir(configuration.get_config_value('server', 'outputpath')),
+                         [os.path.basename(self.response.process.status_location)])
+
+    def test_flush_pending(self):
+        configuration.CONFIG.set('server', 'statusupdateinterval', '0.1')
+        self.response.update_status('step 1', 10)
+        self.response.update_status('step 2', 20)
+        self.assertIn('step 1', self.read_status())
+        time.sleep(0.5)
+        self.assertIn('step 2', self.read_status())
+
+
+class WorkerPoolTest(unittest.TestCase):
+    """Tests for the pool of workers running asynchronous requests
+    """
+
+    def setUp(self):
+        from pywps.app import WorkerPool
+        for (option, value) in (('workers', '1'), ('maxtasksperworker', '1'),
+                                ('outputpath', tempfile.mkdtemp())):
+            self.addCleanup(configuration.CONFIG.set, 'server', option,
+                            configuration.get_config_value('server', option))
+            configuration.CONFIG.set('server', option, value)
+        self.addCleanup(setattr, WorkerPool, '_POOL', None)
+
+    def wait_for_status(self, uuid, timeout=20):
+        status_file = os.path.join(configuration.get_config_value('server', 'outputpath'), '%s.xml' % uuid)
+        for _ in range(timeout * 20):
+            if os.path.exists(status_file):
+                with open(status_file) as f:
+                    status = f.read()
+                if 'ProcessSucceeded' in status:
+                    return status
+            time.sleep(0.05)
+        self.fail('Process %s did not finish' % uuid)
+
+    def test_run_in_worker(self):
+        from pywps.app import WorkerPool
+        from pywps import dblog
+        process = create_greeter()
+        process.store_supported = 'true'
+        process.status_supported = 'true'
+        client = client_for(Service(processes=[process]))
+        self.addCleanup(lambda: WorkerPool._POOL.close())
+
+        # the worker is replaced after each request
+        for name in ('foo', 'bar'):
+            resp = client.get('?service=wps&version=1.0.0&Request=Execute&identifier=greeter'
+                              '&datainputs=name=%s&storeExecuteResponse=true&status=true' % name)
+            self.assertEqual(resp.status_code, 200)
+            location = resp.xml.attrib['statusLocation']
+            uuid = os.path.splitext(os.path.basename(location))[0]
+            status = self.wait_for_status(uuid)
+            self.assertIn('Hello %s!' % name, status)
+            # the workers do not share the in-memory database
+            self.assertNotIn(uuid, [slot.uuid for slot in dblog.get_slots()])
+        self.assertIn('greeter', WorkerPool._POOL._processes)
+
+
+class SchedulerTest(unittest.TestCase):
+    """Tests for the queue of asynchronous requests
+    """
+
+    def setUp(self):
+        for (option, value) in (('parallelprocesses', '0'), ('maxprocesses', '2'),
+                                ('queueorder', 'priority'), ('schedulerinterval', '0')):
+            self.addCleanup(configuration.CONFIG.set, 'server', option,
+                            configuration.get_config_value('server', option))
+            configuration.CONFIG.set('server', option, value)
+        self.started = []
+        self.locked = []
+
+    def submit(self, identifier, priority=0, **kwargs):
+        from pywps.app.Scheduler import get_scheduler, register_process
+        from pywps.app.WPSRequest import WPSRequest
+        from pywps.app.WPSResponse import WPSResponse
+        from pywps import dblog
+        import uuid
+
+        prototype = Process(lambda request, response: response, identifier, identifier, priority=priority, **kwargs)
+
+        def run_async(request, response):
+            # record the start instead of running the process
+            self.started.append(identifier)
+            self.locked.append(get_scheduler()._lock.locked())
+        prototype._run_async = run_async
+        register_process(prototype)
+
+        process = prototype.new_instance()
+        process._set_uuid(uuid.uuid1())
+        process.set_workdir(tempfile.mkdtemp())
+        wps_request = WPSRequest()
+        wps_request.operation = 'execute'
+        wps_request.version = '1.0.0'
+        wps_request.identifier = identifier
+        wps_request.inputs = {}
+        wps_request.outputs = {}
+        dblog.log_request(process.uuid, wps_request)
+        self.addCleanup(self.remove_stored, process.uuid)
+        self.addCleanup(dblog.update_response, process.uuid, FinishedResponse, True)
+        self.addCleanup(get_scheduler().release, process.uuid)
+        get_scheduler().submit(process, wps_request, WPSResponse(process, wps_request, process.uuid))
+        return process
+
+    def remove_stored(self, uuid):
+        from pywps import dblog
+        token = dblog.claim_stored(uuid)
+        if token is not None:
+            dblog.remove_stored(uuid, token)
+
+    def test_start_unlocked(self):
+        from pywps.app.Scheduler import get_scheduler
+        # processes are forked outside of the lock
+        self.set_free_slots(1)
+        self.submit('now', 0)
+        self.submit('queued', 0)
+        self.set_free_slots(1)
+        self.assertEqual(get_scheduler().dispatch(), 1)
+        self.assertEqual(self.started, ['now', 'queued'])
+        self.assertEqual(self.locked, [False, False])
+
+    def test_priority_order(self):
+        from pywps.app.Scheduler import get_scheduler
+        from pywps.exceptions import ServerBusy
+
+        self.submit('low', 0)
+        self.submit('high', 5)
+        self.assertEqual(self.started, [])
+        with self.assertRaises(ServerBusy):
+            self.submit('full', 0)
+
+        self.set_free_slots(1)
+        self.assertEqual(get_scheduler().dispatch(), 1)
+        self.assertEqual(self.started, ['high'])
+        # the started request occupies the only slot
+        self.assertEqual(get_scheduler().dispatch(), 0)
+
+    def set_free_slots(self, slots):
+        from pywps import dblog
+        taken = sum(slot.weight for slot in dblog.get_slots(dblog.get_node()))
+        configuration.CONFIG.set('server', 'parallelprocesses', str(int(taken) + slots))
+
+    def test_weight(self):
+        from pywps.app.Scheduler import get_scheduler
+        self.set_free_slots(2)
+        light = self.submit('light')
+        self.submit('heavy', weight=2)
+        # does not overtake the queued heavy request
+        self.submit('light2')
+        self.assertEqual(self.started, ['light'])
+
+        get_scheduler().release(light.uuid)
+        self.assertEqual(get_scheduler().dispatch(), 1)
+        self.assertEqual(self.started, ['light', 'heavy'])
+
+    def test_max_parallel(self):
+        self.set_free_slots(3)
+        self.submit('capped', max_parallel=1)
+        self.submit('capped', max_parallel=1)
+        # skips the capped request
+        self.submit('other')
+        self.assertEqual(self.started, ['capped', 'other'])
+
+    def test_expired_lease(self):
+        from pywps.app.Scheduler import Scheduler
+        from pywps.app.WPSRequest import WPSRequest
+        from pywps import dblog
+        import uuid
+
+        self.addCleanup(configuration.CONFIG.set, 'server', 'leasetime',
+                        configuration.get_config_value('server', 'leasetime'))
+        configuration.CONFIG.set('server', 'leasetime', '0.3')
+        self.set_free_slots(1)
+        scheduler = Scheduler()
+        process = Process(lambda request, response: response, 'crashing', 'crashing')
+        process.uuid = uuid.uuid1()
+        wps_request = WPSRequest()
+        wps_request.operation = 'execute'
+        wps_request.version = '1.0.0'
+        wps_request.identifier = 'crashing'
+        dblog.log_request(process.uuid, wps_request)
+        self.assertTrue(scheduler.acquire(process))
+
+        # the heartbeat renews the slot
+        time.sleep(0.5)
+        self.assertIn(str(process.uuid), [slot.uuid for slot in dblog.get_slots()])
+
+        # the process died, nobody renews the slot
+        scheduler._heartbeat.discard(process.uuid)
+        time.sleep(0.5)
+        self.assertNotIn(str(process.uuid), [slot.uuid for slot in dblog.get_slots()])
+        scheduler.dispatch()
+        self.assertEqual(dblog.get_job(process.uuid).percent_done, -1)
+        self.assertEqual(dblog.get_job(process.uuid).status, 0)
+
+    def test_claim_once(self):
+        from pywps import dblog
+        self.submit('queued', 0)
+        [stored] = [s for s in dblog.get_stored() if s.uuid]
+        token = dblog.claim_stored(stored.uuid)
+        self.assertTrue(token)
+        self.assertIsNone(dblog.claim_stored(stored.uuid))
+        # claimed requests are not offered to other nodes
+        self.assertNotIn(stored.uuid, [s.uuid for s in dblog.get_stored()])
+        self.assertTrue(dblog.remove_stored(stored.uuid, token))
+
+    def test_stale_claim(self):
+        from pywps import dblog
+        self.submit('queued', 0)
+        [stored] = [s for s in dblog.get_stored() if s.uuid]
+        token = dblog.claim_stored(stored.uuid)
+
+        # the claiming node died, another one takes the request over
+        self.addCleanup(configuration.CONFIG.set, 'server', 'claimtimeout',
+                        configuration.get_config_value('server', 'claimtimeout'))
+        configuration.CONFIG.set('server', 'claimtimeout', '0.01')
+        time.sleep(0.05)
+        configuration.CONFIG.set('server', 'nodename', 'other')
+        self.addCleanup(configuration.CONFIG.set, 'server', 'nodename', '')
+        other_token = dblog.claim_stored(stored.uuid)
+        self.assertTrue(other_token.startswith('other:'))
+        self.assertFalse(dblog.remove_stored(stored.uuid, token))
+        self.assertTrue(dblog.remove_stored(stored.uuid, other_token))
+
+    def test_foreign_workdir(self):
+        from pywps.app.Scheduler import get_scheduler
+        from pywps import dblog
+        import shutil
+        process = self.submit('queued', 0)
+        shutil.rmtree(process.workdir)
+
+        # the working directory is local to the node, which queued it
+        configuration.CONFIG.set('server', 'nodename', 'other')
+        self.addCleanup(configuration.CONFIG.set, 'server', 'nodename', '')
+        self.set_free_slots(1)
+        get_scheduler().dispatch()
+        self.assertIn(str(process.uuid), [s.uuid for s in dblog.get_stored()])
+
+        # the node, which queued it, fails it
+        configuration.CONFIG.set('server', 'nodename', '')
+        self.set_free_slots(1)
+        get_scheduler().dispatch()
+        self.assertEqual(self.started, [])
+        self.assertNotIn(str(process.uuid), [s.uuid for s in dblog.get_stored()])
+        self.assertEqual(dblog.get_job(process.uuid).percent_done, -1)
+        self.assertEqual(dblog.get_job(process.uuid).status, 0)
+
+
+class FinishedResponse:
+    message = 'finished'
+    status = 4
+    status_percentage = 100
+
 
 def load_tests(loader=None, tests=None, pattern=None):
     if not loader:
@@ -402,5 +1275,13 @@ def load_tests(loader=None, tests=None, pattern=None):
     suite_list = [
         loader.loadTestsFromTestCase(ExecuteTest),
         loader.loadTestsFromTestCase(ExecuteXmlParserTest),
+        loader.loadTestsFromTestCase(ReferenceFetcherTest),
+        loader.loadTestsFromTestCase(InputCacheTest),
+        loader.loadTestsFromTestCase(ResultCacheTest),
+        loader.loadTestsFromTestCase(WorkdirManagerTest),
+        loader.loadTestsFromTestCase(GrassLocationTest),
+        loader.loadTestsFromTestCase(StatusUpdateTest),
+        loader.loadTestsFromTestCase(WorkerPoolTest),
+        loader.loadTestsFromTestCase(SchedulerTest),
     ]
     return unittest.TestSuite(suite_list)
@@ -16,8 +16,10 @@ from pywps import NAMESPACES
 from pywps.inout.basic import IOHandler, SOURCE_TYPE, SimpleHandler, BBoxInput, BBoxOutput, \
     ComplexInput, ComplexOutput, LiteralInput, LiteralOutput
 from pywps.inout import BoundingBoxInput as BoundingBoxInputXML
+from pywps.inout.outputs import ComplexOutput as ComplexOutputXML
+from pywps.inout.formats import get_format
 from pywps.inout.literaltypes import convert, AllowedValue
-from pywps._compat import StringIO, text_type
+from pywps._compat import StringIO, text_type, PY2
 from pywps.validator.base import emptyvalidator
 from pywps.exceptions import InvalidParameterValue
 from pywps.validator.mode import MODE
@@ -220,6 +222,62 @@ class ComplexOutputTest(unittest.TestCase):
                          get_validator('application/json'))
 
 
+class ComplexOutputChunksTest(unittest.TestCase):
+    """Streamed serialization of ComplexOutput"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def _output(self, content, data_format):
+        file_name = os.path.join(self.tmp_dir, 'output')
+        with open(file_name, 'wb') as f:
+            f.write(content)
+        output = ComplexOutputXML('output', 'Output', supported_formats=[data_format])
+        output.data_format = data_format
+        output.file = file_name
+        return output
+
+    def _assert_chunks(self, output):
+        # parse both documents, so that CDATA sections are compared as text
+        streamed = etree.fromstring(b''.join(output.execute_xml_chunks()))
+        built = etree.fromstring(etree.tostring(output.execute_xml()))
+        self.assertEqual(etree.tostring(streamed), etree.tostring(built))
+
+    def test_xml(self):
+        output = self._output(b'<?xml version="1.0" encoding="UTF-8"?>\n'
+                              b'<!-- comment -->\n<a xmlns="urn:test"><b>c</b></a>',
+                              get_format('GML'))
+        self._assert_chunks(output)
+
+    def test_text(self):
+        output = self._output(u'a < b & \u00e9'.encode('utf-8'), get_format('TEXT'))
+        self._assert_chunks(output)
+
+    @unittest.skipIf(PY2, 'binary data are read as text on Python 2')
+    def test_base64(self):
+        output = self._output(bytes(bytearray(range(256))) * 1000,
+                              Format('image/tiff', encoding='base64'))
+        self._assert_chunks(output)
+
+
+class ComplexOutputJsonTest(unittest.TestCase):
+    """JSON encoding of ComplexOutput"""
+
+    def setUp(self):
+        self.output = ComplexOutputXML('output', 'Output', supported_formats=[get_format('TEXT')])
+
+    def test_text(self):
+        self.output.data = u'a < b & \u00e9'
+        doc = self.output.execute_json()
+        self.assertEqual(doc['data'], u'a < b & \u00e9')
+        self.assertNotIn('encoding', doc)
+
+    def test_bytes(self):
+        self.output.data = b'\x00\xff'
+        doc = self.output.execute_json()
+        self.assertEqual(doc['data'], 'AP8=')
+        self.assertEqual(doc['encoding'], 'base64')
+
 
 class SimpleHandlerTest(unittest.TestCase):
     """SimpleHandler test cases"""
@@ -388,6 +446,8 @@ def load_tests(loader=None, tests=None, pattern=None):
         loader.loadTestsFromTestCase(IOHandlerTest),
         loader.loadTestsFromTestCase(ComplexInputTest),
         loader.loadTestsFromTestCase(ComplexOutputTest),
+        loader.loadTestsFromTestCase(ComplexOutputChunksTest),
+        loader.loadTestsFromTestCase(ComplexOutputJsonTest),
         loader.loadTestsFromTestCase(SimpleHandlerTest),
         loader.loadTestsFromTestCase(LiteralInputTest),
         loader.loadTestsFromTestCase(LiteralOutputTest),